@@ -1,4 +1,5 @@
 import os
+import shutil
 import numpy as np
 import yaml
 from pathlib import Path
@@ -25,53 +26,104 @@ def extract_classname_from_file(filename):
     return ''.join([char for char in filename.split("-")[-1].split(".")[0] if not char.isdigit()])
 
 
+# Class name -> ID, built once. Label generation looks it up for every object of the dataset.
+CLASS_IDS = class_to_id()
+
+
+def bbox_from_mask(mask, class_name):
+    """Bounding box of the non-zero pixels of a mask array, as [class_id, center_x, center_y, width, height]
+    normalized to the mask size, or [] if the mask is empty. class_id is -1 for an unknown class."""
+    height, width = mask.shape
+    if mask.dtype == np.uint8:
+        # One pass over the mask in OpenCV, without building the coordinates of every pixel
+        x_min, y_min, w, h = cv2.boundingRect(mask)
+        if w == 0:
+            return []
+        x_max, y_max = x_min + w - 1, y_min + h - 1
+    else:
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return []
+        cols = np.flatnonzero(mask.any(axis=0))
+        x_min, x_max, y_min, y_max = cols[0], cols[-1], rows[0], rows[-1]
+
+    # The width and height are max - min, not the pixel count, like the labels of the dataset have always been
+    return [CLASS_IDS.get(class_name, -1), (x_min + x_max) / 2 / width, (y_min + y_max) / 2 / height,
+            (x_max - x_min) / width, (y_max - y_min) / height]
+
+
+def bboxes_from_masks(masks):
+    """Bounding boxes of all the masks of a frame, given as {mask file name: mask array}. Empty masks have none."""
+    bboxes = []
+    for mask_name, mask in masks.items():
+        bbox = bbox_from_mask(mask, extract_classname_from_file(os.path.basename(mask_name)))
+        if bbox:
+            bboxes.append(bbox)
+    return bboxes
+
+
+def write_labels(txt_path, bboxes):
+    """Write bounding boxes as a YOLO label file, one "class_id center_x center_y width height" line per box."""
+    with open(txt_path, "w") as file:
+        for class_id, x_center, y_center, width, height in bboxes:
+            file.write(f"{class_id} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
+
+
 def get_bbox_from_mask(mask_path):
     """Extract bounding box from a mask image and return in the format: class_id center_x center_y width height (normalized)."""
-    # Load mask image (single channel)
-    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)  
-    
-    # Get image dimensions (height, width)
-    height, width = mask.shape
-    
-    # Get the coordinates of all white pixels (non-zero pixels)
-    white_pixels = np.where(mask > 0)  # This gives a tuple of row and column indices of white pixels
-    
-    if len(white_pixels[0]) == 0:  # If there are no white pixels in the mask
-        return []
-    
-    # Find x1, x2, y1, y2 based on the white pixels
-    x_min, x_max = np.min(white_pixels[1]), np.max(white_pixels[1])  # Columns (width direction)
-    y_min, y_max = np.min(white_pixels[0]), np.max(white_pixels[0])  # Rows (height direction)
-    
-    # Bounding box width and height
-    width_bbox = x_max - x_min
-    height_bbox = y_max - y_min
-    
-    # Calculate the center of the bounding box
-    center_x = (x_min + x_max) / 2
-    center_y = (y_min + y_max) / 2
-
-    # Normalize the coordinates to be between 0 and 1
-    center_x /= width
-    center_y /= height
-    width_bbox /= width
-    height_bbox /= height
-
-    # Get the class ID
-    file_name = os.path.basename(mask_path)
-    class_name = extract_classname_from_file(file_name)
-    class_id = class_to_id().get(class_name, -1)  # Returns -1 if class not found
-    
-    return [class_id, center_x, center_y, width_bbox, height_bbox]
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    return bbox_from_mask(mask, extract_classname_from_file(os.path.basename(mask_path)))
 
 
 def copy_image(source_path: str, destination_path: str):
-    image = cv2.imread(source_path)
+    image = cv2.imread(source_path, cv2.IMREAD_UNCHANGED)   # Keep the alpha channel of transparent overlays
     if image is None:
         raise FileNotFoundError(f"Failed to load image: {source_path}")
     cv2.imwrite(destination_path, image)
 
 
+def load_rgba(path, out=None):
+    """Decode an image as an RGBA array, the channel order PIL would give. out is an array of the right shape to
+    decode into, like a slot of a layer stack."""
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Failed to load image: {path}")
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGBA, dst=out)
+    if image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGBA, dst=out)
+    return cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA, dst=out)
+
+
+def extract_seq(filename):
+    """Return the sequence number of a [Frame]-[Sequence]-[Class].png file, or inf for files outside the sequence (x-x-EntireFrame.png, the final image, ...)."""
+    parts = os.path.basename(filename).split("-")
+    if len(parts) != 3 or not parts[1].isdigit():
+        return float('inf')
+    return int(parts[1])
+
+
+def get_last_filenum(directory, pattern="img_"):
+    """Return the highest N of the entries named [pattern]N in a directory, or -1 if there are none."""
+    numbers = [int(entry[len(pattern):]) for entry in os.listdir(directory)
+               if entry.startswith(pattern) and entry[len(pattern):].isdigit()]
+    return max(numbers, default=-1)
+
+
+def empty_directory(directory, verbose=0):
+    """Delete every file and folder inside a directory, keeping the directory itself."""
+    removed = 0
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        removed += 1
+    if verbose:
+        print(f"Removed {removed} entries from {directory}")
+
+
 def print_progress_bar(iteration, total, length=50, additional=""):
     """Print progress bar with iteration and percentage."""
     percent = (iteration + 1) / total
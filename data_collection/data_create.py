@@ -5,45 +5,61 @@ from PIL import Image
 import sys
 from generate_background import BackgroundGen
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from common import print_progress_bar
+from common import extract_seq
+from parallel import list_frames, run_frames
 import random
 
 
 # Join all the images together to create the final training sample
 foreground = os.path.dirname(os.path.abspath(__file__)) + "/resource/foreground.png"
 valid_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff"}
+def blend_layer(base_array, img_array):
+    """Alpha-blend an RGBA layer onto the base image, in place."""
+    overlay_alpha = img_array[..., 3] / 255.0
+    base_array[..., :3] = (1 - overlay_alpha[..., None]) * base_array[..., :3] + overlay_alpha[..., None] * img_array[..., :3]
+
+
 def create_image(bgg, frame_path):
-    files = [f for f in os.listdir(frame_path) if os.path.isfile(os.path.join(frame_path, f))]
+    img_name = os.path.basename(frame_path)
+    # Layers in the order they were rendered, the full frame overlay (x-x-EntireFrame.png) last. The output of an
+    # earlier run is not a layer.
+    files = [f for f in os.listdir(frame_path) if os.path.isfile(os.path.join(frame_path, f)) and f != img_name + ".png"]
+    files.sort(key=extract_seq)
 
     base_array = bgg.generate_background(num_splashes = random.randint(0, 5))
     for file in files:
         if not any(file.lower().endswith(ext) for ext in valid_extensions):
             continue
         img = Image.open(os.path.join(frame_path, file)).convert("RGBA")
-        img_array = np.array(img)
-        overlay_alpha = img_array[..., 3] / 255.0
-        base_array[..., :3] = (1 - overlay_alpha[..., None]) * base_array[..., :3] + overlay_alpha[..., None] * img_array[..., :3]
+        blend_layer(base_array, np.array(img))
 
     final_img = Image.fromarray(base_array)
-    img_name = os.path.basename(frame_path)
-
     img_path = os.path.join(frame_path, img_name + ".png")
     final_img.save(img_path)
 
-def create_images(dataset_sort, res_dir):
-    if not dataset_sort or not os.path.exists(dataset_sort):
-        raise NotADirectoryError("The dataset root path is either missing or invalid in the JSON file.")
+# BackgroundGen of this worker process, see init_worker()
+_worker_bgg = None
+
+
+def init_worker(res_dir):
+    """Decode the background and splash images once per worker process rather than once per frame.
+    Each worker reseeds the random generators so forked workers do not all draw the same splashes."""
+    global _worker_bgg
+    random.seed()
+    np.random.seed()
+    _worker_bgg = BackgroundGen(res_dir)
+
+
+def worker_background():
+    return _worker_bgg
+
 
-    frames = [entry for entry in os.listdir(dataset_sort) if os.path.exists(os.path.join(dataset_sort, entry))]
-    total = len(frames)
-    bgg = BackgroundGen(res_dir)
+def create_image_in_worker(frame_path):
+    create_image(_worker_bgg, frame_path)
 
-    for i, f in enumerate(frames):
-        print_progress_bar(i, total, additional=f"Frame: {f}")
-        dir_path = os.path.join(dataset_sort, f)
-        create_image(bgg, dir_path)
 
-    print("")
+def create_images(dataset_sort, res_dir, workers=None):
+    run_frames(create_image_in_worker, list_frames(dataset_sort), workers, initializer=init_worker, initargs=(res_dir,))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import os
+import json
+import random
+from functools import partial
+import cv2
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import extract_seq, empty_directory, load_rgba, bboxes_from_masks, write_labels
+from parallel import list_frames, run_frames
+from manifest import BuildManifest, file_record, fingerprint
+from data_segment import remove_background_array
+from data_create import blend_layer, init_worker, worker_background
+from generate_masks import load_layer_stack, difference_masks, select_masks
+
+
+# Segmenting, compositing, mask and bounding box generation of a frame in one pass over its layers.
+# The staged scripts (data_segment, data_create, generate_masks, generate_bboxes) write every intermediate result
+# as PNG and read it back in the next stage; here each raw layer is decoded once and everything after that happens
+# on arrays. Only the training image and its labels are written (and the masks, if asked for, for data_visualize).
+# The raw layers are left untouched, so a frame can be processed again. process_frames keeps a manifest of what it
+# built from which inputs and only processes new, changed or failed frames.
+
+# Bump when a change to this pipeline changes what it writes, so the next run rebuilds every frame
+PIPELINE_VERSION = 1
+
+
+def frame_inputs(frame_path):
+    """The files process_frame reads: the layers in rendering order, then the full frame overlay if there is one."""
+    entries = [f for f in os.listdir(frame_path) if os.path.isfile(os.path.join(frame_path, f))]
+    files = sorted((f for f in entries if extract_seq(f) != float('inf')), key=extract_seq)
+    if "x-x-EntireFrame.png" in entries:
+        files.append("x-x-EntireFrame.png")
+    return files
+
+
+def process_frame(bgg, frame_path, write_masks=False):
+    """Build the training image and labels of a frame and return the paths it wrote, relative to the frame folder."""
+    img_name = os.path.basename(frame_path)
+    files = frame_inputs(frame_path)
+    overlay = files.pop() if files and files[-1] == "x-x-EntireFrame.png" else None
+    if not files:
+        return []
+
+    # Decode every layer once, into one stack, and cut out the pink background
+    layers = load_layer_stack([os.path.join(frame_path, f) for f in files])
+    for layer in layers:
+        remove_background_array(layer)
+
+    # Training image: the layers over a random background, the full frame overlay on top
+    base_array = bgg.generate_background(num_splashes = random.randint(0, 5))
+    for layer in layers:
+        blend_layer(base_array, layer)
+    if overlay:
+        blend_layer(base_array, load_rgba(os.path.join(frame_path, overlay)))
+    conversion = cv2.COLOR_RGBA2BGRA if base_array.shape[2] == 4 else cv2.COLOR_RGB2BGR
+    cv2.imwrite(os.path.join(frame_path, img_name + ".png"), cv2.cvtColor(base_array, conversion))
+    outputs = [img_name + ".png", img_name + ".txt"]
+
+    masks = select_masks(files, difference_masks(layers))
+    write_labels(os.path.join(frame_path, f"{img_name}.txt"), bboxes_from_masks(masks))
+
+    if write_masks:
+        masks_dir = os.path.join(frame_path, "masks")
+        if not os.path.exists(masks_dir):
+            os.makedirs(masks_dir)
+        else:
+            empty_directory(masks_dir)
+        for mask_name, mask in masks.items():
+            cv2.imwrite(os.path.join(masks_dir, mask_name), mask)
+            outputs.append(os.path.join("masks", mask_name))
+    return outputs
+
+
+def build_frame(bgg, frame_path, write_masks=False):
+    """Run process_frame and return its manifest entry: the inputs it read, the outputs it wrote, and whether it
+    worked. A frame that fails is recorded as failed instead of stopping the whole build."""
+    inputs = {}
+    try:
+        inputs = {name: file_record(os.path.join(frame_path, name)) for name in frame_inputs(frame_path)}
+        outputs = process_frame(bgg, frame_path, write_masks)
+    except Exception as e:
+        return {"status": "failed", "error": f"{type(e).__name__}: {e}", "inputs": inputs}
+    return {"status": "done", "masks": write_masks, "inputs": inputs,
+            "outputs": {name: os.path.getsize(os.path.join(frame_path, name)) for name in outputs}}
+
+
+def build_frame_in_worker(frame_path, write_masks=False):
+    return build_frame(worker_background(), frame_path, write_masks)
+
+
+def pipeline_version(res_dir):
+    """Frames built by another version of the pipeline or from other background resources are out of date."""
+    resources = [os.path.join(res_dir, f) for f in os.listdir(res_dir) if os.path.isfile(os.path.join(res_dir, f))]
+    return fingerprint(PIPELINE_VERSION, paths=resources)
+
+
+def process_frames(dataset_data, res_dir, workers=None, write_masks=False, rebuild=False):
+    """Process every frame that is not up to date in the manifest of the dataset, or all of them with rebuild."""
+    frame_paths = list_frames(dataset_data)
+    manifest = BuildManifest(dataset_data, pipeline_version(res_dir))
+    try:
+        if not rebuild:
+            frame_paths_todo = [frame_path for frame_path in frame_paths
+                                if not manifest.is_current(frame_path, frame_inputs(frame_path), write_masks)]
+        else:
+            frame_paths_todo = frame_paths
+        print(f"{len(frame_paths) - len(frame_paths_todo)} of {len(frame_paths)} frames are up to date")
+        run_frames(partial(build_frame_in_worker, write_masks=write_masks), frame_paths_todo, workers,
+                   initializer=init_worker, initargs=(res_dir,), callback=manifest.record)
+    finally:
+        manifest.close(frame_paths)
+
+    failed = manifest.failed()
+    if failed:
+        print(f"{len(failed)} frames failed and will be retried on the next run:")
+        for frame, error in sorted(failed.items()):
+            print(f"  {frame}: {error}")
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    root_dir = os.path.abspath(os.path.join(script_dir, ".."))
+    res_dir = os.path.abspath(os.path.join(script_dir, "resource"))
+
+    with open(os.path.join(root_dir, "settings.json"), "r") as file:
+        settings = json.load(file)["settings"]
+    dataset_root_path = settings.get("datasetRootPath")
+    dataset_data = os.path.join(dataset_root_path, "data")
+    process_frames(dataset_data, res_dir)
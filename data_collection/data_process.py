@@ -1,13 +1,16 @@
 import os
 import json
+import argparse
 from data_sort import sort_data
 from data_segment import segment_images
 from data_create import create_images
 from generate_masks import generate_masks
 from generate_bboxes import generate_bboxes
+from data_fused import process_frames
+from parallel import default_workers
 
 
-def process_data():
+def process_data(workers=None, staged=False, write_masks=False, rebuild=False):
     script_dir = os.path.dirname(os.path.abspath(__file__))
     root_dir = os.path.abspath(os.path.join(script_dir, ".."))
     res_dir = os.path.abspath(os.path.join(script_dir, "resource"))
@@ -21,17 +24,35 @@ def process_data():
 
     print("Sorting raw data...")
     sort_data(dataset_raw, dataset_data, fg_dir, remove_corrupted_images=True)
+    if not staged:
+        print("Creating images and bounding boxes...")
+        process_frames(dataset_data, res_dir, workers, write_masks, rebuild)
+        print("Dataset done!")
+        return
+
+    # Every stage writes its results to disk and the next one reads them back, which is slow but easy to inspect.
+    # The stages always run on every frame; they segment the layers in place, so the manifest sees them as changed
+    # and the next normal run rebuilds those frames.
     print("Segmenting out the pink background...")
-    segment_images(dataset_data)
+    segment_images(dataset_data, workers)
     print("Creating images...")
-    create_images(dataset_data, res_dir)
+    create_images(dataset_data, res_dir, workers)
     print("Creating masks...")
-    generate_masks(dataset_data)
+    generate_masks(dataset_data, workers)
     print("Creating bounding boxes...")
-    generate_bboxes(dataset_data)
+    generate_bboxes(dataset_data, workers)
     print("Dataset done!")
 
 
 if __name__ == "__main__":
-    process_data()
+    parser = argparse.ArgumentParser(description="Turn the raw downloaded frames into a training dataset.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"Processes to spread the frames over (default: all {default_workers()} cores, 1 to run serially)")
+    parser.add_argument("--staged", action="store_true",
+                        help="Run the stages one after another with their intermediate files, for debugging")
+    parser.add_argument("--masks", action="store_true", help="Also write the object masks (always written with --staged)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Process every frame, not only the ones that are new or changed since the last run")
+    args = parser.parse_args()
+    process_data(args.workers, args.staged, args.masks, args.rebuild)
     
\ No newline at end of file
@@ -1,39 +1,40 @@
 import os
 import json
+import sys
 import numpy as np
 from PIL import Image
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from common import print_progress_bar
+from parallel import list_frames, run_frames
 
 
-def remove_background(img_path, bg_color=(252, 180, 191, 255)):
-    img = Image.open(img_path).convert("RGBA")
-    img_array = np.array(img)
+def remove_background_array(img_array, bg_color=(252, 180, 191, 255)):
+    """Make every pixel of the pink background colour transparent, in place."""
     mask = (img_array[:, :, :3] == bg_color[:3]).all(axis=-1)
     img_array[mask] = [0, 0, 0, 0]
+    return img_array
+
+
+def remove_background(img_path, bg_color=(252, 180, 191, 255)):
+    img = Image.open(img_path).convert("RGBA")
+    img_array = remove_background_array(np.array(img), bg_color)
     Image.fromarray(img_array).save(img_path)
 
 
-def segment_images(dataset_sort):
-    if not dataset_sort or not os.path.exists(dataset_sort):
-        raise NotADirectoryError("The dataset root path is either missing or invalid in the JSON file.")
-    
-    frames = [entry for entry in os.listdir(dataset_sort) if os.path.exists(os.path.join(dataset_sort, entry))]
-    total = len(frames)
-    for i, f in enumerate(frames):
-        print_progress_bar(i, total, additional=f"Frame: {f}")
-        dir_path = os.path.join(dataset_sort, f)
-        files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f))]
-        for f in files:
-            img_path = os.path.join(dir_path, f)
-            sequence = f.split('-')
-            if len(sequence) != 3:
-                continue
-            sequence = f.split('-')[1]
-            if sequence == "x": # The last frame is already transparent
-                continue
-            remove_background(img_path)
-    print("")
+def segment_frame(dir_path):
+    files = [f for f in os.listdir(dir_path) if os.path.isfile(os.path.join(dir_path, f))]
+    for f in files:
+        img_path = os.path.join(dir_path, f)
+        sequence = f.split('-')
+        if len(sequence) != 3:
+            continue
+        sequence = f.split('-')[1]
+        if sequence == "x": # The last frame is already transparent
+            continue
+        remove_background(img_path)
+
+
+def segment_images(dataset_sort, workers=None):
+    run_frames(segment_frame, list_frames(dataset_sort), workers)
 
 
 if __name__ == "__main__":
@@ -1,36 +1,26 @@
 import os
 import json
-import numpy as np
-from PIL import Image
+import cv2
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from common import print_progress_bar, get_bbox_from_mask
+from common import bboxes_from_masks, write_labels
+from parallel import list_frames, run_frames
 
 
 def generate_bbox_from_masks(masks_path, labels_path, image_name):
     txt_filename = os.path.join(labels_path, f"{image_name}.txt")
-    masks = [entry for entry in os.listdir(masks_path) if os.path.exists(os.path.join(masks_path, entry))]
-    with open(txt_filename, "w") as file:
-        for mask in masks:
-            mask_path = os.path.join(masks_path, mask)
-            bbox = get_bbox_from_mask(mask_path)
-            if bbox:
-                class_id, x_center, y_center, width, height = bbox
-                file.write(f"{class_id} {x_center:.6f} {y_center:.6f} {width:.6f} {height:.6f}\n")
-
-
-def generate_bboxes(dataset_data):
-    if not dataset_data or not os.path.exists(dataset_data):
-        raise NotADirectoryError("The dataset data path is either missing or invalid in the JSON file.")
-
-    frames = [entry for entry in os.listdir(dataset_data) if os.path.exists(os.path.join(dataset_data, entry))]
-    total = len(frames)
-    for i, f in enumerate(frames):
-        print_progress_bar(i, total, additional=f"Frame: {f}")
-        frame_path = os.path.join(dataset_data, f)
-        masks_path = os.path.join(frame_path, "masks")
-        generate_bbox_from_masks(masks_path, frame_path, f)
-    print("")
+    masks = {entry: cv2.imread(os.path.join(masks_path, entry), cv2.IMREAD_GRAYSCALE) for entry in os.listdir(masks_path)
+             if os.path.isfile(os.path.join(masks_path, entry))}
+    write_labels(txt_filename, bboxes_from_masks(masks))
+
+
+def generate_bboxes_for_frame(frame_path):
+    masks_path = os.path.join(frame_path, "masks")
+    generate_bbox_from_masks(masks_path, frame_path, os.path.basename(frame_path))
+
+
+def generate_bboxes(dataset_data, workers=None):
+    run_frames(generate_bboxes_for_frame, list_frames(dataset_data), workers)
 
 
 if __name__ == "__main__":
@@ -1,99 +1,180 @@
 import os
 import json
+import time
+import argparse
+import tempfile
 import numpy as np
 from PIL import Image
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from common import extract_seq, empty_directory, print_progress_bar
+from common import extract_seq, empty_directory, load_rgba
+from parallel import list_frames, run_frames
 
 
-def subtract_images(img1, img2):
-    img1 = img1.convert("RGBA")
-    img2 = img2.convert("RGBA")
-    
-    # Convert images to NumPy arrays
-    arr1 = np.array(img1)
-    arr2 = np.array(img2)
-    
-    # Extract alpha channels
-    alpha1 = arr1[:, :, 3]
-    
+def subtract_arrays(arr1, arr2):
+    """Keep the pixels of RGBA layer arr2 that the previous layer arr1 did not have: where arr1 is transparent or
+    the two differ. Everything else becomes (0, 0, 0, 0)."""
     # Find pixels where either alpha is zero or colors differ
-    mask = (alpha1 == 0) | (arr1 != arr2).any(axis=-1)
-    
+    mask = (arr1[:, :, 3] == 0) | (arr1 != arr2).any(axis=-1)
+
     # Create result array: default to (0,0,0,0) and copy differing pixels
     result = np.zeros_like(arr2)
     result[mask] = arr2[mask]
-    
-    # Convert back to PIL image
-    return Image.fromarray(result)
+    return result
+
+
+def subtract_images(img1, img2):
+    arr1 = np.array(img1.convert("RGBA"))
+    arr2 = np.array(img2.convert("RGBA"))
+    return Image.fromarray(subtract_arrays(arr1, arr2))
+
+
+def combine_bomb_masks(bomb_mask, outline_mask):
+    """The bomb and its outline are rendered separately but labelled as one object."""
+    return np.logical_or(bomb_mask > 128, outline_mask > 128).astype(np.uint8) * 255
+
+def difference_masks(stack, previous=None, out=None):
+    """Masks of what every layer of an (L, H, W, 4) RGBA layer stack adds over the layer before it, as an (L, H, W)
+    array: the alpha of the pixels that changed, the same as subtract_arrays(layer before, layer)[:, :, 3] for every
+    pair at once. previous is the layer before stack[0], if there is one; without it the first mask is its alpha."""
+    stack = np.ascontiguousarray(stack)
+    if out is None:
+        out = np.empty(stack.shape[:3], dtype=np.uint8)
+    # One 32-bit word per RGBA pixel, so a pixel is compared with a single instruction instead of four. A pixel that
+    # did not change has the same alpha as before, so "transparent in the layer before" needs no separate test.
+    pixels = stack.view(np.uint32)[..., 0]
+    alpha = stack[..., 3]
+    if previous is None:
+        out[0] = alpha[0]
+    else:
+        np.multiply(alpha[0], pixels[0] != np.ascontiguousarray(previous).view(np.uint32)[..., 0], out=out[0])
+    np.multiply(alpha[1:], pixels[1:] != pixels[:-1], out=out[1:])
+    return out
+
+
+def load_layer_stack(paths, out=None):
+    """Decode the layers into one (L, H, W, 4) RGBA array, straight into its slots."""
+    first = load_rgba(paths[0])
+    if out is None:
+        out = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+    out[0] = first
+    for i in range(1, len(paths)):
+        layer = load_rgba(paths[i], out=out[i])
+        if layer.shape != out.shape[1:]:
+            raise ValueError(f"Layer {paths[i]} is {layer.shape[1]}x{layer.shape[0]}, the frame is {out.shape[2]}x{out.shape[1]}")
+    return out
+
 
-def generate_masks_from_frame(frame_path):
-    files = [entry for entry in os.listdir(frame_path) if os.path.exists(os.path.join(frame_path, entry))]
+def layer_masks(paths, chunk_layers=None):
+    """difference_masks of the layer files in rendering order. With chunk_layers only that many decoded layers are
+    held at a time (plus the last one of the chunk before), instead of the whole stack."""
+    chunk_layers = chunk_layers or len(paths)
+    masks = None
+    previous = None
+    buffer = None
+    for start in range(0, len(paths), chunk_layers):
+        chunk = paths[start:start + chunk_layers]
+        buffer = load_layer_stack(chunk, out=None if buffer is None else buffer[:len(chunk)])
+        if masks is None:
+            masks = np.empty((len(paths),) + buffer.shape[1:3], dtype=np.uint8)
+        difference_masks(buffer, previous, out=masks[start:start + len(chunk)])
+        previous = buffer[len(chunk) - 1].copy()
+    return masks
+
+
+def select_masks(files, masks, threshold=2):
+    """Turn the difference masks of a frame's layers into {mask file name: mask}: the first layer always, the others
+    only if they changed at least `threshold` pixels, and the bomb and its outline merged into one x-x-bomb.png."""
+    counts = np.count_nonzero(masks.reshape(len(masks), -1), axis=1)
+    selected = {files[0]: masks[0]}
+    for i in range(1, len(files)):
+        if counts[i] >= threshold:  # Some threshold
+            selected[files[i]] = masks[i]
+
+    bomb = next((f for f in files if "bomb." in f), None)
+    bomb_outline = next((f for f in files if "bombO" in f), None)
+    if bomb and bomb_outline and bomb in selected and bomb_outline in selected:
+        selected["x-x-bomb.png"] = combine_bomb_masks(selected.pop(bomb), selected.pop(bomb_outline))
+    return selected
+
+
+def generate_masks_from_frame(frame_path, chunk_layers=None):
+    files = [entry for entry in os.listdir(frame_path) if os.path.isfile(os.path.join(frame_path, entry))]
+    files = [f for f in files if extract_seq(f) != float('inf')]
+    files.sort(key=extract_seq)     # Neighbouring layers are diffed, so they have to be in rendering order
 
     masks_dir = os.path.join(frame_path, "masks")
     if not os.path.exists(masks_dir):
         os.makedirs(masks_dir)
     else:
         empty_directory(masks_dir)
+    if not files:
+        return
 
-    img1 = Image.open(os.path.join(frame_path, files[0])).convert("RGBA")
-    mask = img1.split()[3]
-    mask.save(os.path.join(masks_dir, files[0]))
-    for i in range(len(files)):
-        if i == 0:
-            continue
-        if extract_seq(files[i]) == float('inf'):
-            continue
-        img1 = Image.open(os.path.join(frame_path, files[i-1])).convert("RGBA")
-        img2 = Image.open(os.path.join(frame_path, files[i])).convert("RGBA")
-        res = subtract_images(img1, img2)
-        mask = res.split()[3]
-        mask_array = np.array(mask)
-        if np.count_nonzero(mask_array) >= 2:  # Some threshold
-            mask.save(os.path.join(masks_dir, files[i]))
+    masks = select_masks(files, layer_masks([os.path.join(frame_path, f) for f in files], chunk_layers))
+    for mask_name, mask in masks.items():
+        Image.fromarray(mask, mode="L").save(os.path.join(masks_dir, mask_name))
 
     bomb = next((f for f in files if "bomb." in f), None)
     bombOutline = next((f for f in files if "bombO" in f), None)
-    if bomb and bombOutline:    # We need to combine their masks
-        bombPath = os.path.join(masks_dir, bomb)
-        bombOPath = os.path.join(masks_dir, bombOutline)
-        if not os.path.exists(bombPath) or not os.path.exists(bombOPath):
-            return  # Bomb is outside the frame
-
-        bombImg = Image.open(bombPath).convert("RGBA")
-        bombOImg = Image.open(bombOPath).convert("RGBA")
-
-        os.remove(bombPath)
-        os.remove(bombOPath)
-
-        bombArray = np.array(bombImg)
-        bombOArray = np.array(bombOImg)
-        bombMask = bombArray[:, :, 0] > 128
-        bombOMask = bombOArray[:, :, 0] > 128
-
-        combinedMask = np.logical_or(bombMask, bombOMask).astype(np.uint8) * 255
-        combinedImage = Image.fromarray(combinedMask, mode="L")
-        combinedImage.save(os.path.join(masks_dir, "x-x-bomb.png"))
-    elif bomb:
+    if bomb and not bombOutline:
         print(f"Found only a bomb: {frame_path}")
-    elif bombOutline:
+    elif bombOutline and not bomb:
         print(f"Found only a bomb outline: {frame_path}")
 
-def generate_masks(dataset_sort):
-    if not dataset_sort or not os.path.exists(dataset_sort):
-        raise NotADirectoryError("The dataset root path is either missing or invalid in the JSON file.")
+def generate_masks(dataset_sort, workers=None):
+    run_frames(generate_masks_from_frame, list_frames(dataset_sort), workers)
 
-    frames = [entry for entry in os.listdir(dataset_sort) if os.path.exists(os.path.join(dataset_sort, entry))]
-    total = len(frames)
-    for i, f in enumerate(frames):
-        print_progress_bar(i, total, additional=f"Frame: {f}")
-        dir_path = os.path.join(dataset_sort, f)
-        generate_masks_from_frame(dir_path)
-    print("")
+
+def _pairwise_masks(paths):
+    """The masks the way generate_masks_from_frame used to make them, two decodes and a subtract_images per layer.
+    Only kept as the baseline of the benchmark."""
+    masks = [np.array(Image.open(paths[0]).convert("RGBA").split()[3])]
+    for i in range(1, len(paths)):
+        img1 = Image.open(paths[i - 1]).convert("RGBA")
+        img2 = Image.open(paths[i]).convert("RGBA")
+        masks.append(np.array(subtract_images(img1, img2).split()[3]))
+    return np.stack(masks)
+
+
+def benchmark(frames=5, layers=12, width=1280, height=768, chunk_layers=4):
+    """Time the pairwise masks against the stacked ones on synthetic frames, where every layer adds a few random
+    rectangles to the one before, and check that they agree."""
+    rng = np.random.default_rng(0)
+    timings = {"pairwise": [], "stacked": [], f"stacked, {chunk_layers} layers at a time": []}
+    with tempfile.TemporaryDirectory() as directory:
+        for frame in range(frames):
+            layer = np.zeros((height, width, 4), dtype=np.uint8)
+            paths = []
+            for seq in range(layers):
+                for _ in range(3):
+                    x, y = rng.integers(0, width - 100), rng.integers(0, height - 100)
+                    layer[y:y + rng.integers(10, 100), x:x + rng.integers(10, 100)] = rng.integers(1, 256, 4)
+                paths.append(os.path.join(directory, f"{frame}-{seq}-AppleGreenWhole.png"))
+                Image.fromarray(layer).save(paths[-1])
+
+            results = []
+            for name, function in zip(timings, (_pairwise_masks, layer_masks, lambda p: layer_masks(p, chunk_layers))):
+                start = time.perf_counter()
+                results.append(function(paths))
+                timings[name].append((time.perf_counter() - start) * 1000)
+            if not all(np.array_equal(results[0], result) for result in results[1:]):
+                raise AssertionError(f"The masks of frame {frame} differ")
+
+    baseline = np.median(timings["pairwise"])
+    for name, times in timings.items():
+        print(f"{name:>28}: {np.median(times):7.1f} ms per frame of {layers} layers ({baseline / np.median(times):.1f}x)")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the object masks of every frame from its layers.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the stacked masks with the pairwise ones on synthetic frames")
+    parser.add_argument("--layers", type=int, default=12, help="Layers per benchmark frame")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(layers=args.layers)
+        sys.exit()
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     root_dir = os.path.abspath(os.path.join(script_dir, ".."))
 
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+
+
+# Record of what a dataset build has produced, so a rerun only processes the frames that changed.
+# Every finished frame is appended as one JSON line, later lines replacing earlier ones for the same frame, so a run
+# that crashes or is interrupted keeps everything it finished and the next run picks up the rest. At the end of a run
+# the file is rewritten with one line per frame that still exists.
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_record(path):
+    """[size, mtime in ns, sha1] of a file. Size and mtime let a later run skip hashing files nobody touched."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, hash_file(path)]
+
+
+def fingerprint(*parts, paths=()):
+    """A short hash of some version strings and the content of some files, to tell builds with different code or
+    resources apart."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode())
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode())
+        digest.update(hash_file(path).encode())
+    return digest.hexdigest()[:16]
+
+
+class BuildManifest:
+    def __init__(self, dataset_data, version, name=MANIFEST_NAME):
+        self.__path = os.path.join(dataset_data, name)
+        self.__version = version
+        self.__entries = {}
+        self.__dirty = False
+        line = "\n"
+        if os.path.exists(self.__path):
+            with open(self.__path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # The last line of a run that was killed while writing it
+                    self.__entries[entry["frame"]] = entry
+        self.__journal = open(self.__path, "a")
+        if not line.endswith("\n"):
+            self.__journal.write("\n")  # Do not glue the next entry onto a cut off one
+
+    def is_current(self, frame_path, input_names, write_masks=False):
+        """True if the frame was built by this version from the same inputs and its outputs are still there.
+        Inputs are compared by size and mtime first and only hashed when those changed, so checking a frame that
+        nobody touched does not read it."""
+        entry = self.__entries.get(os.path.basename(frame_path))
+        if entry is None or entry.get("status") != "done" or entry.get("version") != self.__version:
+            return False
+        if write_masks and not entry.get("masks"):
+            return False
+        if sorted(entry["inputs"]) != sorted(input_names):
+            return False
+
+        for name, size in entry["outputs"].items():
+            path = os.path.join(frame_path, name)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+
+        touched = {}
+        for name, (size, mtime_ns, sha1) in entry["inputs"].items():
+            stat = os.stat(os.path.join(frame_path, name))
+            if stat.st_size != size:
+                return False
+            if stat.st_mtime_ns != mtime_ns:
+                if hash_file(os.path.join(frame_path, name)) != sha1:
+                    return False
+                touched[name] = [size, stat.st_mtime_ns, sha1]
+        if touched:
+            # Same content with a new mtime (copied, restored from a backup, ...), remember it to skip the hash next time
+            entry["inputs"].update(touched)
+            self.__dirty = True
+        return True
+
+    def record(self, frame_path, entry):
+        """Add the result of building a frame and write it out immediately."""
+        entry = dict(entry, frame=os.path.basename(frame_path), version=self.__version)
+        self.__entries[entry["frame"]] = entry
+        self.__journal.write(json.dumps(entry) + "\n")
+        self.__journal.flush()
+        self.__dirty = True
+
+    def failed(self):
+        return {frame: entry.get("error", "") for frame, entry in self.__entries.items() if entry.get("status") == "failed"}
+
+    def close(self, frame_paths=None):
+        """Rewrite the manifest with one line per frame. Frames not in frame_paths (deleted folders) are dropped."""
+        self.__journal.close()
+        if frame_paths is not None:
+            existing = {os.path.basename(frame_path) for frame_path in frame_paths}
+            removed = [frame for frame in self.__entries if frame not in existing]
+            for frame in removed:
+                del self.__entries[frame]
+            self.__dirty = self.__dirty or bool(removed)
+        if not self.__dirty:
+            return
+
+        # Write next to the manifest and swap it in, so there is a complete manifest on disk at any moment
+        temp_path = self.__path + ".tmp"
+        with open(temp_path, "w") as file:
+            for entry in self.__entries.values():
+                file.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, self.__path)
+        self.__dirty = False
+
+    def __len__(self):
+        return len(self.__entries)
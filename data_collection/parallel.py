@@ -0,0 +1,53 @@
+import os
+import sys
+import multiprocessing as mp
+from functools import partial
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import print_progress_bar
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def list_frames(dataset_data):
+    """Return the path of every frame folder (img_N) of a dataset."""
+    if not dataset_data or not os.path.exists(dataset_data):
+        raise NotADirectoryError("The dataset root path is either missing or invalid in the JSON file.")
+    return [os.path.join(dataset_data, entry) for entry in os.listdir(dataset_data) if os.path.isdir(os.path.join(dataset_data, entry))]
+
+
+def _run_frame(function, frame_path):
+    return frame_path, function(frame_path)
+
+
+def run_frames(function, frame_paths, workers=None, initializer=None, initargs=(), chunksize=None, callback=None):
+    """Call function(frame_path) for every frame folder on a pool of worker processes and show the progress.
+    Frames do not depend on each other, so they are handed out in chunks of `chunksize` frames, which keeps the
+    inter-process overhead per frame low. `initializer(*initargs)` runs once in every worker, for state that is
+    expensive to build, like decoded resource images. `callback(frame_path, result)` is called in this process with
+    what function returned, as soon as the frame is done. workers=1 runs everything in this process."""
+    total = len(frame_paths)
+    if total == 0:
+        return
+    workers = min(workers or default_workers(), total)
+    task = partial(_run_frame, function)
+
+    if workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for i, frame_path in enumerate(frame_paths):
+            print_progress_bar(i, total, additional=f"Frame: {os.path.basename(frame_path)}")
+            result = function(frame_path)
+            if callback is not None:
+                callback(frame_path, result)
+    else:
+        # A few chunks per worker balances the load without sending every frame on its own
+        chunksize = chunksize or max(1, min(32, total // (workers * 4)))
+        with mp.Pool(workers, initializer, initargs) as pool:
+            for i, (frame_path, result) in enumerate(pool.imap_unordered(task, frame_paths, chunksize)):
+                print_progress_bar(i, total, additional=f"Frame: {os.path.basename(frame_path)}")
+                if callback is not None:
+                    callback(frame_path, result)
+    print("")
+
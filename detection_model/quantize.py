@@ -0,0 +1,244 @@
+import os
+import json
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'game_player')))
+from common import get_classnames, print_progress_bar
+from detector import OnnxDetector, export_onnx, to_blob
+from preprocess import FramePreprocessor
+
+
+def list_images(images_dir, limit=None):
+    images = sorted(os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.lower().endswith(".png"))
+    return images[:limit] if limit else images
+
+
+def load_bgra(image_path):
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Failed to load image: {image_path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+
+
+class YoloCalibrationReader:
+    """ Feeds letterboxed validation images to onnxruntime's static quantization calibrator. """
+    def __init__(self, image_paths, input_name, model_size=640):
+        self.__paths = iter(image_paths)
+        self.__input_name = input_name
+        self.__preprocessor = FramePreprocessor(model_size=model_size)
+        self.__total = len(image_paths)
+        self.__count = 0
+
+    def get_next(self):
+        path = next(self.__paths, None)
+        if path is None:
+            return None
+        print_progress_bar(self.__count, self.__total, additional="Calibrating...")
+        self.__count += 1
+        model_input = self.__preprocessor.to_model_input(load_bgra(path))
+        return {self.__input_name: to_blob(model_input)}
+
+
+def quantize_int8(fp32_path, int8_path, calibration_images, model_size=640):
+    """ Statically quantize an exported FP32 ONNX model to INT8 (QDQ, per-channel weights). """
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    input_name = ort.InferenceSession(fp32_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    prepared_path = os.path.splitext(fp32_path)[0] + "-prep.onnx"
+    quant_pre_process(fp32_path, prepared_path)
+
+    reader = YoloCalibrationReader(calibration_images, input_name, model_size)
+    quantize_static(prepared_path, int8_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    print("")
+    os.remove(prepared_path)
+    return int8_path
+
+
+def load_labels(label_path, width, height):
+    """ Read a YOLO label file into class ids and xyxy boxes in pixels. """
+    if not os.path.exists(label_path):
+        return np.zeros(0, dtype=np.int32), np.zeros((0, 4), dtype=np.float32)
+    rows = np.loadtxt(label_path, ndmin=2, dtype=np.float32)
+    if rows.size == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros((0, 4), dtype=np.float32)
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    return rows[:, 0].astype(np.int32), boxes
+
+
+def box_iou(a, b):
+    """ IoU matrix between (N, 4) and (M, 4) xyxy boxes. """
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+
+def average_precision(recall, precision):
+    """ COCO style 101-point interpolated AP. """
+    precision = np.flip(np.maximum.accumulate(np.flip(precision)))    # Precision envelope
+    points = np.linspace(0, 1, 101)
+    indices = np.searchsorted(recall, points, side="left")
+    reached = indices < len(recall)     # Recall levels the detector never reaches count as zero precision
+    return np.where(reached, precision[np.minimum(indices, len(recall) - 1)], 0.0).mean()
+
+
+def evaluate(detector, images_dir, labels_dir, limit=None, warmup=3):
+    """ Run a detector over a split and return per-image latencies and per-class AP50 / AP50-95. """
+    iou_thresholds = np.linspace(0.5, 0.95, 10)
+    num_classes = len(get_classnames())
+    confidences, pred_classes, correct = [], [], []    # One entry per prediction over the whole split
+    gt_counts = np.zeros(num_classes, dtype=np.int64)
+    latencies = []
+
+    images = list_images(images_dir, limit)
+    for _ in range(warmup):
+        detector.detect(load_bgra(images[0]))
+
+    for i, image_path in enumerate(images):
+        print_progress_bar(i, len(images), additional="Evaluating...")
+        screen = load_bgra(image_path)
+        start = time.perf_counter_ns()
+        detections = detector.detect(screen)
+        latencies.append((time.perf_counter_ns() - start) / 1e6)
+
+        label_path = os.path.join(labels_dir, os.path.splitext(os.path.basename(image_path))[0] + ".txt")
+        gt_classes, gt_boxes = load_labels(label_path, screen.shape[1], screen.shape[0])
+        gt_counts += np.bincount(gt_classes[gt_classes >= 0], minlength=num_classes)
+
+        # Greedy matching per IoU threshold, highest confidence first, same class only
+        order = np.argsort(-detections.confidences)
+        boxes, classes = detections.boxes[order], detections.classes[order]
+        hits = np.zeros((len(boxes), len(iou_thresholds)), dtype=bool)
+        if len(boxes) and len(gt_boxes):
+            iou = box_iou(boxes, gt_boxes) * (classes[:, None] == gt_classes[None, :])
+            for t, threshold in enumerate(iou_thresholds):
+                matched = np.zeros(len(gt_boxes), dtype=bool)
+                for d in range(len(boxes)):
+                    candidates = np.where((iou[d] >= threshold) & ~matched)[0]
+                    if len(candidates):
+                        best = candidates[np.argmax(iou[d, candidates])]
+                        matched[best] = True
+                        hits[d, t] = True
+        confidences.append(detections.confidences[order])
+        pred_classes.append(classes)
+        correct.append(hits)
+    print("")
+
+    confidences = np.concatenate(confidences) if confidences else np.zeros(0)
+    pred_classes = np.concatenate(pred_classes) if pred_classes else np.zeros(0, dtype=np.int32)
+    correct = np.concatenate(correct) if correct else np.zeros((0, len(iou_thresholds)), dtype=bool)
+
+    per_class = {}
+    for class_id, name in enumerate(get_classnames()):
+        if gt_counts[class_id] == 0:
+            continue
+        selected = pred_classes == class_id
+        order = np.argsort(-confidences[selected])
+        hits = correct[selected][order]
+        true_positives = np.cumsum(hits, axis=0)
+        false_positives = np.cumsum(~hits, axis=0)
+        recall = true_positives / gt_counts[class_id]
+        precision = true_positives / np.maximum(true_positives + false_positives, 1)
+        aps = [average_precision(recall[:, t], precision[:, t]) if len(hits) else 0.0 for t in range(len(iou_thresholds))]
+        per_class[name] = {"instances": int(gt_counts[class_id]), "ap50": float(aps[0]), "ap50_95": float(np.mean(aps))}
+
+    return np.array(latencies), per_class
+
+
+def summarize(model_path, latencies, per_class):
+    return {
+        "model": model_path,
+        "size_mb": os.path.getsize(model_path) / 2**20,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+        },
+        "map50": float(np.mean([c["ap50"] for c in per_class.values()])) if per_class else 0.0,
+        "map50_95": float(np.mean([c["ap50_95"] for c in per_class.values()])) if per_class else 0.0,
+        "per_class": per_class,
+    }
+
+
+def print_report(report):
+    fp32, int8 = report["fp32"], report["int8"]
+    print(f"{'':<18} {'FP32':>10} {'INT8':>10}")
+    print(f"{'size (MB)':<18} {fp32['size_mb']:>10.2f} {int8['size_mb']:>10.2f}")
+    for key in ("mean", "p50", "p95"):
+        print(f"{'latency ' + key + ' (ms)':<18} {fp32['latency_ms'][key]:>10.2f} {int8['latency_ms'][key]:>10.2f}")
+    print(f"{'mAP50':<18} {fp32['map50']:>10.4f} {int8['map50']:>10.4f}")
+    print(f"{'mAP50-95':<18} {fp32['map50_95']:>10.4f} {int8['map50_95']:>10.4f}")
+    print("")
+    print(f"{'class':<18} {'instances':>10} {'FP32 AP50':>10} {'INT8 AP50':>10} {'delta':>8}")
+    for name, fp32_class in fp32["per_class"].items():
+        int8_ap = int8["per_class"].get(name, {"ap50": 0.0})["ap50"]
+        print(f"{name:<18} {fp32_class['instances']:>10} {fp32_class['ap50']:>10.4f} {int8_ap:>10.4f} {int8_ap - fp32_class['ap50']:>+8.4f}")
+
+
+def quantize_run(run_dir, yolo_dir, num_calibration=200, limit=None, threads=None, model_size=640):
+    """
+    Produce an INT8 version of a trained run and compare it against the FP32 model.
+
+    Args:
+        run_dir (str): Training run directory, e.g. detection_model/FruitNinja/YOLO11s, containing weights/best.pt.
+        yolo_dir (str): Dataset in YOLO format as written by organize_yolo_format.
+        num_calibration (int): Number of images from images/val used for calibration.
+        limit (int, optional): Only evaluate on the first N images of images/test.
+        threads (int, optional): Intra-op threads used when measuring latency.
+        model_size (int): Model input size.
+
+    Returns:
+        dict: The report, which is also written to <run_dir>/weights/quantization_report.json.
+    """
+    weights_dir = os.path.join(run_dir, "weights")
+    fp32_path = os.path.join(weights_dir, "best.onnx")
+    int8_path = os.path.join(weights_dir, "best-int8.onnx")
+    if not os.path.exists(fp32_path):
+        print("Exporting FP32 ONNX model...")
+        fp32_path = export_onnx(os.path.join(weights_dir, "best.pt"), model_size)
+
+    print("Quantizing to INT8...")
+    calibration_images = list_images(os.path.join(yolo_dir, "images", "val"), num_calibration)
+    quantize_int8(fp32_path, int8_path, calibration_images, model_size)
+
+    test_images = os.path.join(yolo_dir, "images", "test")
+    test_labels = os.path.join(yolo_dir, "labels", "test")
+    report = {}
+    for key, path in (("fp32", fp32_path), ("int8", int8_path)):
+        print(f"Evaluating {key.upper()} model...")
+        detector = OnnxDetector(path, threads=threads, model_size=model_size, conf=0.001, iou=0.7)
+        latencies, per_class = evaluate(detector, test_images, test_labels, limit)
+        report[key] = summarize(path, latencies, per_class)
+
+    with open(os.path.join(weights_dir, "quantization_report.json"), "w") as file:
+        json.dump(report, file, indent=4)
+    print_report(report)
+    return report
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    root_dir = os.path.abspath(os.path.join(script_dir, ".."))
+
+    with open(os.path.join(root_dir, "settings.json"), "r") as file:
+        settings = json.load(file)["settings"]
+    dataset_root_path = settings.get("datasetRootPath")
+
+    parser = argparse.ArgumentParser(description="Quantize a trained run to INT8 and compare it against FP32 on the test split.")
+    parser.add_argument("--run", default=os.path.join(script_dir, "FruitNinja", "YOLO11s"), help="Training run directory")
+    parser.add_argument("--data", default=os.path.join(dataset_root_path, "YOLOformat"), help="Dataset in YOLO format")
+    parser.add_argument("--calibration", type=int, default=200, help="Number of validation images used for calibration")
+    parser.add_argument("--limit", type=int, default=None, help="Only evaluate the first N test images")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads for CPU inference")
+    args = parser.parse_args()
+    quantize_run(args.run, args.data, args.calibration, args.limit, args.threads)
@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+
+# A swipe along a polyline of (N, 2) game coordinates. It starts at `start_time` (time.perf_counter() seconds)
+# and moves along the polyline at constant speed for `duration` seconds.
+Swipe = namedtuple("Swipe", ["points", "start_time", "duration"])
+
+
+def swipe_path(swipe, to_screen, rate=240):
+    """ Screen positions (M, 2) of a swipe sampled `rate` times per second at constant speed along its polyline,
+    and the time (same clock as swipe.start_time) at which the mouse has to be at each of them. """
+    points = np.asarray(swipe.points, dtype=np.float64)
+    sx, sy = to_screen(points[:, 0], points[:, 1])
+    screen = np.stack([sx, sy], axis=1)
+
+    # Positions at evenly spaced times along the polyline, at constant speed
+    lengths = np.linalg.norm(np.diff(screen, axis=0), axis=1)
+    distance = np.concatenate([[0.0], np.cumsum(lengths)])
+    steps = max(int(swipe.duration * rate), 1)
+    along = np.linspace(0, distance[-1], steps + 1)
+    path = np.stack([np.interp(along, distance, screen[:, 0]), np.interp(along, distance, screen[:, 1])], axis=1)
+    return path, swipe.start_time + np.linspace(0, swipe.duration, steps + 1)
+
+
+class MouseBackend:
+    """ Drives the real mouse through pyautogui. """
+    def __init__(self):
+        import pyautogui
+        pyautogui.PAUSE = 0             # pyautogui sleeps after every call by default
+        pyautogui.FAILSAFE = False
+        self.__gui = pyautogui
+
+    def move(self, x, y):
+        self.__gui.moveTo(int(x), int(y), _pause=False)
+
+    def press(self, x, y):
+        self.__gui.mouseDown(int(x), int(y), _pause=False)
+
+    def release(self, x, y):
+        self.__gui.mouseUp(int(x), int(y), _pause=False)
+
+
+class RecordingBackend:
+    """ Records mouse events instead of performing them, for headless runs and tests.
+    `events` holds (time.perf_counter(), event, x, y) tuples with event one of "press", "move" and "release". """
+    def __init__(self):
+        self.events = []
+        self.__lock = threading.Lock()
+
+    def __record(self, event, x, y):
+        with self.__lock:
+            self.events.append((time.perf_counter(), event, float(x), float(y)))
+
+    def move(self, x, y):
+        self.__record("move", x, y)
+
+    def press(self, x, y):
+        self.__record("press", x, y)
+
+    def release(self, x, y):
+        self.__record("release", x, y)
+
+    def swipes(self):
+        """ Recorded events grouped into one (N, 2) array of screen positions per press-release pair. """
+        with self.__lock:
+            events = list(self.events)
+        swipes, current = [], None
+        for _, event, x, y in events:
+            if event == "press":
+                current = [(x, y)]
+            elif current is not None:
+                current.append((x, y))
+                if event == "release":
+                    swipes.append(np.array(current))
+                    current = None
+        return swipes
+
+
+class SwipeExecutor:
+    """ Performs swipes on its own thread so capture and inference never wait for the mouse.
+    schedule() hands over a new swipe and returns immediately. A newer swipe replaces the pending one and, with
+    replace=True, also cuts short the one in flight. Game coordinates are converted with `to_screen`, normally
+    GameWrapper.game_to_screen_coords. Executors of several games that share one mouse also share a `lock`, which is
+    held for the whole of each swipe. """
+    def __init__(self, to_screen, backend=None, rate=240, spin=0.001, lock=None):
+        self.to_screen = to_screen
+        self.backend = backend or RecordingBackend()
+        self.lock = lock or threading.Lock()
+        self.rate = rate        # Mouse positions per second during a swipe
+        self.spin = spin        # Poll this long before a deadline instead of sleeping, for precise timing
+
+        self.__pending = None
+        self.__executing = False
+        self.__generation = 0   # Bumped whenever the current swipe should be abandoned
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.completed = 0
+        self.cancelled = 0
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def schedule(self, swipe, replace=True):
+        """ Queue a swipe, replacing any swipe that has not started. With replace=True a swipe in flight is cut short. """
+        with self.__cond:
+            if self.__pending is not None:
+                self.cancelled += 1
+            self.__pending = swipe
+            if replace:
+                self.__generation += 1
+            self.__cond.notify()
+
+    def cancel(self):
+        """ Drop the pending swipe and stop the one in flight. """
+        with self.__cond:
+            if self.__pending is not None:
+                self.cancelled += 1
+            self.__pending = None
+            self.__generation += 1
+            self.__cond.notify()
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__generation += 1
+            self.__cond.notify()
+        self.__thread.join()
+
+    @property
+    def busy(self):
+        """ Whether a swipe is waiting to start or in flight. """
+        with self.__cond:
+            return self.__pending is not None or self.__executing
+
+    def __wait_until(self, deadline, generation):
+        """ Sleep until `deadline`, returning False if the swipe was cancelled or replaced in the meantime. """
+        with self.__cond:
+            while True:
+                if self.__generation != generation or self.__closed:
+                    return False
+                remaining = deadline - time.perf_counter()
+                if remaining <= self.spin:
+                    break
+                self.__cond.wait(remaining - self.spin)
+        while time.perf_counter() < deadline:
+            time.sleep(0)   # Releases the GIL so capture and inference keep running while we poll
+        return True
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__pending is None and not self.__closed:
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+                swipe, self.__pending = self.__pending, None
+                generation = self.__generation
+                self.__executing = True
+            with self.lock:
+                done = self.__execute(swipe, generation)
+            with self.__cond:
+                self.__executing = False
+                if done:
+                    self.completed += 1
+                else:
+                    self.cancelled += 1
+
+    def __execute(self, swipe, generation):
+        path, times = swipe_path(swipe, self.to_screen, self.rate)
+        if not self.__wait_until(times[0], generation):
+            return False
+        self.backend.press(*path[0])
+        for (x, y), deadline in zip(path[1:], times[1:]):
+            if not self.__wait_until(deadline, generation):
+                self.backend.release(x, y)
+                return False
+            self.backend.move(x, y)
+        self.backend.release(*path[-1])
+        return True
+
+
+def add_actuator_arguments(parser):
+    parser.add_argument("--actuator", choices=["none", "mouse", "record"], default="none",
+                        help="Perform swipes with the real mouse, record them without moving the mouse, or do nothing")
+
+
+def executor_from_args(args, to_screen, lock=None, mouse=None):
+    """ `mouse` replaces the real mouse for sources that take swipes themselves, like a SimulatorSource. """
+    if args.actuator == "none":
+        return None
+    if mouse is not None:
+        backend = mouse
+    else:
+        backend = MouseBackend() if args.actuator == "mouse" else RecordingBackend()
+    return SwipeExecutor(to_screen, backend, lock=lock)
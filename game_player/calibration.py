@@ -0,0 +1,187 @@
+import json
+import os
+import time
+import cv2
+import numpy as np
+
+
+BACKGROUND_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data_collection", "resource", "background.png"))
+CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration.json")
+
+
+def load_template(path=BACKGROUND_PATH):
+    """ The game background as a grayscale image, which is what the game region looks like behind fruit and menus. """
+    template = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if template is None:
+        raise FileNotFoundError(f"Error: Background image '{path}' does not exist.")
+    return template
+
+
+def to_gray(screen):
+    if screen.ndim == 2:
+        return screen
+    return cv2.cvtColor(screen, cv2.COLOR_BGRA2GRAY if screen.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+
+def _best_match(gray, template, widths):
+    """ Best (score, x, y, width) of the template resized to each width, at the resolution of `gray`. """
+    best = (-1.0, 0, 0, 0)
+    aspect = template.shape[0] / template.shape[1]
+    for width in widths:
+        width = int(round(width))
+        height = int(round(width * aspect))
+        if width < 16 or width > gray.shape[1] or height > gray.shape[0]:
+            continue
+        resized = cv2.resize(template, (width, height), interpolation=cv2.INTER_AREA)
+        result = cv2.matchTemplate(gray, resized, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (x, y) = cv2.minMaxLoc(result)
+        if score > best[0]:
+            best = (score, x, y, width)
+    return best
+
+
+def find_game_region(screen, template, levels=(480, 960, 960), min_fraction=0.25, steps=40, min_score=0.5):
+    """ Locate the game viewport in a screenshot by multi-scale template matching against the game background.
+    Every plausible game size is tried on a copy of the screen scaled to the first width in `levels`. Each following
+    level (None for full resolution) only refines the scale between the neighbouring steps of the previous one, around
+    the previous match; repeating a width refines the scale further at the same resolution.
+    Returns ({"top", "left", "width", "height"} in screenshot pixels, score), with None instead of the region if
+    nothing matches at least `min_score`. The game keeps the background's aspect ratio. """
+    gray = to_gray(screen)
+    height, width = gray.shape
+    aspect = template.shape[0] / template.shape[1]
+
+    scale = min(1.0, levels[0] / width)
+    small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    widths = np.geomspace(small.shape[1] * min_fraction, small.shape[1], steps)
+    score, x, y, match_width = _best_match(small, template, widths)
+    if score < min_score:
+        return None, score
+    step = widths[1] / widths[0]
+    # From here on x, y and match_width are kept in screenshot pixels
+    x, y, match_width = x / scale, y / scale, match_width / scale
+
+    for level in levels[1:]:
+        previous, scale = scale, 1.0 if level is None else min(1.0, level / width)
+        # Search window: the previous match, grown by the largest scale change and the previous pixel size
+        pad = 2 / previous + match_width * (step - 1)
+        x0, y0 = int(max(x - pad, 0) * scale), int(max(y - pad, 0) * scale)
+        x1 = int(min(x + match_width * step + pad, width) * scale)
+        y1 = int(min(y + match_width * step * aspect + pad, height) * scale)
+        crop = gray[int(y0 / scale):int(np.ceil(y1 / scale)), int(x0 / scale):int(np.ceil(x1 / scale))]
+        crop = cv2.resize(crop, (x1 - x0, y1 - y0), interpolation=cv2.INTER_AREA) if scale < 1 else crop
+        level_score, lx, ly, level_width = _best_match(crop, template, match_width * scale * np.geomspace(1 / step, step, 9))
+        if level_score >= score:
+            score, x, y, match_width = level_score, (lx + x0) / scale, (ly + y0) / scale, level_width / scale
+        step = step ** (1 / 4)     # The 9 scales of this level are 4 steps either side
+
+    region = {"top": int(round(y)), "left": int(round(x)),
+              "width": int(round(match_width)), "height": int(round(match_width * aspect))}
+    return region, score
+
+
+def region_score(screen, region, template, size=(160, 96)):
+    """ How well a region (in screenshot pixels) of a screenshot matches the background, in [-1, 1]. """
+    crop = screen[region["top"]:region["top"] + region["height"], region["left"]:region["left"] + region["width"]]
+    if crop.shape[0] < 16 or crop.shape[1] < 16:
+        return -1.0
+    a = cv2.resize(to_gray(crop), size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    b = cv2.resize(template, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    return float(cv2.matchTemplate(a, b, cv2.TM_CCOEFF_NORMED)[0, 0])
+
+
+def find_game_regions(screen, template, count, min_score=0.5, **kwargs):
+    """ Locate `count` game viewports side by side in one screenshot, ordered left to right. Each region found is
+    covered with noise before searching for the next. Returns (regions, scores) in the order found, with None instead
+    of the regions if fewer than `count` match. """
+    screen = to_gray(screen).copy()
+    noise = np.random.default_rng(0)
+    regions, scores = [], []
+    for _ in range(count):
+        region, score = find_game_region(screen, template, min_score=min_score, **kwargs)
+        scores.append(score)
+        if region is None:
+            return None, scores
+        regions.append(region)
+        top, left = region["top"], region["left"]
+        area = screen[top:top + region["height"], left:left + region["width"]]
+        area[:] = noise.integers(0, 256, size=area.shape, dtype=np.uint8)
+    return sorted(regions, key=lambda r: (r["left"], r["top"])), scores
+
+
+class CalibrationCache:
+    """ Game regions found before, in a JSON file keyed by monitor geometry (and the number of games on the monitor),
+    so restarts need no search or clicks. """
+    def __init__(self, path=CALIBRATION_PATH):
+        self.path = path
+
+    @staticmethod
+    def key(monitor, count=1):
+        key = f"{monitor['left']},{monitor['top']},{monitor['width']},{monitor['height']}"
+        return key if count == 1 else f"{key} x{count}"
+
+    def __load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, "r") as file:
+            return json.load(file)
+
+    def get(self, monitor, count=1):
+        """ The cached region, or list of `count` regions, for the monitor. """
+        return self.__load().get(self.key(monitor, count))
+
+    def put(self, monitor, region, count=1):
+        regions = self.__load()
+        to_json = lambda r: {name: int(r[name]) for name in ("top", "left", "width", "height")}
+        regions[self.key(monitor, count)] = to_json(region) if count == 1 else [to_json(r) for r in region]
+        with open(self.path, "w") as file:
+            json.dump(regions, file, indent=4)
+
+
+def locate_game_regions(monitor, screen, count=1, cache=None, template=None, recalibrate=False, min_score=0.5):
+    """ Absolute regions of `count` games on `monitor` given a screenshot of it: the cached regions if the screen
+    still matches them, otherwise a new search whose result is cached. None if the games cannot be found. """
+    cache = cache or CalibrationCache()
+    template = load_template() if template is None else template
+    offset = np.array([monitor["top"], monitor["left"]])
+
+    cached = None if recalibrate else cache.get(monitor, count)
+    if cached is not None:
+        cached = [cached] if count == 1 else cached
+        relative = [dict(r, top=r["top"] - offset[0], left=r["left"] - offset[1]) for r in cached]
+        if all(region_score(screen, r, template) >= min_score for r in relative):
+            return cached
+
+    regions, _ = find_game_regions(screen, template, count, min_score=min_score)
+    if regions is None:
+        return None
+    for region in regions:
+        region["top"] += int(offset[0])
+        region["left"] += int(offset[1])
+    cache.put(monitor, regions[0] if count == 1 else regions, count)
+    return regions
+
+
+def locate_game_region(monitor, screen, cache=None, template=None, recalibrate=False, min_score=0.5):
+    """ locate_game_regions() for a single game. """
+    regions = locate_game_regions(monitor, screen, 1, cache, template, recalibrate, min_score)
+    return None if regions is None else regions[0]
+
+
+if __name__ == "__main__":
+    # Self-check and timing: paste the background at a known place and scale into a fake desktop and find it again
+    rng = np.random.default_rng(0)
+    template = load_template()
+    background = cv2.imread(BACKGROUND_PATH, cv2.IMREAD_COLOR)
+    for screen_size, (left, top, game_width) in (((1080, 1920), (300, 150, 1280)), ((1440, 2560), (611, 87, 1700)), ((1080, 1920), (0, 0, 900))):
+        screen = rng.integers(0, 256, size=screen_size + (3,), dtype=np.uint8)
+        screen = cv2.GaussianBlur(screen, (0, 0), 3)
+        game_height = int(round(game_width * template.shape[0] / template.shape[1]))
+        screen[top:top + game_height, left:left + game_width] = cv2.resize(background[..., :3], (game_width, game_height))
+        start = time.perf_counter()
+        region, score = find_game_region(screen, template)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"expected left={left} top={top} width={game_width}, found {region} (score {score:.2f}) in {elapsed:.0f} ms")
+        start = time.perf_counter()
+        check = region_score(screen, region, template)
+        print(f"  cached region check: score {check:.2f} in {(time.perf_counter() - start) * 1000:.2f} ms")
@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+from preprocess import FramePreprocessor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import get_classnames
+
+
+# Detector output as plain arrays in frame pixel coordinates:
+#   boxes (N, 4) float32 xyxy, classes (N,) int32, confidences (N,) float32
+Detections = namedtuple("Detections", ["boxes", "classes", "confidences"])
+
+
+def empty_detections():
+    return Detections(np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+
+class Detector:
+    """ Common interface of all detection backends. detect() takes a BGRA frame as captured and returns Detections. """
+    def __init__(self, model_size=640, conf=0.5, iou=0.7):
+        self.names = get_classnames()
+        self.conf = conf
+        self.iou = iou
+        self.preprocessor = FramePreprocessor(model_size=model_size)
+        self.batch_preprocessors = []   # One per position in detect_batch(), since every game region has its own size
+
+    def detect(self, screen, timestamp=None):
+        """ Detect on a whole frame. `timestamp` (ms) is the capture time, for detectors that use tracking state. """
+        detections = self.detect_model_input(self.preprocessor.to_model_input(screen))
+        return Detections(self.preprocessor.to_frame_coords(detections.boxes), detections.classes, detections.confidences)
+
+    def detect_batch(self, screens, slots=None):
+        """ Detect on several frames, e.g. one per game window, in one forward pass where the backend supports it.
+        Frames may differ in size. `slots` gives each frame's preprocessor (default: its position), so a game keeps
+        its buffers when only some games are in the batch. Returns one Detections per frame, in that frame's pixels. """
+        slots = range(len(screens)) if slots is None else slots
+        while len(self.batch_preprocessors) <= max(slots, default=-1):
+            self.batch_preprocessors.append(FramePreprocessor(model_size=self.preprocessor.model_size))
+        preprocessors = [self.batch_preprocessors[slot] for slot in slots]
+        inputs = [preprocessor.to_model_input(screen) for preprocessor, screen in zip(preprocessors, screens)]
+        return [Detections(preprocessor.to_frame_coords(d.boxes), d.classes, d.confidences)
+                for preprocessor, d in zip(preprocessors, self.detect_model_inputs(inputs))]
+
+    def detect_model_input(self, model_input):
+        """ Detect on a prepared BGR model input of model_size x model_size, with boxes in model input pixels. """
+        raise NotImplementedError
+
+    def detect_model_inputs(self, model_inputs):
+        """ detect_model_input() for a list of model inputs. Backends that can run a batch override this. """
+        return [self.detect_model_input(model_input) for model_input in model_inputs]
+
+    def warm_up(self, width, height, runs=3):
+        """ Detect on blank frames of the game size, so one-off costs of the first inferences (lazy initialisation,
+        JIT compilation, memory allocation, kernel selection) are paid before capture starts instead of on the first
+        live frames. Returns the duration of every run in ms. """
+        blank = np.zeros((height, width, 4), dtype=np.uint8)
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self.detect(blank)
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+
+class UltralyticsDetector(Detector):
+    """ PyTorch inference through Ultralytics, on the GPU if there is one. """
+    def __init__(self, weights_path, device=None, threads=None, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        from ultralytics import YOLO
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = YOLO(weights_path).to(self.device)
+
+    def detect_model_input(self, model_input):
+        return self.detect_model_inputs([model_input])[0]
+
+    def detect_model_inputs(self, model_inputs):
+        # A list source is run as one batch
+        results = self.model.predict(source=list(model_inputs), device=self.device, imgsz=self.preprocessor.model_size,
+                                     agnostic_nms=True, conf=self.conf, iou=self.iou, verbose=False)
+        return [self.__to_detections(result) for result in results]
+
+    @staticmethod
+    def __to_detections(result):
+        if len(result.boxes) == 0:
+            return empty_detections()
+        return Detections(result.boxes.xyxy.cpu().numpy().astype(np.float32),
+                          result.boxes.cls.cpu().numpy().astype(np.int32),
+                          result.boxes.conf.cpu().numpy().astype(np.float32))
+
+
+def to_blob(model_input, out=None):
+    """ BGR HWC uint8 letterboxed image -> RGB NCHW float32 tensor in [0, 1], optionally written into `out`. """
+    if out is None:
+        out = np.empty((1, 3) + model_input.shape[:2], dtype=np.float32)
+    np.multiply(model_input[..., ::-1].transpose(2, 0, 1), 1 / 255, out=out[0], casting="unsafe")
+    return out
+
+
+class OnnxDetector(Detector):
+    """ CPU inference of an exported YOLO ONNX model with onnxruntime or OpenVINO.
+    Export a trained run with `python detector.py --export path/to/best.pt`. """
+    def __init__(self, onnx_path, runtime="onnxruntime", threads=None, **kwargs):
+        super().__init__(**kwargs)
+        if not os.path.isfile(onnx_path):
+            raise FileNotFoundError(f"Error: ONNX model '{onnx_path}' does not exist.")
+        size = self.preprocessor.model_size
+        self.__blob = np.empty((1, 3, size, size), dtype=np.float32)   # Reused NCHW input tensor
+        self.__batch_blob = self.__blob                                 # Grown for detect_model_inputs()
+
+        if runtime == "onnxruntime":
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            session = ort.InferenceSession(onnx_path, sess_options=options, providers=["CPUExecutionProvider"])
+            model_input = session.get_inputs()[0]
+            self.dynamic_batch = not isinstance(model_input.shape[0], int)
+            self.__run = lambda blob: session.run(None, {model_input.name: blob})[0]
+        elif runtime == "openvino":
+            import openvino as ov
+            config = {"INFERENCE_NUM_THREADS": threads} if threads else {}
+            compiled = ov.Core().compile_model(onnx_path, "CPU", config)
+            self.dynamic_batch = compiled.input(0).get_partial_shape()[0].is_dynamic
+            request = compiled.create_infer_request()
+            self.__run = lambda blob: request.infer({0: blob})[compiled.output(0)]
+        else:
+            raise ValueError(f"Unknown runtime: {runtime}. Use 'onnxruntime' or 'openvino'.")
+
+    def detect_model_input(self, model_input):
+        output = self.__run(to_blob(model_input, out=self.__blob))
+        return self.decode(output[0])
+
+    def detect_model_inputs(self, model_inputs):
+        # Models exported with a fixed batch size of 1 (the default, see export_onnx) run one input at a time
+        if not self.dynamic_batch or len(model_inputs) == 1:
+            return super().detect_model_inputs(model_inputs)
+        if len(self.__batch_blob) != len(model_inputs):
+            size = self.preprocessor.model_size
+            self.__batch_blob = np.empty((len(model_inputs), 3, size, size), dtype=np.float32)
+        for i, model_input in enumerate(model_inputs):
+            to_blob(model_input, out=self.__batch_blob[i:i + 1])
+        output = self.__run(self.__batch_blob)
+        return [self.decode(prediction) for prediction in output]
+
+    def decode(self, output):
+        """ Decode a raw YOLO11 head output of shape (4 + num_classes, num_anchors) with class-agnostic NMS.
+        Boxes stay in model input pixels. """
+        predictions = output.T
+        scores = predictions[:, 4:]
+        classes = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), classes]
+        keep = confidences >= self.conf
+        if not keep.any():
+            return empty_detections()
+
+        cxcywh = predictions[keep, :4]
+        classes, confidences = classes[keep], confidences[keep]
+        boxes = np.empty_like(cxcywh)
+        boxes[:, :2] = cxcywh[:, :2] - cxcywh[:, 2:] / 2
+        boxes[:, 2:] = cxcywh[:, :2] + cxcywh[:, 2:] / 2
+
+        xywh = np.concatenate([boxes[:, :2], cxcywh[:, 2:]], axis=1)
+        indices = np.asarray(cv2.dnn.NMSBoxes(xywh.tolist(), confidences.tolist(), self.conf, self.iou), dtype=np.int64).reshape(-1)
+        return Detections(boxes[indices].astype(np.float32),
+                          classes[indices].astype(np.int32),
+                          confidences[indices].astype(np.float32))
+
+
+def export_onnx(weights_path, model_size=640, dynamic=False):
+    """ Export trained Ultralytics weights to ONNX next to the .pt file and return the path of the export.
+    With dynamic=True the batch size is left open, so several game windows can be detected on in one run. """
+    from ultralytics import YOLO
+    return YOLO(weights_path).export(format="onnx", imgsz=model_size, dynamic=dynamic)
+
+
+def add_detector_arguments(parser):
+    parser.add_argument("--backend", choices=["ultralytics", "onnxruntime", "openvino"], default="ultralytics",
+                        help="Inference backend. onnxruntime and openvino expect an exported .onnx model as --weights")
+    parser.add_argument("--weights", default="../detection_model/FruitNinja/YOLO11s/weights/best.pt", help="Model weights")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads for CPU inference")
+    parser.add_argument("--conf", type=float, default=0.5, help="Confidence threshold")
+
+
+def detector_from_args(args):
+    if args.backend == "ultralytics":
+        return UltralyticsDetector(args.weights, threads=args.threads, conf=args.conf)
+    return OnnxDetector(args.weights, runtime=args.backend, threads=args.threads, conf=args.conf)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export trained weights to ONNX for the CPU backends.")
+    parser.add_argument("--export", required=True, help="Path to the .pt weights to export")
+    parser.add_argument("--dynamic", action="store_true", help="Export with a variable batch size, for multi_game.py")
+    args = parser.parse_args()
+    print(f"Exported to {export_onnx(args.export, dynamic=args.dynamic)}")
@@ -1,31 +1,63 @@
+from startup import StartupProfile, add_startup_arguments    # First, so the startup profile covers the other imports
 from game_wrapper import GameWrapper
+from frame_source import add_source_arguments, source_from_args
+from metrics import add_metrics_arguments
+from detector import add_detector_arguments, detector_from_args, empty_detections
+from gating import add_gate_arguments, gate_from_args
 import cv2
-import torch
-from ultralytics import YOLO
+import argparse
 
 
 if __name__ == "__main__":
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    weights_path = "../detection_model/FruitNinja/YOLO11s/weights/best.pt"
-    model = YOLO(weights_path).to(device)
+    parser = argparse.ArgumentParser(description="Run YOLO detection on the game and draw the results.")
+    parser.add_argument("--pipelined", action="store_true", help="Run capture, detection and display on separate threads")
+    add_source_arguments(parser)
+    add_metrics_arguments(parser)
+    add_detector_arguments(parser)
+    add_gate_arguments(parser)
+    add_startup_arguments(parser)
+    args = parser.parse_args()
+
+    # The model loads in the background while the game region is found
+    startup = StartupProfile()
+    detector_future = startup.in_background("model load", detector_from_args, args)
+    gate = gate_from_args(args)
+    last_detections = empty_detections()
 
     def custom_take_action(self, screen, prev_FPS, counter, delta_time):
-        frame = cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
+        global last_detections
+        # Reused buffer for the display copy; the detector letterboxes the frame into its own input buffer
+        with self.metrics.stage("convert"):
+            frame = detector.preprocessor.to_bgr(screen)
 
-        prev_FPS = prev_FPS or 0    # in the first frame, there is no FPS
+        # Reuse the last detections while the screen is static
+        if gate is not None:
+            with self.metrics.stage("gate"):
+                changed = gate.changed(screen, counter)
+            self.metrics.record_ratio("gate_skip", not changed)
+        if gate is None or changed:
+            with self.metrics.stage("inference"):
+                last_detections = detector.detect(screen)
+        detections = last_detections
 
-        results = model.predict(source=frame, device=device, agnostic_nms=True, conf=0.5, verbose=False)
-        for result in results:
-            for box in result.boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                label = f"{result.names[int(box.cls[0])]} {box.conf[0]:.2f}"
+        with self.metrics.stage("overlay"):
+            for box, class_id, conf in zip(detections.boxes, detections.classes, detections.confidences):
+                x1, y1, x2, y2 = map(int, box)
+                label = f"{detector.names[class_id]} {conf:.2f}"
                 color = (0, 255, 0) if "Whole" in label else (255, 0, 0) if "Half" in label else (0, 0, 255) if "bomb" in label else (0, 0, 0)
                 cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
                 cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
 
-        cv2.setWindowTitle("GameFrame", f"FPS: {prev_FPS:.2f} - Counter: {counter:.2f} - dT: {delta_time:.2f} - Press Q to quit")
-        cv2.imshow("GameFrame", frame)
+        return frame
 
-    game = GameWrapper(custom_take_action, monitor_index=0)
-    game.play()
-    
\ No newline at end of file
+    with startup.phase("game region"):
+        game = GameWrapper(custom_take_action, source=source_from_args(args), headless=args.headless,
+                           metrics_interval=args.metrics_every, metrics_path=args.metrics_out,
+                           startup=startup if args.startup_profile else None)
+    with startup.phase("wait for model"):
+        detector = detector_future.result()
+    with startup.phase("warm-up"):
+        detector.warm_up(game.source.region["width"], game.source.region["height"], args.warmup)
+    game.play(pipelined=args.pipelined)
+    if gate is not None:
+        print(gate.format())
@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import cv2
+import numpy as np
+import mss
+
+
+class FrameSource:
+    """ Base class for everything GameWrapper can read frames from.
+    grab() returns a BGRA image (the same layout mss produces) or None once the source is exhausted. """
+    region = None   # {"top", "left", "width", "height"} of the game in screen coordinates
+
+    def open(self):
+        """ Called from the thread that will grab frames, right before the first grab. """
+        pass
+
+    def wait(self):
+        """ Block until the next frame is due. Live sources are always due. """
+        pass
+
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ScreenSource(FrameSource):
+    """ Live capture of the game region with mss. Without a region, GameWrapper looks the game up on the monitor
+    (`auto_region`, reusing the cached calibration unless `recalibrate`) or lets the user select it. """
+    def __init__(self, monitor_index=0, region=None, auto_region=True, recalibrate=False):
+        with mss.mss() as sct:
+            if 0 <= monitor_index < len(sct.monitors):
+                self.monitor = sct.monitors[monitor_index]
+            else:
+                raise ValueError(f"Invalid monitor index: {monitor_index}. Available: {len(sct.monitors) - 1}")
+        self.region = region
+        self.auto_region = auto_region
+        self.recalibrate = recalibrate
+        self.__sct = None
+
+    def open(self):
+        self.__sct = mss.mss()  # mss handles are per thread on some platforms
+
+    def grab(self):
+        # Wrap mss' raw buffer instead of copying it with np.array(). Every grab gets a fresh buffer from mss,
+        # so the view stays valid after the next grab.
+        shot = self.__sct.grab(self.region)
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+    def close(self):
+        if self.__sct is not None:
+            self.__sct.close()
+            self.__sct = None
+
+
+class ReplaySource(FrameSource):
+    """ Common pacing for recorded sources: either at their native rate or as fast as possible. """
+    def __init__(self, fps=30.0, realtime=True):
+        self.fps = fps
+        self.realtime = realtime
+        self.__next_time = None
+
+    def open(self):
+        self.__next_time = None
+
+    def wait(self):
+        if not self.realtime or not self.fps:
+            return
+        now = time.perf_counter()
+        if self.__next_time is None:
+            self.__next_time = now
+        elif now < self.__next_time:
+            time.sleep(self.__next_time - now)
+        self.__next_time += 1 / self.fps
+
+
+class VideoSource(ReplaySource):
+    """ Replay of a recorded video file (mp4, avi, ...). """
+    def __init__(self, video_path, realtime=True):
+        if not os.path.isfile(video_path):
+            raise FileNotFoundError(f"Error: Video '{video_path}' does not exist.")
+        self.video_path = video_path
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise ValueError(f"Error: Could not open video '{video_path}'.")
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        capture.release()
+
+        super().__init__(fps, realtime)
+        self.region = {"top": 0, "left": 0, "width": width, "height": height}
+        self.__capture = None
+
+    def open(self):
+        super().open()
+        self.__capture = cv2.VideoCapture(self.video_path)
+
+    def grab(self):
+        ok, frame = self.__capture.read()
+        if not ok:
+            return None
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+
+    def close(self):
+        if self.__capture is not None:
+            self.__capture.release()
+            self.__capture = None
+
+
+def _natural_key(text):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text)]
+
+
+def find_frame_images(image_dir):
+    """ List the frames of an image directory in natural order (img_2 before img_10).
+    Accepts a flat directory of PNGs, or a dataset directory where each img_N folder holds img_N.png or final_image.png. """
+    if not os.path.isdir(image_dir):
+        raise NotADirectoryError(f"Error: '{image_dir}' is not a directory.")
+
+    entries = sorted(os.listdir(image_dir), key=_natural_key)
+    images = [os.path.join(image_dir, f) for f in entries if f.lower().endswith(".png")]
+    if images:
+        return images
+
+    for entry in entries:
+        folder = os.path.join(image_dir, entry)
+        if not os.path.isdir(folder):
+            continue
+        for name in (entry + ".png", "final_image.png"):
+            if os.path.isfile(os.path.join(folder, name)):
+                images.append(os.path.join(folder, name))
+                break
+    if not images:
+        raise FileNotFoundError(f"Error: No frames found in '{image_dir}'.")
+    return images
+
+
+class ImageDirectorySource(ReplaySource):
+    """ Replay of a directory of PNG frames, such as the frames written by the data pipeline. """
+    def __init__(self, image_dir, fps=30.0, realtime=True, loop=False):
+        super().__init__(fps, realtime)
+        self.images = find_frame_images(image_dir)
+        self.loop = loop
+        first = cv2.imread(self.images[0])
+        if first is None:
+            raise FileNotFoundError(f"Failed to load image: {self.images[0]}")
+        height, width = first.shape[:2]
+        self.region = {"top": 0, "left": 0, "width": width, "height": height}
+        self.__index = 0
+
+    def open(self):
+        super().open()
+        self.__index = 0
+
+    def grab(self):
+        if self.__index >= len(self.images):
+            if not self.loop:
+                return None
+            self.__index = 0
+        frame = cv2.imread(self.images[self.__index], cv2.IMREAD_UNCHANGED)
+        self.__index += 1
+        if frame.ndim == 2:
+            return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGRA)
+        if frame.shape[2] == 3:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+        return frame
+
+
+def add_source_arguments(parser):
+    """ Add the command line options shared by all agents for choosing where frames come from. """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--video", help="Replay a recorded video instead of capturing the screen")
+    group.add_argument("--images", help="Replay a directory of PNG frames instead of capturing the screen")
+    group.add_argument("--simulate", action="store_true", help="Play a simulated game instead of capturing the screen")
+    group.add_argument("--replay", help="Replay a session recorded with --record instead of capturing the screen")
+    parser.add_argument("--monitor", type=int, default=0, help="Monitor index for live capture")
+    parser.add_argument("--fps", type=float, default=30.0, help="Replay rate for --images and --simulate")
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible instead of at the native rate")
+    parser.add_argument("--headless", action="store_true", help="Do not open any windows")
+    parser.add_argument("--manual-region", action="store_true", help="Select the game region by clicking instead of finding it")
+    parser.add_argument("--recalibrate", action="store_true", help="Search for the game region even if a cached one still matches")
+    from simulator import add_simulator_arguments
+    add_simulator_arguments(parser)
+
+
+def source_from_args(args):
+    if args.video:
+        return VideoSource(args.video, realtime=not args.fast)
+    if args.images:
+        return ImageDirectorySource(args.images, fps=args.fps, realtime=not args.fast)
+    if args.replay:
+        from recorder import RecordingSource
+        return RecordingSource(args.replay, realtime=not args.fast)
+    if args.simulate:
+        from simulator import simulator_source_from_args
+        return simulator_source_from_args(args)
+    return ScreenSource(args.monitor, auto_region=not args.manual_region, recalibrate=args.recalibrate)
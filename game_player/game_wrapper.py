@@ -2,19 +2,40 @@ import cv2
 import numpy as np
 import mss
 import time
+import threading
+from pipeline import Frame, LatestQueue
+from frame_source import ScreenSource, add_source_arguments, source_from_args
+from metrics import StageMetrics, add_metrics_arguments
+from calibration import CalibrationCache, locate_game_region
+from recorder import add_recorder_arguments, recorder_from_args
+import argparse
 
 
 class GameWrapper:
-    def __init__(self, action_function, monitor_index=0):
+    def __init__(self, action_function, monitor_index=0, window_topmost=False, source=None, headless=False,
+                 metrics_interval=0, metrics_path=None, startup=None, recorder=None):
         self.__action_function = action_function
+        self.__window_topmost = window_topmost
+        self.__headless = headless
+        self.frame = None   # The Frame currently being handled by the action function
 
-        with mss.mss() as sct:
-            if 0 <= monitor_index < len(sct.monitors):
-                self.monitor = sct.monitors[monitor_index]
-            else:
-                raise ValueError(f"Invalid monitor index: {monitor_index}. Available: {len(sct.monitors) - 1}")
-            
-        self.__game_region = self.__get_game_region()
+        # Stage latencies. The wrapper times grab, action, display and the whole frame; action functions can add
+        # their own stages with `with self.metrics.stage("inference"): ...`
+        self.metrics = StageMetrics()
+        self.__metrics_interval = metrics_interval  # Seconds between live metric prints, 0 to disable
+        self.__metrics_path = metrics_path          # .json/.csv file the metrics are written to when play() returns
+        self.__metrics_last_print = 0
+        self.__startup = startup    # StartupProfile, completed and printed once the first frame has been handled
+        # SessionRecorder that gets every handled frame together with what the action function annotate()d for it
+        self.recorder = recorder
+        self.__annotations = {}
+
+        # Live screen capture unless another frame source (video, image directory, ...) is given
+        self.source = source or ScreenSource(monitor_index)
+        if self.source.region is None:
+            self.monitor = self.source.monitor
+            self.source.region = self.__find_game_region()
+        self.__game_region = self.source.region
 
     def game_to_screen_coords(self, gx, gy):
         """ Convert game region coordinates to real screen coordinates. """
@@ -22,8 +43,36 @@ class GameWrapper:
         sy = self.__game_region["top"] + gy
         return sx, sy
 
-    def __get_game_region(self):
-        """ Capture a scaled-down screen and let the user select a region by clicking two corners. """
+    def annotate(self, **fields):
+        """ Attach data (detections, tracks, swipes, ...) to the current frame's entry in the session recording. """
+        if self.recorder is not None:
+            self.__annotations.update(fields)
+
+    def __record(self, frame):
+        if self.recorder is not None:
+            with self.metrics.stage("record"):
+                self.recorder.record(frame, self.__annotations)
+            self.__annotations = {}
+
+    def __find_game_region(self):
+        """ Find the game on the monitor automatically (or take it from the calibration cache), falling back to manual
+        selection. Manual selections are cached as well, so only the first start needs a person at the keyboard. """
+        with mss.mss() as sct:
+            screen = np.array(sct.grab(self.monitor))
+        cache = CalibrationCache()
+        if getattr(self.source, "auto_region", False):
+            start = time.perf_counter()
+            region = locate_game_region(self.monitor, screen, cache=cache, recalibrate=getattr(self.source, "recalibrate", False))
+            if region is not None:
+                print(f"Game region {region} found in {(time.perf_counter() - start) * 1000:.0f} ms")
+                return region
+            print("Could not find the game automatically, please select it manually.")
+        region = self.__get_game_region(screen)
+        cache.put(self.monitor, region)
+        return region
+
+    def __get_game_region(self, screen):
+        """ Show a scaled-down screenshot and let the user select a region by clicking two corners. """
         selected_game_corners = []
         mouse_callback_res = {
             "X": None,
@@ -38,97 +87,279 @@ class GameWrapper:
             param["E"] = event  # Update event
 
         is_inside_mouse_press = False
-        with mss.mss() as sct:
-            # Grab the screen to display
-            screen = np.array(sct.grab(self.monitor))  
-            screen = cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
-
-            height, width = screen.shape[:2]
-            screen_resized = cv2.resize(screen, (width // 2, height // 2))
-
-            instructions = "Left-click on the top-left corner of the game."
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            font_scale = 1.5
-            font_color = (0, 255, 255)  # Yellow for better contrast
-            line_thickness = 2
-            background_color = (0, 0, 0)  # Black background for text
-
-            # Create a blank image with the same size as the resized screen
-            while len(selected_game_corners) < 2:
-                # Display the screen in the resized window
-                screen_resized = np.array(sct.grab(self.monitor))
-                screen_resized = cv2.cvtColor(screen_resized, cv2.COLOR_BGRA2BGR)
-                screen_resized = cv2.resize(screen_resized, (width // 2, height // 2))
-
-                # Check for mouse click to select the corners
-                if mouse_callback_res["E"] == cv2.EVENT_LBUTTONDOWN:
-                    if not is_inside_mouse_press:
-                        selected_game_corners.append((mouse_callback_res["X"], mouse_callback_res["Y"]))
-                        instructions = "Now, left-click on the bottom-right corner."
-                    is_inside_mouse_press = True
-                
-                if mouse_callback_res["E"] == cv2.EVENT_LBUTTONUP:
-                    is_inside_mouse_press = False
-
-                # Dynamically draw the rectangle as the user moves the mouse
-                if len(selected_game_corners) == 1:
-                    x1, y1 = selected_game_corners[0]
-                    x2, y2 = mouse_callback_res["X"], mouse_callback_res["Y"]
-                    # Fill the rectangle with lower alpha
-                    filled_color = (0, 255, 0)  # Green for the fill
-                    alpha = 0.2  # Low alpha for transparency in the fill (20% opacity)
-                    overlay = screen_resized.copy()
-                    cv2.rectangle(overlay, (x1, y1), (x2, y2), filled_color, -1)  # -1 to fill the rectangle
-                    # Blend the overlay with the original image
-                    cv2.addWeighted(overlay, alpha, screen_resized, 1 - alpha, 0, screen_resized)
-                    # Draw the rectangle border with 100% opacity
-                    cv2.rectangle(screen_resized, (x1, y1), (x2, y2), (0, 255, 0), 1)  # Border with 100% opacity
-
-                # Draw the instructions with a background
-                cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, background_color, line_thickness + 1, cv2.LINE_AA)
-                cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, font_color, line_thickness, cv2.LINE_AA)
-
-                # Add a pulsing effect to the text for better visibility
-                if time.time() % 1 > 0.5:
-                    cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, (255, 0, 0), line_thickness, cv2.LINE_AA)
-
-                # Update window and wait
-                cv2.imshow("Select two corners", screen_resized)
-                cv2.setMouseCallback("Select two corners", mouse_callback, mouse_callback_res)
-                cv2.waitKey(1)
+        # The screenshot is resized once; every iteration only draws onto a copy of it
+        screen = cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
+
+        height, width = screen.shape[:2]
+        screen_small = cv2.resize(screen, (width // 2, height // 2))
+
+        instructions = "Left-click on the top-left corner of the game."
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 1.5
+        font_color = (0, 255, 255)  # Yellow for better contrast
+        line_thickness = 2
+        background_color = (0, 0, 0)  # Black background for text
+
+        # Create a blank image with the same size as the resized screen
+        while len(selected_game_corners) < 2:
+            # Display the screen in the resized window
+            screen_resized = screen_small.copy()
+
+            # Check for mouse click to select the corners
+            if mouse_callback_res["E"] == cv2.EVENT_LBUTTONDOWN:
+                if not is_inside_mouse_press:
+                    selected_game_corners.append((mouse_callback_res["X"], mouse_callback_res["Y"]))
+                    instructions = "Now, left-click on the bottom-right corner."
+                is_inside_mouse_press = True
+            
+            if mouse_callback_res["E"] == cv2.EVENT_LBUTTONUP:
+                is_inside_mouse_press = False
+
+            # Dynamically draw the rectangle as the user moves the mouse
+            if len(selected_game_corners) == 1:
+                x1, y1 = selected_game_corners[0]
+                x2, y2 = mouse_callback_res["X"], mouse_callback_res["Y"]
+                # Fill the rectangle with lower alpha
+                filled_color = (0, 255, 0)  # Green for the fill
+                alpha = 0.2  # Low alpha for transparency in the fill (20% opacity)
+                overlay = screen_resized.copy()
+                cv2.rectangle(overlay, (x1, y1), (x2, y2), filled_color, -1)  # -1 to fill the rectangle
+                # Blend the overlay with the original image
+                cv2.addWeighted(overlay, alpha, screen_resized, 1 - alpha, 0, screen_resized)
+                # Draw the rectangle border with 100% opacity
+                cv2.rectangle(screen_resized, (x1, y1), (x2, y2), (0, 255, 0), 1)  # Border with 100% opacity
+
+            # Draw the instructions with a background
+            cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, background_color, line_thickness + 1, cv2.LINE_AA)
+            cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, font_color, line_thickness, cv2.LINE_AA)
+
+            # Add a pulsing effect to the text for better visibility
+            if time.time() % 1 > 0.5:
+                cv2.putText(screen_resized, instructions, (10, 50), font, font_scale, (255, 0, 0), line_thickness, cv2.LINE_AA)
+
+            # Update window and wait
+            cv2.imshow("Select two corners", screen_resized)
+            cv2.setMouseCallback("Select two corners", mouse_callback, mouse_callback_res)
+            cv2.waitKey(15)     # The screenshot is static, so there is no need to redraw faster than the mouse moves
 
         # Once the region is selected, process the coordinates and return the game region
         cv2.destroyAllWindows()
         x1, y1, x2, y2 = selected_game_corners[0][0] * 2, selected_game_corners[0][1] * 2, mouse_callback_res["X"] * 2, mouse_callback_res["Y"] * 2
-        return {"top": min(y1, y2), "left": min(x1, x2), "width": abs(x2 - x1), "height": abs(y2 - y1)}
+        return {"top": self.monitor["top"] + min(y1, y2), "left": self.monitor["left"] + min(x1, x2),
+                "width": abs(x2 - x1), "height": abs(y2 - y1)}
+
+
+    def play(self, pipelined=False):
+        """ Run the agent loop until Q is pressed.
+        The action function may return an image, which is then shown in the "GameFrame" window.
+        With pipelined=True, capture, the action function and display each run on their own thread and are connected
+        by latest-frame-wins queues, so a slow detector skips stale frames instead of falling behind. In that mode the
+        action function must return its image rather than calling cv2.imshow itself. """
+        self.__metrics_last_print = time.perf_counter()
+        if pipelined:
+            self.__play_pipelined()
+        else:
+            self.__play_sequential()
+
+    def __display(self, image, fps, counter, delta_time):
+        fps = fps or 0  # In the first frame, there is no FPS
+        cv2.setWindowTitle("GameFrame", f"FPS: {fps:.2f} - Counter: {counter:.2f} - dT: {delta_time:.2f} - Press Q to quit")
+        cv2.imshow("GameFrame", image)
+        if self.__window_topmost:
+            cv2.setWindowProperty("GameFrame", cv2.WND_PROP_TOPMOST, 1)
 
+    def __poll_quit(self):
+        if self.__headless:
+            return False
+        return cv2.waitKey(1) & 0xFF == ord("q")
 
-    def play(self):
-        sct = mss.mss()
-        counter = 0  # Millisecond counter
+    def __print_metrics(self, force=False):
+        now = time.perf_counter()
+        if force or (self.__metrics_interval and now - self.__metrics_last_print >= self.__metrics_interval):
+            self.__metrics_last_print = now
+            print("\n" + self.metrics.format(), flush=True)
+
+    def __first_frame_done(self):
+        if self.__startup is not None:
+            self.__startup.mark("first frame")
+            print(self.__startup.format(), flush=True)
+
+    def __report(self, frames, start_time, end_time):
+        elapsed = end_time - start_time
+        if frames and elapsed > 0:
+            print(f"Processed {frames} frames in {elapsed:.2f} s ({frames / elapsed:.2f} FPS)")
+        if self.recorder is not None:
+            print(self.recorder.format())
+        if self.__metrics_interval:
+            self.__print_metrics(force=True)
+        if self.__metrics_path:
+            self.metrics.dump(self.__metrics_path)
+
+    def __play_sequential(self):
+        source = self.source
+        metrics = self.metrics
         fps = None
+        index = 0
+        play_start = time.perf_counter()
+        last_capture = None
+
+        source.open()
+        try:
+            while True:
+                loop_start = time.perf_counter_ns()
+                source.wait()
+                grab_start = time.perf_counter_ns()
+                screen = source.grab()
+                if screen is None:  # The source ran out of frames
+                    break
+                grab_end = time.perf_counter_ns()
+                metrics.record("grab", grab_end - grab_start)
 
-        while True:
-            start_time = time.time()
-            screen = np.array(sct.grab(self.__game_region))
-            delta_time = (time.time() - start_time) * 1000
-            counter += delta_time
+                timestamp = grab_end / 1e9
+                counter = (timestamp - play_start) * 1000  # Capture time in ms since play() started
+                delta_time = 0 if last_capture is None else (timestamp - last_capture) * 1000  # ms since the previous capture
+                last_capture = timestamp
+                self.frame = Frame(screen, index, timestamp, (grab_end - grab_start) / 1e6)
+                index += 1
 
-            self.__action_function(self, screen, fps, counter, delta_time)
+                with metrics.stage("action"):
+                    image = self.__action_function(self, screen, fps, counter, delta_time)
+                self.__record(self.frame)
+                if index == 1:
+                    self.__first_frame_done()
+                with metrics.stage("display"):
+                    if image is not None and not self.__headless:
+                        self.__display(image, fps, counter, delta_time)
+                    quit_requested = self.__poll_quit()
 
-            fps = 1 / (time.time() - start_time)
+                loop_end = time.perf_counter_ns()
+                metrics.record("latency", loop_end - grab_end)
+                metrics.record("frame", loop_end - loop_start)
+                fps = 1e9 / (loop_end - loop_start)
+                self.__print_metrics()
 
-            if cv2.waitKey(1) & 0xFF == ord("q"):
+                if quit_requested:
+                    break
+        finally:
+            source.close()
+            play_end = time.perf_counter()
+            if self.recorder is not None:
+                self.recorder.close()   # Waits for the compression of the last chunks, so after the clock stops
+        self.__report(index, play_start, play_end)
+
+    def __play_pipelined(self):
+        source = self.source
+        metrics = self.metrics
+        frames = LatestQueue()      # Capture -> action function
+        outputs = LatestQueue()     # Action function -> display
+        stop = threading.Event()
+        errors = []
+        processed = [0]
+        start_time = time.perf_counter()
+
+        def capture_stage():
+            source.open()   # Opened here because mss handles are per thread on some platforms
+            try:
+                index = 0
+                while not stop.is_set():
+                    source.wait()
+                    grab_start = time.perf_counter_ns()
+                    screen = source.grab()
+                    if screen is None:  # The source ran out of frames
+                        break
+                    grab_end = time.perf_counter_ns()
+                    metrics.record("grab", grab_end - grab_start)
+                    frames.put(Frame(screen, index, grab_end / 1e9, (grab_end - grab_start) / 1e6))
+                    index += 1
+            finally:
+                source.close()
+                frames.close()
+
+        def action_stage():
+            fps = None
+            last_time = None
+            last_capture = None
+            while not stop.is_set():
+                frame = frames.get(timeout=0.1)
+                if frame is None:
+                    if frames.closed:
+                        break
+                    continue
+                self.frame = frame
+                counter = (frame.timestamp - start_time) * 1000    # Capture time in ms since play() started
+                delta_time = 0 if last_capture is None else (frame.timestamp - last_capture) * 1000  # ms since the previous frame we handled
+                last_capture = frame.timestamp
+                with metrics.stage("action"):
+                    image = self.__action_function(self, frame.image, fps, counter, delta_time)
+                self.__record(frame)
+                processed[0] += 1
+                if processed[0] == 1:
+                    self.__first_frame_done()
+
+                now = time.perf_counter_ns()
+                if last_time is not None:
+                    metrics.record("frame", now - last_time)
+                    fps = 1e9 / (now - last_time)
+                last_time = now
+                if image is not None and not self.__headless:
+                    outputs.put((image, fps, counter, delta_time, frame.timestamp))
+                else:
+                    metrics.record("latency", now - int(frame.timestamp * 1e9))
+                self.__print_metrics()
+            outputs.close()
+
+        def run_stage(stage):
+            try:
+                stage()
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+                frames.close()
+                outputs.close()
+
+        threads = [threading.Thread(target=run_stage, args=(stage,), daemon=True) for stage in (capture_stage, action_stage)]
+        for thread in threads:
+            thread.start()
+
+        # Display has to stay on the main thread for the OpenCV GUI backends
+        while not stop.is_set() and threads[1].is_alive():
+            output = outputs.get(timeout=0.005)
+            with metrics.stage("display"):
+                if output is not None:
+                    image, fps, counter, delta_time, timestamp = output
+                    self.__display(image, fps, counter, delta_time)
+                quit_requested = self.__poll_quit()
+            if output is not None:
+                metrics.record("latency", time.perf_counter_ns() - int(timestamp * 1e9))
+            if quit_requested:
                 break
 
+        stop.set()
+        frames.close()
+        outputs.close()
+        for thread in threads:
+            thread.join()
+        end_time = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder.close()
+        if errors:
+            raise errors[0]
+        self.__report(processed[0], start_time, end_time)
+        if frames.dropped:
+            print(f"Dropped {frames.dropped} stale frames")
+
 
 if __name__ == "__main__":
-    def custom_take_action(screen, prev_FPS, counter, delta_time):
-        frame = cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
-        prev_FPS = prev_FPS or 0    # in the first frame, there is no FPS
+    def custom_take_action(self, screen, prev_FPS, counter, delta_time):
+        return cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
 
-        cv2.setWindowTitle("GameFrame", f"FPS: {prev_FPS:.2f} - Counter: {counter:.2f} - dT: {delta_time:.2f} - Press Q to quit")
-        cv2.imshow("GameFrame", frame)
+    parser = argparse.ArgumentParser(description="Show the captured game region.")
+    add_source_arguments(parser)
+    add_metrics_arguments(parser)
+    add_recorder_arguments(parser)
+    parser.add_argument("--pipelined", action="store_true", help="Run capture and display on separate threads")
+    args = parser.parse_args()
 
-    game = GameWrapper(custom_take_action, monitor_index=0)
-    game.play()
+    game = GameWrapper(custom_take_action, source=source_from_args(args), headless=args.headless,
+                       metrics_interval=args.metrics_every, metrics_path=args.metrics_out, recorder=recorder_from_args(args))
+    game.play(pipelined=args.pipelined)
@@ -0,0 +1,85 @@
+import time
+import cv2
+import numpy as np
+
+
+class FrameGate:
+    """ Cheap check whether a frame differs enough from the last one that was passed through to be worth detecting on.
+    Frames are reduced to a small grayscale thumbnail and compared pixel by pixel with the thumbnail of the last
+    passed frame, not simply the previous one, so slow changes still add up to a pass eventually. A frame passes when
+    more than `min_changed` of the thumbnail pixels changed by more than `pixel_threshold` grey levels, which catches
+    a single small fruit entering the screen while ignoring compression noise. The thumbnail is a bilinear sample
+    rather than an area average: it is 200x cheaper on a full frame and fruit still cover dozens of its pixels.
+    Even an unchanged screen passes every `max_idle_ms`, so detection keeps running at a low rate in menus and
+    between waves. """
+    def __init__(self, size=(128, 72), pixel_threshold=12, min_changed=0.001, max_idle_ms=500.0):
+        self.size = size                        # Thumbnail (width, height)
+        self.pixel_threshold = pixel_threshold
+        self.min_changed = min_changed          # Share of thumbnail pixels that must change
+        self.max_idle_ms = max_idle_ms
+
+        self.frames = 0
+        self.skipped = 0
+        self.__reference = None
+        self.__reference_time = None
+        self.__gray = np.zeros((size[1], size[0]), dtype=np.uint8)
+        self.__diff = np.zeros_like(self.__gray)
+
+    def thumbnail(self, screen):
+        """ Grayscale thumbnail of a BGRA or BGR frame, written into a reused buffer. """
+        small = cv2.resize(screen, self.size, interpolation=cv2.INTER_LINEAR)
+        code = cv2.COLOR_BGRA2GRAY if small.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        return cv2.cvtColor(small, code, dst=self.__gray)
+
+    def changed(self, screen, timestamp):
+        """ Whether the frame captured at `timestamp` (ms) should be processed. Passing frames become the new reference. """
+        self.frames += 1
+        gray = self.thumbnail(screen)
+        if self.__reference is not None and timestamp - self.__reference_time < self.max_idle_ms:
+            cv2.absdiff(gray, self.__reference, dst=self.__diff)
+            if np.count_nonzero(self.__diff > self.pixel_threshold) <= self.min_changed * self.__diff.size:
+                self.skipped += 1
+                return False
+        if self.__reference is None:
+            self.__reference = np.empty_like(gray)
+        np.copyto(self.__reference, gray)
+        self.__reference_time = timestamp
+        return True
+
+    def reset(self):
+        """ Force the next frame through. """
+        self.__reference = None
+
+    @property
+    def skip_ratio(self):
+        return self.skipped / self.frames if self.frames else 0.0
+
+    def format(self):
+        return f"Frame gate: skipped {self.skip_ratio * 100:.1f}% of {self.frames} frames"
+
+
+def add_gate_arguments(parser):
+    parser.add_argument("--gate", action="store_true", help="Skip detection on frames that barely changed since the last detection")
+    parser.add_argument("--gate-threshold", type=float, default=0.001,
+                        help="Share of thumbnail pixels that must change for a frame to be detected on")
+
+
+def gate_from_args(args):
+    return FrameGate(min_changed=args.gate_threshold) if args.gate else None
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: cost of the gate on a 1280x720 BGRA frame, idle and with a moving object
+    rng = np.random.default_rng(0)
+    screen = rng.integers(0, 256, size=(720, 1280, 4), dtype=np.uint8)
+    gate = FrameGate()
+    timings = []
+    for i in range(500):
+        if i >= 250:     # A 60 px object moving across the frame
+            screen[300:360, (i * 4) % 1200:(i * 4) % 1200 + 60] = 255
+        start = time.perf_counter_ns()
+        gate.changed(screen, i * 16.7)
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+    timings = np.array(timings)
+    print(f"{np.median(timings):.3f} ms median, {np.percentile(timings, 99):.3f} ms p99")
+    print(gate.format())
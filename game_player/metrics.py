@@ -0,0 +1,102 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+
+class StageMetrics:
+    """ Rolling latency histograms for the stages of the agent loop (grab, inference, display, ...).
+    Each stage keeps the last `window` samples in a ring buffer of nanoseconds; percentiles are computed on demand. """
+    def __init__(self, window=1000):
+        self.window = window
+        self.__samples = {}     # Stage name -> int64 ring buffer
+        self.__counts = {}      # Stage name -> total number of samples ever recorded
+        self.__totals = {}      # Stage name -> sum of all samples ever recorded, in ns
+        self.__ratios = {}      # Ratio name -> [hits, total], e.g. the share of frames that skipped inference
+        self.__lock = threading.Lock()
+
+    def record(self, stage, duration_ns):
+        with self.__lock:
+            if stage not in self.__samples:
+                self.__samples[stage] = np.zeros(self.window, dtype=np.int64)
+                self.__counts[stage] = 0
+                self.__totals[stage] = 0
+            count = self.__counts[stage]
+            self.__samples[stage][count % self.window] = duration_ns
+            self.__counts[stage] = count + 1
+            self.__totals[stage] += duration_ns
+
+    def record_ratio(self, name, hit):
+        """ Count one event under `name`, as a hit or not. The summary reports the share of hits. """
+        with self.__lock:
+            counts = self.__ratios.setdefault(name, [0, 0])
+            counts[0] += bool(hit)
+            counts[1] += 1
+
+    def ratios(self):
+        """ Per ratio: number of events and share of hits. """
+        with self.__lock:
+            return {name: {"count": total, "ratio": hits / total} for name, (hits, total) in self.__ratios.items()}
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the body of a with-block and record it under `name`. """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter_ns() - start)
+
+    def summary(self):
+        """ Per stage: sample count, mean over the whole run and p50/p95/p99/max over the rolling window, in ms. """
+        with self.__lock:
+            stages = {name: (samples[:min(self.__counts[name], self.window)].copy(), self.__counts[name], self.__totals[name])
+                      for name, samples in self.__samples.items()}
+
+        summary = {}
+        for name, (samples, count, total) in stages.items():
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) / 1e6
+            summary[name] = {
+                "count": count,
+                "mean_ms": total / count / 1e6,
+                "p50_ms": p50,
+                "p95_ms": p95,
+                "p99_ms": p99,
+                "max_ms": samples.max() / 1e6,
+            }
+        return summary
+
+    def format(self):
+        lines = [f"{'stage':<12} {'count':>8} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)"]
+        for name, s in self.summary().items():
+            lines.append(f"{name:<12} {s['count']:>8} {s['mean_ms']:>8.2f} {s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f} {s['max_ms']:>8.2f}")
+        for name, r in self.ratios().items():
+            lines.append(f"{name:<12} {r['count']:>8} {r['ratio'] * 100:>7.1f}%")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """ Write the summary to a .json or .csv file, depending on the extension. """
+        summary, ratios = self.summary(), self.ratios()
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(["stage", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+                for name, s in summary.items():
+                    writer.writerow([name, s["count"], s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"]])
+                if ratios:
+                    writer.writerow([])
+                    writer.writerow(["ratio", "count", "share"])
+                    for name, r in ratios.items():
+                        writer.writerow([name, r["count"], r["ratio"]])
+        else:
+            if ratios:
+                summary["ratios"] = ratios
+            with open(path, "w") as file:
+                json.dump(summary, file, indent=4)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics-every", type=float, default=0, help="Print stage latencies every N seconds (0 to disable)")
+    parser.add_argument("--metrics-out", help="Write stage latencies to this .json or .csv file on exit")
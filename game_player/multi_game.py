@@ -0,0 +1,177 @@
+from startup import StartupProfile, add_startup_arguments    # First, so the startup profile covers the other imports
+import threading
+import time
+import argparse
+import cv2
+import mss
+import numpy as np
+from frame_source import ScreenSource
+from metrics import StageMetrics, add_metrics_arguments
+from detector import add_detector_arguments, detector_from_args
+from gating import add_gate_arguments, gate_from_args
+from calibration import locate_game_regions
+from actuator import add_actuator_arguments, executor_from_args
+from track_agent import TrackAgent
+
+
+class MultiGameWrapper:
+    """ Plays several games side by side from one process with one model.
+    Every iteration grabs all game regions, runs the detector on all of them as one batch and hands each game's
+    detections to its own agent, which keeps its own tracks and actuator. Agents need a
+    step(screen, detections, time_ms, capture_time, metrics) method returning an image, like TrackAgent. Games whose
+    FrameGate sees no change are left out of the batch and get None instead of detections. """
+    def __init__(self, detector, agents, sources, gates=None, headless=False, metrics_interval=0, metrics_path=None, startup=None):
+        self.detector = detector
+        self.agents = agents
+        self.sources = sources
+        self.gates = gates or [None] * len(sources)
+        self.headless = headless
+        self.metrics = StageMetrics()
+        self.__metrics_interval = metrics_interval
+        self.__metrics_path = metrics_path
+        self.__startup = startup
+
+    def play(self):
+        """ Run until Q is pressed in any game window or a source runs out of frames. """
+        metrics = self.metrics
+        for source in self.sources:
+            source.open()
+        play_start = time.perf_counter()
+        last_print = play_start
+        index = 0
+        try:
+            while True:
+                loop_start = time.perf_counter_ns()
+                screens, capture_times = [], []
+                for source in self.sources:
+                    source.wait()
+                    with metrics.stage("grab"):
+                        screens.append(source.grab())
+                    capture_times.append(time.perf_counter())
+                if any(screen is None for screen in screens):
+                    break
+                counters = [(capture_time - play_start) * 1000 for capture_time in capture_times]
+
+                # Only games whose screen changed go into the batch
+                batch = []
+                for i, (gate, screen) in enumerate(zip(self.gates, screens)):
+                    if gate is None:
+                        batch.append(i)
+                        continue
+                    with metrics.stage("gate"):
+                        changed = gate.changed(screen, counters[i])
+                    metrics.record_ratio("gate_skip", not changed)
+                    if changed:
+                        batch.append(i)
+
+                detections = [None] * len(screens)
+                if batch:
+                    with metrics.stage("inference"):
+                        results = self.detector.detect_batch([screens[i] for i in batch], slots=batch)
+                    for i, result in zip(batch, results):
+                        detections[i] = result
+                metrics.record_ratio("batch_fill", len(batch) == len(screens))
+
+                quit_requested = False
+                for i, agent in enumerate(self.agents):
+                    with metrics.stage("agent"):
+                        image = agent.step(screens[i], detections[i], counters[i], capture_times[i], metrics)
+                    if image is not None and not self.headless:
+                        cv2.imshow(f"Game {i}", image)
+                if not self.headless:
+                    quit_requested = cv2.waitKey(1) & 0xFF == ord("q")
+
+                now = time.perf_counter_ns()
+                metrics.record("frame", now - loop_start)
+                metrics.record("latency", now - int(capture_times[0] * 1e9))
+                index += 1
+                if index == 1 and self.__startup is not None:
+                    self.__startup.mark("first frame")
+                    print(self.__startup.format(), flush=True)
+                if self.__metrics_interval and time.perf_counter() - last_print >= self.__metrics_interval:
+                    last_print = time.perf_counter()
+                    print("\n" + metrics.format(), flush=True)
+                if quit_requested:
+                    break
+        finally:
+            for source in self.sources:
+                source.close()
+            if not self.headless:
+                cv2.destroyAllWindows()
+
+        elapsed = time.perf_counter() - play_start
+        if index and elapsed > 0:
+            print(f"Processed {index} iterations of {len(self.sources)} games in {elapsed:.2f} s "
+                  f"({index / elapsed:.2f} per second, {index * len(self.sources) / elapsed:.2f} game frames per second)")
+        if self.__metrics_interval:
+            print("\n" + metrics.format(), flush=True)
+        if self.__metrics_path:
+            metrics.dump(self.__metrics_path)
+
+
+def parse_region(text):
+    left, top, width, height = (int(value) for value in text.split(","))
+    return {"top": top, "left": left, "width": width, "height": height}
+
+
+def region_to_screen(region):
+    """ Game to screen coordinate conversion for one region, like GameWrapper.game_to_screen_coords. """
+    return lambda gx, gy: (region["left"] + gx, region["top"] + gy)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track and play several game windows with one model.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--games", type=int, help="Number of game windows to find on the monitor")
+    group.add_argument("--region", type=parse_region, action="append", help="Game region as left,top,width,height (repeat per game)")
+    parser.add_argument("--monitor", type=int, default=0, help="Monitor the games are on")
+    parser.add_argument("--recalibrate", action="store_true", help="Search for the game regions even if cached ones still match")
+    parser.add_argument("--headless", action="store_true", help="Do not open any windows")
+    parser.add_argument("--swipe-speed", type=float, default=4000, help="Swipe speed in pixels per second")
+    add_metrics_arguments(parser)
+    add_detector_arguments(parser)
+    add_gate_arguments(parser)
+    add_actuator_arguments(parser)
+    add_startup_arguments(parser)
+    args = parser.parse_args()
+
+    startup = StartupProfile()
+    detector_future = startup.in_background("model load", detector_from_args, args)
+
+    with startup.phase("game regions"):
+        regions = args.region
+        if regions is None:
+            with mss.mss() as sct:
+                monitor = sct.monitors[args.monitor]
+                screen = np.array(sct.grab(monitor))
+            regions = locate_game_regions(monitor, screen, args.games, recalibrate=args.recalibrate)
+            if regions is None:
+                raise SystemExit(f"Could not find {args.games} games on monitor {args.monitor}. Give them with --region instead.")
+        for i, region in enumerate(regions):
+            print(f"Game {i}: {region}")
+    with startup.phase("wait for model"):
+        detector = detector_future.result()
+
+    mouse = threading.Lock()    # There is only one mouse, so swipes of different games take turns
+    # The executors run threads and the sources hold screen grabbers, so close them however the session ends
+    agents, sources = [], []
+    try:
+        for region in regions:
+            agents.append(TrackAgent(detector.names, executor=executor_from_args(args, region_to_screen(region), lock=mouse),
+                                     swipe_speed=args.swipe_speed))
+        with startup.phase("warm-up"):
+            blanks = [np.zeros((region["height"], region["width"], 4), dtype=np.uint8) for region in regions]
+            for _ in range(args.warmup):
+                detector.detect_batch(blanks)
+
+        sources = [ScreenSource(args.monitor, region=region) for region in regions]
+        game = MultiGameWrapper(detector, agents, sources,
+                                gates=[gate_from_args(args) for _ in regions], headless=args.headless,
+                                metrics_interval=args.metrics_every, metrics_path=args.metrics_out,
+                                startup=startup if args.startup_profile else None)
+        game.play()
+    finally:
+        for source in sources:
+            source.close()  # play() closes them as well, closing twice does nothing
+        for agent in agents:
+            agent.close()
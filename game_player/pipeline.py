@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import namedtuple
+
+
+# A captured game frame. `timestamp` is the time.perf_counter() value at the moment the grab finished,
+# so agents can work out how old a frame is by the time they act on it.
+Frame = namedtuple("Frame", ["image", "index", "timestamp", "grab_time"])
+
+
+class LatestQueue:
+    """ Bounded queue of size one where a new item replaces the one waiting to be consumed.
+    A slow consumer therefore always gets the most recent item and never builds a backlog. """
+    def __init__(self):
+        self.__item = None
+        self.__has_item = False
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.dropped = 0    # Number of items that were replaced before anyone consumed them
+
+    def put(self, item):
+        with self.__cond:
+            if self.__has_item:
+                self.dropped += 1
+            self.__item = item
+            self.__has_item = True
+            self.__cond.notify()
+
+    def get(self, timeout=None):
+        """ Wait for the next item. Returns None on timeout or once the queue has been closed. """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.__cond:
+            while not self.__has_item and not self.__closed:
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.__cond.wait(remaining)
+            if not self.__has_item:
+                return None
+            item = self.__item
+            self.__item = None
+            self.__has_item = False
+            return item
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import get_classnames
+
+
+# A planned swipe: polyline `points` (K, 2) in game coordinates, indices of the fruit it cuts and its score
+Plan = namedtuple("Plan", ["points", "hits", "score"])
+
+WHOLE_CLASSES = np.array([i for i, name in enumerate(get_classnames()) if name.endswith("Whole")])
+BOMB_CLASS = get_classnames().index("bomb")
+
+
+def segments_hit_boxes(starts, ends, boxes):
+    """ Which of S segments intersect which of B xyxy boxes, as an (S, B) bool matrix (slab test). """
+    direction = ends - starts
+    direction = np.where(np.abs(direction) < 1e-9, 1e-9, direction)    # Avoid 0/0 for axis-aligned segments
+    inverse = 1 / direction
+    sx, sy = starts[:, 0:1], starts[:, 1:2]
+    ix, iy = inverse[:, 0:1], inverse[:, 1:2]
+    tx1, tx2 = (boxes[:, 0] - sx) * ix, (boxes[:, 2] - sx) * ix
+    ty1, ty2 = (boxes[:, 1] - sy) * iy, (boxes[:, 3] - sy) * iy
+    t_enter = np.maximum(np.minimum(tx1, tx2), np.minimum(ty1, ty2))
+    t_exit = np.minimum(np.maximum(tx1, tx2), np.maximum(ty1, ty2))
+    return (t_enter <= t_exit) & (t_exit >= 0) & (t_enter <= 1)
+
+
+class SwipePlanner:
+    """ Picks the swipe that cuts the most whole fruit without touching a bomb, within a time budget.
+    Candidates are tried cheapest first (a short vertical cut through each fruit, then straight lines through every
+    pair of fruit, then polylines grown from the best pairs), so a plan is available even if the budget runs out.
+    All candidates of a tier are tested against every fruit and bomb box at once, in calls of about `chunk_tests`
+    segment-box tests, and the best candidate keeps the fruit it was found to cut, so there is no pass over the result.
+    Before each call the planner checks that the slowest recent step (a call and the bookkeeping around it) still
+    fits, so plan() returns within `budget_ms` (None: no limit) unless the process is descheduled in the middle of it.
+    `cut_off` tells whether the last plan() stopped searching early, `cut_offs` counts them. """
+    SAFETY = 1.25       # Steps jitter this much above the slowest recent one
+
+    def __init__(self, budget_ms=2.0, margin=30.0, bomb_margin=25.0, max_points=5, chain_seeds=8, chunk_tests=4096):
+        self.budget_ms = budget_ms          # Time limit for plan()
+        self.margin = margin                # How far a swipe extends past the first and last fruit it cuts
+        self.bomb_margin = bomb_margin      # Safety padding around bombs
+        self.max_points = max_points        # Maximum fruit a polyline is routed through
+        self.chain_seeds = chain_seeds      # Number of best pair swipes that are extended into polylines
+        self.chunk_tests = chunk_tests      # Segment-box tests per scoring call
+        self.cut_off = False
+        self.cut_offs = 0
+        # Slowest recent search step in seconds, decaying so that one hiccup does not stick
+        self.__step_s = 1e-4
+        self.__last_check = None
+
+    def plan(self, boxes, classes, bounds=None):
+        """ Best Plan for objects at predicted `boxes` (N, 4) with `classes` (N,), or None if nothing can be cut safely.
+        `bounds` (width, height) clips the swipe to the game region. """
+        start_time = time.perf_counter()
+        budget_s = np.inf if self.budget_ms is None else self.budget_ms / 1000
+        self.__step_s *= 0.9    # Let the estimate recover from a slow plan even if it leaves no time to measure steps
+        self.__deadline = start_time + budget_s
+        self.__last_check = None
+        self.cut_off = False
+        boxes = np.asarray(boxes, dtype=np.float64)
+        classes = np.asarray(classes)
+        fruit_index = np.flatnonzero(np.isin(classes, WHOLE_CLASSES))
+        if len(fruit_index) == 0:
+            return None
+        self.__fruit = boxes[fruit_index]
+        self.__bombs = boxes[classes == BOMB_CLASS] + np.array([-1, -1, 1, 1]) * self.bomb_margin
+        self.__bounds = bounds
+        centres = (self.__fruit[:, :2] + self.__fruit[:, 2:]) / 2
+        route, hits, score = self.__search(centres)
+        self.__end_step(time.perf_counter())
+        if route is None:
+            return None
+        return Plan(self.__clip(route), fruit_index[hits], float(score))
+
+    def __search(self, centres):
+        """ The best route (K, 2), the fruit it cuts and its score over the three tiers, as far as the budget allows. """
+        fruit_count = len(centres)
+        tests_per_segment = fruit_count + len(self.__bombs)
+        best = None, None, 0.0
+
+        # Tier 1: short vertical cut through each fruit
+        half_height = (self.__fruit[:, 3] - self.__fruit[:, 1]) / 2 + self.margin
+        offsets = np.stack([np.zeros_like(half_height), half_height], axis=1)
+        starts, ends = centres - offsets, centres + offsets
+        if not self.__fits():
+            return best
+        score, hits = self.__score(starts, ends)
+        k = int(np.argmax(score))
+        if score[k] > best[2]:
+            best = np.stack([starts[k], ends[k]]), hits[k], score[k]
+
+        # Tier 2: a straight line through every pair of fruit, extended past both ends
+        i, j = np.triu_indices(fruit_count, k=1)
+        pair_scores = np.full(len(i), -np.inf)
+        pair_hits = np.zeros((len(i), fruit_count), dtype=bool)
+        chunk = max(1, self.chunk_tests // tests_per_segment)
+        for first in range(0, len(i), chunk):
+            if not self.__fits():
+                return best
+            ci, cj = i[first:first + chunk], j[first:first + chunk]
+            starts, ends = self.__extend(centres[ci], centres[cj])
+            score, hits = self.__score(starts, ends)
+            pair_scores[first:first + chunk], pair_hits[first:first + chunk] = score, hits
+            k = int(np.argmax(score))
+            if score[k] > best[2]:
+                best = np.stack([starts[k], ends[k]]), hits[k], score[k]
+
+        # Tier 3: grow polylines from the best pairs, all of them together, one safe segment at a time
+        seeds = np.argsort(-pair_scores)[:self.chain_seeds]
+        seeds = seeds[np.isfinite(pair_scores[seeds])]
+        group = max(1, self.chunk_tests // (fruit_count * tests_per_segment))
+        for first in range(0, len(seeds), group):
+            routes, lengths, scores, hits, complete = self.__grow(seeds[first:first + group], i, j, centres,
+                                                                  pair_scores, pair_hits)
+            k = int(np.argmax(scores))
+            if scores[k] > best[2]:
+                best = routes[k, :lengths[k]], hits[k], scores[k]
+            if not complete:
+                break
+        return best
+
+    def __fits(self):
+        """ Whether another scoring call still fits in the budget; marks the plan as cut off if not. """
+        now = time.perf_counter()
+        self.__end_step(now)
+        if now + self.__step_s * self.SAFETY <= self.__deadline:
+            self.__last_check = now
+            return True
+        if not self.cut_off:
+            self.cut_off = True
+            self.cut_offs += 1
+        return False
+
+    def __end_step(self, now):
+        if self.__last_check is not None:
+            self.__step_s = max(now - self.__last_check, self.__step_s * 0.99)
+            self.__last_check = None
+
+    def __clip(self, points):
+        return points if self.__bounds is None else np.clip(points, 0, self.__bounds)
+
+    def __extend(self, starts, ends):
+        """ Lengthen segments by the margin on both ends so the swipe cuts all the way through the fruit. """
+        direction = ends - starts
+        direction /= np.maximum(np.linalg.norm(direction, axis=-1, keepdims=True), 1e-9)
+        return starts - direction * self.margin, ends + direction * self.margin
+
+    def __score(self, starts, ends, base_hits=None, base_length=0.0):
+        """ Score candidates that each add one segment to a route (empty by default) that already cuts `base_hits`.
+        Returns the scores (-inf where a bomb is touched) and the (C, F) fruit each candidate cuts. """
+        starts, ends = self.__clip(starts), self.__clip(ends)
+        hits = segments_hit_boxes(starts, ends, self.__fruit)
+        if base_hits is not None:
+            hits |= base_hits
+        if len(self.__bombs):
+            safe = ~segments_hit_boxes(starts, ends, self.__bombs).any(axis=1)
+        else:
+            safe = np.ones(len(starts), dtype=bool)
+        lengths = base_length + np.linalg.norm(ends - starts, axis=1)
+        # Cut as many fruit as possible, prefer shorter swipes among equals
+        score = np.where(safe, hits.sum(axis=1) - lengths * 1e-6, -np.inf)
+        return score, hits
+
+    def __grow(self, seeds, i, j, centres, pair_scores, pair_hits):
+        """ Extend the pair swipes of `seeds` through more fruit for as long as that stays safe and gains fruit, every
+        step for all routes at once. Returns their routes (G, max_points + 1, 2) with the number of points in each, their
+        scores, the fruit they cut and whether growing ran to the end in the budget. """
+        fruit_count = len(centres)
+        rows = np.arange(len(seeds))
+        routes = np.zeros((len(seeds), self.max_points + 1, 2))
+        routes[:, 0], routes[:, 1] = self.__extend(centres[i[seeds]], centres[j[seeds]])
+        lengths = np.full(len(seeds), 2)
+        scores, hits = pair_scores[seeds].copy(), pair_hits[seeds].copy()
+        distances = np.linalg.norm(routes[:, 1] - routes[:, 0], axis=1)
+        growing = np.ones(len(seeds), dtype=bool)
+        for _ in range(self.max_points - 1):
+            growing &= ~hits.all(axis=1)
+            active = np.flatnonzero(growing)
+            if len(active) == 0:
+                break
+            if not self.__fits():
+                return routes, lengths, scores, hits, False
+            # Every active route continued through every fruit
+            step_starts = np.repeat(routes[active, lengths[active] - 1], fruit_count, axis=0)
+            _, step_ends = self.__extend(step_starts, np.tile(centres, (len(active), 1)))
+            new_scores, new_hits = self.__score(step_starts, step_ends, np.repeat(hits[active], fruit_count, axis=0),
+                                                np.repeat(distances[active], fruit_count))
+            new_scores = new_scores.reshape(len(active), fruit_count)
+            new_scores[hits[active]] = -np.inf     # Only fruit the route does not cut yet
+            k = np.argmax(new_scores, axis=1)
+            best = new_scores[rows[:len(active)], k]
+            better = best > scores[active]
+            growing[active[~better]] = False
+            grown, candidates = active[better], rows[:len(active)][better] * fruit_count + k[better]
+            routes[grown, lengths[grown]] = step_ends[candidates]
+            lengths[grown] += 1
+            scores[grown], hits[grown] = best[better], new_hits[candidates]
+            distances[grown] += np.linalg.norm(step_ends[candidates] - step_starts[candidates], axis=1)
+        return routes, lengths, scores, hits, True
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: planning time as the number of objects on screen grows, within the budget and without one.
+    # "over" counts plans that took longer than the budget, "cpu over" those that also used more CPU time than that,
+    # as opposed to plans that only overran because the process was descheduled.
+    rng = np.random.default_rng(0)
+    planner, unlimited = SwipePlanner(budget_ms=2.0), SwipePlanner(budget_ms=None)
+    whole = WHOLE_CLASSES
+    print(f"budget {planner.budget_ms} ms, 200 plans per row")
+    print(f"{'objects':>8} {'median ms':>10} {'p99 ms':>8} {'max ms':>8} {'over':>5} {'cpu over':>9} {'cut off':>8} {'fruit cut':>10}"
+          f" {'unlimited ms':>13} {'fruit cut':>10}")
+    for num_objects in (5, 10, 20, 30, 45, 60):
+        timings, cuts, full_timings, full_cuts, cpu_timings = [], [], [], [], []
+        cut_offs = planner.cut_offs
+        for _ in range(200):
+            centres = rng.uniform([50, 50], [1230, 670], size=(num_objects, 2))
+            sizes = rng.uniform(40, 110, size=(num_objects, 1))
+            boxes = np.concatenate([centres - sizes / 2, centres + sizes / 2], axis=1)
+            classes = np.where(rng.random(num_objects) < 0.15, BOMB_CLASS, rng.choice(whole, num_objects))
+            for timed, counted, run in ((timings, cuts, planner), (full_timings, full_cuts, unlimited)):
+                start, cpu_start = time.perf_counter_ns(), time.process_time_ns()
+                plan = run.plan(boxes, classes, bounds=(1280, 720))
+                timed.append((time.perf_counter_ns() - start) / 1e6)
+                counted.append(len(plan.hits) if plan else 0)
+                if run is planner:
+                    cpu_timings.append((time.process_time_ns() - cpu_start) / 1e6)
+        timings = np.array(timings)
+        over = int((timings > planner.budget_ms).sum())
+        cpu_over = int((np.array(cpu_timings) > planner.budget_ms).sum())
+        print(f"{num_objects:>8} {np.median(timings):>10.3f} {np.percentile(timings, 99):>8.3f} {timings.max():>8.3f}"
+              f" {over:>5} {cpu_over:>9} {planner.cut_offs - cut_offs:>8} {np.mean(cuts):>10.2f}"
+              f" {np.median(full_timings):>13.3f} {np.mean(full_cuts):>10.2f}")
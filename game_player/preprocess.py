@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+
+
+class FramePreprocessor:
+    """ Turns captured BGRA frames into BGR display frames and letterboxed model inputs without per-frame allocations.
+    Buffers are allocated once for a given frame size and reused. They rotate between `num_buffers` copies so a frame
+    handed to another stage (e.g. the display queue in pipelined mode) is not overwritten while it is still in use. """
+    def __init__(self, model_size=640, num_buffers=3, pad_color=114):
+        self.model_size = model_size
+        self.num_buffers = num_buffers
+        self.pad_color = pad_color
+
+        self.__shape = None
+        self.__bgr = []
+        self.__inputs = []
+        self.__resized = None
+        self.__bgr_index = 0
+        self.__input_index = 0
+        self.scale = 1.0    # Model input pixels per frame pixel
+        self.pad = (0, 0)   # (left, top) padding of the letterboxed image in model input pixels
+        self.__new_size = (model_size, model_size)
+
+    def __allocate(self, shape):
+        height, width = shape[:2]
+        size = self.model_size
+        self.scale = min(size / width, size / height)
+        new_w, new_h = int(round(width * self.scale)), int(round(height * self.scale))
+        self.pad = ((size - new_w) // 2, (size - new_h) // 2)
+        self.__new_size = (new_w, new_h)
+
+        self.__bgr = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(self.num_buffers)]
+        self.__inputs = [np.full((size, size, 3), self.pad_color, dtype=np.uint8) for _ in range(self.num_buffers)]
+        self.__resized = np.empty((new_h, new_w, 4), dtype=np.uint8)
+        self.__shape = shape
+
+    def __check_shape(self, screen):
+        if screen.shape != self.__shape:
+            self.__allocate(screen.shape)
+
+    def to_bgr(self, screen):
+        """ Drop the alpha channel into a reused full-resolution BGR buffer. """
+        self.__check_shape(screen)
+        self.__bgr_index = (self.__bgr_index + 1) % self.num_buffers
+        return cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR, dst=self.__bgr[self.__bgr_index])
+
+    def to_model_input(self, screen):
+        """ Resize and drop the alpha channel in one pass over the full frame, straight into a letterboxed model input.
+        Only the small resized image is touched twice; the padding is written once when the buffer is allocated. """
+        self.__check_shape(screen)
+        self.__input_index = (self.__input_index + 1) % self.num_buffers
+        model_input = self.__inputs[self.__input_index]
+        left, top = self.pad
+        new_w, new_h = self.__new_size
+        cv2.resize(screen, self.__new_size, dst=self.__resized, interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(self.__resized, cv2.COLOR_BGRA2BGR, dst=model_input[top:top + new_h, left:left + new_w])
+        return model_input
+
+    def to_frame_coords(self, boxes_xyxy):
+        """ Map (N, 4) xyxy boxes from model input pixels back to frame pixels. """
+        boxes = np.asarray(boxes_xyxy, dtype=np.float32).copy()
+        left, top = self.pad
+        boxes[:, [0, 2]] = (boxes[:, [0, 2]] - left) / self.scale
+        boxes[:, [1, 3]] = (boxes[:, [1, 3]] - top) / self.scale
+        return boxes
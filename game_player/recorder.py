@@ -0,0 +1,339 @@
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from frame_source import ReplaySource
+
+
+# A session directory holds:
+#   session.json        frame shape, chunk size and codec, rewritten with the totals when recording ends
+#   frames.jsonl        one line per recorded frame: index, timestamp, grab_ms, chunk, slot and the frame's annotations
+#   chunk_NNNNN.raw     `chunk_frames` frames back to back, memory-mapped while it is written
+#   chunk_NNNNN.z       the same chunk compressed frame by frame with the session's codec, replacing .raw once
+#                       compression has finished... (zlib, lossless, or JPEG, lossy but several times faster to compress)
+#   chunk_NNNNN.jpg     ...or as JPEG, for chunks of a zlib session that were downgraded because compression fell behind
+#   chunk_NNNNN.offsets.npy ...with the byte offset of every frame in it (int64, one more than the number of frames)
+
+
+def _to_json(value):
+    """ Arrays, namedtuples (Detections, Tracks, Swipe) and numpy scalars as plain JSON values. """
+    if hasattr(value, "_asdict"):
+        return {key: _to_json(item) for key, item in value._asdict().items()}
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def encode_frame(image, codec):
+    """ Both codecs release the GIL while they work, so compression threads do not stall the agent. """
+    if codec == "jpeg":
+        return cv2.imencode(".jpg", image[..., :3], [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+    return zlib.compress(image, 1)
+
+
+def decode_frame(data, codec, shape):
+    if codec == "jpeg":
+        return cv2.cvtColor(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2BGRA)
+    return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+
+
+class SessionRecorder:
+    """ Records what an agent saw and did, with as little work as possible on the agent's thread.
+    record() copies the frame into a free buffer of a small pool and queues it; a writer thread puts it into the
+    current memory-mapped chunk and appends its annotations (detections, tracks, swipes, ...) to the index. Full
+    chunks are compressed on other threads. If the writer falls behind and the pool runs dry, frames are dropped
+    (and counted) rather than slowing the agent down. At most `max_backlog` finished chunks wait for compression:
+    once half of them are waiting, new chunks of a zlib session are compressed as JPEG instead (counted in
+    `downgraded`), and while all of them are waiting, frames that would start a new chunk are dropped. So a codec
+    that cannot keep up costs quality or frames, never unbounded disk and memory or a long close().
+    `codec` is "zlib", "jpeg" or None to keep the raw chunks. With copy_frames=False, record() queues the frame
+    itself instead of a copy, which takes the copy off the agent's thread; only for sources that return a new array
+    from every grab() (all FrameSources do) and agents that do not draw on it. `buffers` then only limits how many
+    frames can be queued. """
+    def __init__(self, path, chunk_frames=64, codec="zlib", buffers=16, compress_threads=2, max_backlog=4, copy_frames=True):
+        if codec not in ("zlib", "jpeg", None):
+            raise ValueError(f"Unknown codec: {codec}. Use 'zlib', 'jpeg' or None.")
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.codec = codec
+        self.max_backlog = max_backlog
+        self.copy_frames = copy_frames
+        self.recorded = 0
+        self.downgraded = 0     # Chunks compressed as JPEG instead of zlib because compression fell behind
+        os.makedirs(path, exist_ok=True)
+
+        self.__buffer_count = buffers
+        # Frames dropped by record() and by the writer thread, each counted only by its own thread
+        self.__record_dropped = 0
+        self.__write_dropped = 0
+        self.__free = queue.SimpleQueue()   # Pool buffers (allocated once the frame shape is known) or, without copies, tokens
+        self.__queue = queue.SimpleQueue()  # (buffer or token, image, index, timestamp, grab_ms, annotations), None to stop
+        self.__shape = None
+        self.__chunk = None                 # Memory map of the chunk being written
+        self.__chunk_index = -1
+        self.__chunk_codec = codec
+        self.__slot = 0
+        self.__index_file = open(os.path.join(path, "frames.jsonl"), "w")
+        self.__compressor = ThreadPoolExecutor(compress_threads) if codec else None
+        self.__compressing = []
+        self.__backlog = 0                  # Finished chunks whose compression has not completed
+        self.__backlog_lock = threading.Lock()
+        self.__writer = threading.Thread(target=self.__write, daemon=True)
+        self.__writer.start()
+
+    def record(self, frame, annotations=None):
+        """ Queue a Frame and a dict of anything JSON-serialisable (arrays and namedtuples included) about it. """
+        image = frame.image
+        if self.__shape is None:
+            self.__shape = image.shape
+            for _ in range(self.__buffer_count):
+                self.__free.put(np.empty(image.shape, dtype=np.uint8) if self.copy_frames else True)
+            self.__write_session()
+        if image.shape != self.__shape:
+            self.__record_dropped += 1
+            return
+        try:
+            buffer = self.__free.get_nowait()
+        except queue.Empty:
+            self.__record_dropped += 1
+            return
+        if self.copy_frames:
+            np.copyto(buffer, image)
+            image = buffer
+        self.__queue.put((buffer, image, frame.index, frame.timestamp, frame.grab_time, annotations))
+
+    @property
+    def dropped(self):
+        return self.__record_dropped + self.__write_dropped
+
+    def close(self):
+        """ Write everything that is still queued, compress the last chunk and wait for compression to finish. """
+        self.__queue.put(None)
+        self.__writer.join()
+        self.__finish_chunk()
+        if self.__compressor is not None:
+            for future in self.__compressing:
+                future.result()
+            self.__compressor.shutdown()
+        self.__index_file.close()
+        self.__write_session()
+
+    def __write_session(self):
+        session = {"shape": list(self.__shape) if self.__shape else None, "chunk_frames": self.chunk_frames,
+                   "codec": self.codec, "frames": self.recorded, "dropped": self.dropped, "downgraded": self.downgraded}
+        with open(os.path.join(self.path, "session.json"), "w") as file:
+            json.dump(session, file, indent=2)
+
+    def __write(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            buffer, image, index, timestamp, grab_ms, annotations = item
+            if self.__chunk is None or self.__slot == self.chunk_frames:
+                self.__finish_chunk()
+                with self.__backlog_lock:
+                    backlog = self.__backlog
+                if self.__compressor is not None and backlog >= self.max_backlog:
+                    # Compression is too far behind to take another chunk: drop frames until it catches up
+                    self.__free.put(buffer)
+                    self.__write_dropped += 1
+                    continue
+                self.__chunk_codec = self.codec
+                if self.codec == "zlib" and backlog >= max(self.max_backlog // 2, 1):
+                    self.__chunk_codec = "jpeg"
+                    self.downgraded += 1
+                self.__chunk_index += 1
+                self.__slot = 0
+                self.__chunk = np.memmap(self.__chunk_path(self.__chunk_index, ".raw"), dtype=np.uint8, mode="w+",
+                                         shape=(self.chunk_frames,) + self.__shape)
+            self.__chunk[self.__slot] = image
+            self.__free.put(buffer)
+            entry = {"index": index, "timestamp": timestamp, "grab_ms": grab_ms, "chunk": self.__chunk_index, "slot": self.__slot}
+            if annotations:
+                entry.update(_to_json(annotations))
+            self.__index_file.write(json.dumps(entry) + "\n")
+            self.__slot += 1
+            self.recorded += 1
+
+    def __finish_chunk(self):
+        if self.__chunk is None:
+            return
+        self.__chunk.flush()
+        self.__chunk = None
+        self.__index_file.flush()
+        if self.__compressor is not None:
+            with self.__backlog_lock:
+                self.__backlog += 1
+            self.__compressing.append(self.__compressor.submit(self.__compress_chunk, self.__chunk_index, self.__slot,
+                                                               self.__chunk_codec))
+
+    def __compress_chunk(self, chunk_index, count, codec):
+        """ Compress every frame of a finished chunk on its own, so the reader can still decompress just one frame. """
+        try:
+            raw = np.memmap(self.__chunk_path(chunk_index, ".raw"), dtype=np.uint8, mode="r", shape=(self.chunk_frames,) + self.__shape)
+            extension = ".z" if codec == self.codec else ".jpg"
+            offsets = [0]
+            with open(self.__chunk_path(chunk_index, extension + ".tmp"), "wb") as file:
+                for slot in range(count):
+                    data = encode_frame(raw[slot], codec)
+                    file.write(data)
+                    offsets.append(offsets[-1] + len(data))
+            np.save(self.__chunk_path(chunk_index, ".offsets"), np.array(offsets, dtype=np.int64), allow_pickle=False)
+            os.replace(self.__chunk_path(chunk_index, extension + ".tmp"), self.__chunk_path(chunk_index, extension))
+            del raw
+            os.remove(self.__chunk_path(chunk_index, ".raw"))
+        finally:
+            with self.__backlog_lock:
+                self.__backlog -= 1
+
+    def __chunk_path(self, chunk_index, extension):
+        return os.path.join(self.path, f"chunk_{chunk_index:05d}{extension}")
+
+    def format(self):
+        return f"Recorded {self.recorded} frames to {self.path} ({self.dropped} dropped, {self.downgraded} chunks downgraded to JPEG)"
+
+
+class SessionReader:
+    """ Random access to a recorded session: reader[i] is the i-th recorded frame (BGRA), reader.entries[i] what was
+    recorded with it. Uncompressed chunks are memory-mapped, compressed ones are mapped and only the requested frame
+    is decompressed. Sessions that were not closed properly can be read up to the last complete line of the index. """
+    def __init__(self, path):
+        if not os.path.isfile(os.path.join(path, "session.json")):
+            raise FileNotFoundError(f"Error: '{path}' is not a recorded session.")
+        self.path = path
+        with open(os.path.join(path, "session.json")) as file:
+            session = json.load(file)
+        self.shape = tuple(session["shape"]) if session["shape"] else None
+        self.chunk_frames = session["chunk_frames"]
+        self.codec = session["codec"]
+        self.entries = []
+        with open(os.path.join(path, "frames.jsonl")) as file:
+            for line in file:
+                try:
+                    self.entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break   # Cut off mid-write
+        self.__chunks = {}  # Chunk index -> ("raw", memmap) or ("z", memmap, offsets, codec)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        entry = self.entries[i]
+        chunk = self.__chunks.get(entry["chunk"])
+        if chunk is None or (chunk[0] == "raw" and not os.path.isfile(self.__chunk_path(entry["chunk"], ".raw"))):
+            chunk = self.__open_chunk(entry["chunk"])
+        if chunk[0] == "raw":
+            return chunk[1][entry["slot"]]
+        _, data, offsets, codec = chunk
+        start, end = offsets[entry["slot"]], offsets[entry["slot"] + 1]
+        return decode_frame(data[start:end], codec, self.shape)
+
+    def __open_chunk(self, chunk_index):
+        for extension, codec in ((".z", self.codec), (".jpg", "jpeg")):
+            compressed = self.__chunk_path(chunk_index, extension)
+            if os.path.isfile(compressed):
+                offsets = np.load(self.__chunk_path(chunk_index, ".offsets.npy"))
+                chunk = ("z", np.memmap(compressed, dtype=np.uint8, mode="r"), offsets, codec)
+                break
+        else:
+            chunk = ("raw", np.memmap(self.__chunk_path(chunk_index, ".raw"), dtype=np.uint8, mode="r",
+                                      shape=(self.chunk_frames,) + self.shape))
+        self.__chunks[chunk_index] = chunk
+        return chunk
+
+    def __chunk_path(self, chunk_index, extension):
+        return os.path.join(self.path, f"chunk_{chunk_index:05d}{extension}")
+
+    @property
+    def fps(self):
+        """ Median recorded frame rate. """
+        if len(self.entries) < 2:
+            return 30.0
+        intervals = np.diff([entry["timestamp"] for entry in self.entries])
+        return 1 / np.median(intervals) if np.median(intervals) > 0 else 30.0
+
+
+class RecordingSource(ReplaySource):
+    """ Replay of a recorded session, from frame `start` on, at the recorded rate or as fast as possible.
+    `entry` holds what was recorded with the frame grab() returned last, e.g. to compare detections. """
+    def __init__(self, path, realtime=True, start=0):
+        self.reader = SessionReader(path)
+        super().__init__(self.reader.fps, realtime)
+        if self.reader.shape is None:
+            raise ValueError(f"Error: Session '{path}' has no frames.")
+        height, width = self.reader.shape[:2]
+        self.region = {"top": 0, "left": 0, "width": width, "height": height}
+        self.start = start
+        self.entry = None
+        self.__position = start
+
+    def open(self):
+        super().open()
+        self.__position = self.start
+
+    def grab(self):
+        if self.__position >= len(self.reader):
+            return None
+        self.entry = self.reader.entries[self.__position]
+        image = self.reader[self.__position]
+        self.__position += 1
+        return image
+
+
+def add_recorder_arguments(parser):
+    parser.add_argument("--record", default=None, help="Record the session (frames, detections, tracks, swipes) to this directory")
+    parser.add_argument("--record-codec", choices=["zlib", "jpeg", "none"], default="jpeg",
+                        help="Compression of recorded frames: lossless, lossy but fast enough for 60 FPS on one core, or none")
+
+
+def recorder_from_args(args):
+    if not args.record:
+        return None
+    # GameWrapper's sources return a new array from every grab and the agents draw on their own BGR copy
+    return SessionRecorder(args.record, codec=None if args.record_codec == "none" else args.record_codec, copy_frames=False)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark on simulated game frames: cost of record() on the agent's thread, and random access replay
+    import tempfile
+    from pipeline import Frame
+    from simulator import FruitNinjaSimulator
+
+    simulator = FruitNinjaSimulator()
+    images = [simulator.step() for _ in range(180)]
+    frames = 600    # 10 s at 60 FPS, long enough for a slow codec to fall behind
+    for codec, copy_frames in (("zlib", True), ("zlib", False), ("jpeg", False), (None, False)):
+        with tempfile.TemporaryDirectory() as path:
+            recorder = SessionRecorder(path, codec=codec, copy_frames=copy_frames)
+            timings = []
+            for i in range(frames):
+                image = images[i % len(images)]
+                start = time.perf_counter_ns()
+                recorder.record(Frame(image, i, time.perf_counter(), 1.0), {"boxes": np.zeros((3, 4), dtype=np.float32)})
+                timings.append((time.perf_counter_ns() - start) / 1e6)
+                time.sleep(1 / 60)
+            start = time.perf_counter()
+            recorder.close()
+            closing = time.perf_counter() - start
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2 ** 20
+
+            reader = SessionReader(path)
+            order = np.random.default_rng(0).permutation(len(reader))[:30]
+            start = time.perf_counter()
+            error = max(np.abs(reader[i].astype(np.int16) - images[reader.entries[i]["index"] % len(images)]).mean() for i in order)
+            access = (time.perf_counter() - start) / len(order) * 1000
+            print(f"{str(codec):>5}{' copy' if copy_frames else ''}: record() {np.median(timings):.3f} ms median, {np.percentile(timings, 99):.3f} ms p99, "
+                  f"{max(timings):.3f} ms max, {recorder.dropped} dropped, {recorder.downgraded} chunks downgraded, "
+                  f"close() {closing:.1f} s, {size:.0f} MiB, "
+                  f"random access {access:.2f} ms per frame, mean abs error {error:.2f}")
@@ -0,0 +1,152 @@
+import time
+import cv2
+import numpy as np
+from detector import Detections, empty_detections
+
+
+class RoiDetector:
+    """ Detects only around the predicted positions of tracked objects, at native resolution.
+    The predicted boxes are packed into at most grid x grid crops of model_size / grid frame pixels each. The crops are
+    tiled into one model input (a mosaic), so a single forward pass covers all of them whatever the backend or the
+    exported input shape, and fruit are seen at full resolution instead of shrunk with the whole frame. A full frame
+    pass still runs every `full_interval_ms`, and whenever the tracks do not fit the crops, to find fruit that are
+    not tracked yet, e.g. entering from the bottom edge. Same interface as the Detector it wraps. """
+    def __init__(self, detector, tracker, grid=2, padding=16.0, sigmas=2.0, full_interval_ms=250.0):
+        self.detector = detector
+        self.tracker = tracker
+        self.names = detector.names
+        self.preprocessor = detector.preprocessor
+        self.grid = grid
+        self.tile = detector.preprocessor.model_size // grid    # Crop size in frame pixels
+        self.padding = padding          # Pixels added around every predicted box...
+        self.sigmas = sigmas            # ...plus this many standard deviations of its predicted position
+        self.full_interval_ms = full_interval_ms
+
+        self.full_passes = 0
+        self.roi_passes = 0
+        self.__last_full = None
+        size = detector.preprocessor.model_size
+        self.__mosaic = np.full((size, size, 3), detector.preprocessor.pad_color, dtype=np.uint8)
+        self.__used = np.zeros(grid * grid, dtype=bool)     # Mosaic slots that hold a crop, so stale ones get cleared
+
+    def warm_up(self, width, height, runs=3):
+        """ Crops go through the same model input size as full frames, so warming up the wrapped detector covers both. """
+        return self.detector.warm_up(width, height, runs)
+
+    def plan_crops(self, boxes, width, height):
+        """ Top-left corners (K, 2) of crops that together contain every box, or None if that needs too many crops.
+        Boxes are packed greedily: each joins the first crop whose extent stays within one tile. """
+        tile = self.tile
+        if width < tile or height < tile:
+            return None
+        extents = []    # [x1, y1, x2, y2] of the boxes in each crop
+        for box in boxes[np.argsort(boxes[:, 1])]:
+            if box[2] - box[0] > tile or box[3] - box[1] > tile:
+                return None
+            for extent in extents:
+                merged = np.concatenate([np.minimum(extent[:2], box[:2]), np.maximum(extent[2:], box[2:])])
+                if merged[2] - merged[0] <= tile and merged[3] - merged[1] <= tile:
+                    extent[:] = merged
+                    break
+            else:
+                if len(extents) == self.grid * self.grid:
+                    return None
+                extents.append(box.copy())
+        extents = np.array(extents).reshape(-1, 4)
+        centres = (extents[:, :2] + extents[:, 2:]) / 2
+        corners = np.round(centres - tile / 2).astype(np.int64)
+        return np.clip(corners, 0, [width - tile, height - tile])
+
+    def detect(self, screen, timestamp=None):
+        height, width = screen.shape[:2]
+        full = timestamp is None or len(self.tracker) == 0 or self.__last_full is None \
+            or timestamp - self.__last_full >= self.full_interval_ms
+        corners = None
+        if not full:
+            predicted = self.tracker.predict(timestamp)
+            grow = self.padding + self.sigmas * self.tracker.uncertainty(timestamp)
+            boxes = predicted.boxes + np.array([-1, -1, 1, 1]) * grow[:, None]
+            corners = self.plan_crops(np.clip(boxes, 0, [width, height, width, height]), width, height)
+        if corners is None:
+            self.full_passes += 1
+            self.__last_full = timestamp
+            return self.detector.detect(screen, timestamp)
+        self.roi_passes += 1
+        return self.__detect_crops(screen, corners)
+
+    def __detect_crops(self, screen, corners):
+        tile = self.tile
+        slots = np.stack([np.arange(len(corners)) % self.grid, np.arange(len(corners)) // self.grid], axis=1) * tile
+        for slot, (x, y), (sx, sy) in zip(range(len(corners)), corners, slots):
+            cv2.cvtColor(screen[y:y + tile, x:x + tile], cv2.COLOR_BGRA2BGR, dst=self.__mosaic[sy:sy + tile, sx:sx + tile])
+            self.__used[slot] = True
+        for slot in range(len(corners), self.grid * self.grid):
+            if self.__used[slot]:
+                sx, sy = slot % self.grid * tile, slot // self.grid * tile
+                self.__mosaic[sy:sy + tile, sx:sx + tile] = self.detector.preprocessor.pad_color
+                self.__used[slot] = False
+
+        detections = self.detector.detect_model_input(self.__mosaic)
+        if len(detections.boxes) == 0:
+            return detections
+
+        # Assign each box to the crop its centre is in, clip it to that crop and move it back to frame pixels
+        centres = (detections.boxes[:, :2] + detections.boxes[:, 2:]) / 2
+        cell = np.floor(centres / tile).astype(np.int64).clip(0, self.grid - 1)
+        slot = cell[:, 1] * self.grid + cell[:, 0]
+        keep = slot < len(corners)
+        boxes, slot = detections.boxes[keep], slot[keep]
+        origin = np.tile(slots[slot], 2)
+        boxes = np.clip(boxes, origin, origin + tile) - origin + np.tile(corners[slot], 2)
+        classes, confidences = detections.classes[keep], detections.confidences[keep]
+
+        # Crops can overlap, so the same fruit may have been found twice
+        if len(corners) > 1 and len(boxes) > 1:
+            xywh = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+            indices = np.asarray(cv2.dnn.NMSBoxes(xywh.tolist(), confidences.tolist(), 0.0, self.detector.iou), dtype=np.int64).reshape(-1)
+            boxes, classes, confidences = boxes[indices], classes[indices], confidences[indices]
+        if len(boxes) == 0:
+            return empty_detections()
+        return Detections(boxes.astype(np.float32), classes, confidences)
+
+    @property
+    def roi_rate(self):
+        passes = self.full_passes + self.roi_passes
+        return self.roi_passes / passes if passes else 0.0
+
+    def format(self):
+        return f"ROI inference: {self.roi_rate * 100:.1f}% of {self.full_passes + self.roi_passes} detector calls on crops"
+
+
+def add_roi_arguments(parser):
+    parser.add_argument("--roi", action="store_true", help="Detect on native resolution crops around tracked objects")
+    parser.add_argument("--roi-full-ms", type=float, default=250, help="Interval of full frame passes in --roi mode")
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: preprocessing cost of a crop mosaic compared with letterboxing the whole frame, on a model stub
+    from detector import Detector
+    from tracker import Tracker
+
+    class StubDetector(Detector):
+        def detect_model_input(self, model_input):
+            return empty_detections()
+
+    rng = np.random.default_rng(0)
+    screen = rng.integers(0, 256, size=(1080, 1920, 4), dtype=np.uint8)
+    detector = StubDetector()
+    tracker = Tracker()
+    centres = rng.uniform([200, 200], [1700, 900], size=(6, 2))
+    boxes = np.concatenate([centres - 40, centres + 40], axis=1).astype(np.float32)
+    tracker.update(Detections(boxes, np.zeros(6, dtype=np.int32), np.full(6, 0.9, dtype=np.float32)), 0.0)
+    roi = RoiDetector(detector, tracker, full_interval_ms=1e9)
+    roi.detect(screen, 0.0)     # First call is a full pass
+
+    for name, run in (("full frame", lambda t: detector.detect(screen, t)), ("crops", lambda t: roi.detect(screen, t))):
+        timings = []
+        for i in range(200):
+            start = time.perf_counter_ns()
+            run(1.0 + i * 0.01)
+            timings.append((time.perf_counter_ns() - start) / 1e6)
+        print(f"{name:>10}: {np.median(timings):.3f} ms median preprocessing")
+    print(roi.format())
@@ -0,0 +1,85 @@
+import math
+import time
+import numpy as np
+from tracker import Tracks
+
+
+class DetectionScheduler:
+    """ Decides per frame whether to run the detector or only propagate the existing tracks with their motion model.
+    The detector runs when
+      - the average detector latency no longer fits the per-frame `latency_budget_ms` over the frames skipped so far,
+      - some track's predicted position is more uncertain than `max_uncertainty` pixels,
+      - `new_object_interval_ms` has passed since the last detection, since new fruit can only be found by detecting,
+      - or there are no tracks to propagate at all.
+    Every detection also measures how far the propagated tracks had drifted, which gives the tracking error of skipping. """
+    def __init__(self, detector, tracker, latency_budget_ms=10.0, max_uncertainty=25.0, new_object_interval_ms=250.0, max_skip=10):
+        self.detector = detector
+        self.tracker = tracker
+        self.latency_budget_ms = latency_budget_ms
+        self.max_uncertainty = max_uncertainty
+        self.new_object_interval_ms = new_object_interval_ms
+        self.max_skip = max_skip
+
+        self.detect_ms = None       # Moving average of the detector latency
+        self.frames = 0
+        self.detections = 0
+        self.__skipped = 0          # Frames propagated since the last detection
+        self.__last_detection = None
+        self.__error_sum = 0.0      # Sum and count of the mean propagation error (px) measured at each detection after
+        self.__error_count = 0      # skipped frames
+
+    def should_detect(self, timestamp):
+        if self.detect_ms is None or self.__last_detection is None or len(self.tracker) == 0:
+            return True
+        if self.__skipped >= self.max_skip or timestamp - self.__last_detection >= self.new_object_interval_ms:
+            return True
+        # Skip as many frames as it takes for the detector's cost, spread over them, to fit the budget
+        if self.__skipped + 1 >= math.ceil(self.detect_ms / self.latency_budget_ms):
+            return True
+        return bool((self.tracker.uncertainty(timestamp) > self.max_uncertainty).any())
+
+    def step(self, screen, timestamp):
+        """ Returns (tracks, detected) for the frame captured at `timestamp` (ms). """
+        self.frames += 1
+        if not self.should_detect(timestamp):
+            self.__skipped += 1
+            predicted = self.tracker.predict(timestamp)
+            return predicted, False
+
+        start = time.perf_counter()
+        detections = self.detector.detect(screen, timestamp)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.detect_ms = elapsed if self.detect_ms is None else 0.8 * self.detect_ms + 0.2 * elapsed
+
+        predicted = self.tracker.predict(timestamp) if self.__skipped else None
+        tracks = self.tracker.update(detections, timestamp)
+        if predicted is not None:
+            self.__record_error(predicted, tracks)
+
+        self.detections += 1
+        self.__skipped = 0
+        self.__last_detection = timestamp
+        return tracks, True
+
+    def __record_error(self, predicted, tracks):
+        common, pred_index, track_index = np.intersect1d(predicted.ids, tracks.ids, return_indices=True)
+        if len(common) == 0:
+            return
+        pred_centres = (predicted.boxes[pred_index, :2] + predicted.boxes[pred_index, 2:]) / 2
+        det_centres = (tracks.boxes[track_index, :2] + tracks.boxes[track_index, 2:]) / 2
+        self.__error_sum += float(np.linalg.norm(pred_centres - det_centres, axis=1).mean())
+        self.__error_count += 1
+
+    @property
+    def detection_rate(self):
+        return self.detections / self.frames if self.frames else 0.0
+
+    @property
+    def tracking_error(self):
+        """ Mean distance in pixels between propagated and detected positions, measured after skipped frames. """
+        return self.__error_sum / self.__error_count if self.__error_count else 0.0
+
+    def format(self):
+        detect_ms = self.detect_ms or 0
+        return (f"Detection rate: {self.detection_rate * 100:.1f}% of {self.frames} frames, detector {detect_ms:.2f} ms, "
+                f"propagation error {self.tracking_error:.2f} px")
@@ -0,0 +1,388 @@
+from startup import StartupProfile, add_startup_arguments    # First, so the startup profile covers the other imports
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+import cv2
+import mss
+import numpy as np
+from detector import Detections, add_detector_arguments, detector_from_args
+from frame_source import add_source_arguments, source_from_args
+from calibration import CalibrationCache, locate_game_region
+from multi_game import region_to_screen
+from metrics import StageMetrics, add_metrics_arguments
+from actuator import add_actuator_arguments, executor_from_args
+from track_agent import TrackAgent
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import get_classnames
+
+
+class FrameRing:
+    """ Ring of `slots` frames in shared memory, written by one process and read zero-copy by others.
+    Frames are never pickled: the writer copies each frame into the next slot and then publishes its sequence number,
+    readers look up the slot of a sequence number and use the memory in place. A slot holds -1 while it is written,
+    so a reader can tell afterwards (valid()) whether the frame it used was overwritten in the meantime. Readers that
+    keep a frame for longer than the writer takes to lap the ring copy it out with read_into() instead. """
+    def __init__(self, shape, slots=8, name=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        frame_bytes = int(np.prod(self.shape))
+        header_bytes = 8 * (2 + slots) + 8 * 2 * slots
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=header_bytes + frame_bytes * slots)
+        buffer = self.shm.buf
+        self.__header = np.ndarray((2 + slots,), dtype=np.int64, buffer=buffer)         # Latest sequence, closed, sequence per slot
+        self.__times = np.ndarray((slots, 2), dtype=np.float64, buffer=buffer, offset=8 * (2 + slots))    # Capture time, grab ms
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=buffer, offset=header_bytes)
+        if create:
+            self.__header[:] = 0
+            self.__header[2:] = -1
+
+    @property
+    def spec(self):
+        """ What another process needs to attach: FrameRing(*spec). """
+        return self.shape, self.slots, self.shm.name
+
+    @property
+    def latest(self):
+        return int(self.__header[0])
+
+    @property
+    def closed(self):
+        return bool(self.__header[1])
+
+    def mark_closed(self):
+        self.__header[1] = 1
+
+    def write(self, image, timestamp, grab_ms=0.0):
+        sequence = self.latest + 1
+        slot = sequence % self.slots
+        self.__header[2 + slot] = -1
+        np.copyto(self.frames[slot], image)
+        self.__times[slot] = timestamp, grab_ms
+        self.__header[2 + slot] = sequence
+        self.__header[0] = sequence
+        return sequence
+
+    def valid(self, sequence):
+        return self.__header[2 + sequence % self.slots] == sequence
+
+    def read(self, sequence):
+        """ (image view, capture time, grab ms) of a frame that is still in the ring, otherwise None. """
+        slot = sequence % self.slots
+        if not self.valid(sequence):
+            return None
+        timestamp, grab_ms = self.__times[slot]
+        return self.frames[slot], timestamp, grab_ms
+
+    def read_into(self, sequence, out):
+        """ Copy a frame into `out` and return (capture time, grab ms), or None if it was overwritten before or while
+        it was copied, in which case `out` holds a torn frame. """
+        slot = sequence % self.slots
+        if not self.valid(sequence):
+            return None
+        timestamp, grab_ms = self.__times[slot]
+        np.copyto(out, self.frames[slot])
+        if not self.valid(sequence):
+            return None
+        return timestamp, grab_ms
+
+    def close(self, unlink=False):
+        # Views into the buffer must go before the memory can be released
+        self.__header = self.__times = self.frames = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class DetectionBoard:
+    """ The latest detections in shared memory, published by the detector process and read by the control process.
+    A version counter that is odd while a write is in progress lets readers retry instead of taking a lock. """
+    def __init__(self, capacity=256, name=None):
+        self.capacity = capacity
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=8 * 4 + 8 * 2 + capacity * 24)
+        buffer = self.shm.buf
+        self.__header = np.ndarray((4,), dtype=np.int64, buffer=buffer)      # Version, frame sequence, count, closed
+        self.__times = np.ndarray((2,), dtype=np.float64, buffer=buffer, offset=32)  # Capture time, detector ms
+        self.__boxes = np.ndarray((capacity, 4), dtype=np.float32, buffer=buffer, offset=48)
+        self.__classes = np.ndarray((capacity,), dtype=np.int32, buffer=buffer, offset=48 + capacity * 16)
+        self.__confidences = np.ndarray((capacity,), dtype=np.float32, buffer=buffer, offset=48 + capacity * 20)
+        if create:
+            self.__header[:] = 0
+
+    @property
+    def spec(self):
+        return self.capacity, self.shm.name
+
+    @property
+    def version(self):
+        return int(self.__header[0])
+
+    @property
+    def closed(self):
+        return bool(self.__header[3])
+
+    def mark_closed(self):
+        self.__header[3] = 1
+
+    def publish(self, sequence, detections, timestamp, detect_ms):
+        count = min(len(detections.boxes), self.capacity)
+        self.__header[0] += 1     # Odd: write in progress
+        self.__header[1:3] = sequence, count
+        self.__times[:] = timestamp, detect_ms
+        self.__boxes[:count] = detections.boxes[:count]
+        self.__classes[:count] = detections.classes[:count]
+        self.__confidences[:count] = detections.confidences[:count]
+        self.__header[0] += 1
+
+    def read(self):
+        """ (version, frame sequence, capture time, detector ms, Detections) of the latest publication. """
+        while True:
+            version = int(self.__header[0])
+            if version % 2:
+                continue
+            sequence, count = int(self.__header[1]), int(self.__header[2])
+            timestamp, detect_ms = self.__times
+            detections = Detections(self.__boxes[:count].copy(), self.__classes[:count].copy(), self.__confidences[:count].copy())
+            if int(self.__header[0]) == version:
+                return version, sequence, float(timestamp), float(detect_ms), detections
+
+    def close(self, unlink=False):
+        self.__header = self.__times = self.__boxes = self.__classes = self.__confidences = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ForwardedMouse:
+    """ Mouse backend for SwipeExecutor that sends the events to the capture process, for sources that take swipes
+    themselves (a SimulatorSource): the source there is the one whose frames the agent sees, not the copy this process
+    made to find the game region. The capture process performs the events before each grab. """
+    def __init__(self):
+        self.__events = mp.get_context("spawn").Queue()
+
+    def press(self, x, y):
+        self.__events.put(("press", float(x), float(y)))
+
+    def move(self, x, y):
+        self.__events.put(("move", float(x), float(y)))
+
+    def release(self, x, y):
+        self.__events.put(("release", float(x), float(y)))
+
+    def replay(self, mouse):
+        """ Perform the events sent so far on `mouse`, in the process that owns it. """
+        while True:
+            try:
+                event, x, y = self.__events.get_nowait()
+            except queue.Empty:
+                return
+            getattr(mouse, event)(x, y)
+
+
+def capture_process(args, region, ring_spec, stop, mouse=None):
+    """ Grabs frames into the ring until stopped or the source runs out. Swipes sent through a ForwardedMouse
+    `mouse` are performed on the source's own mouse. """
+    ring = FrameRing(*ring_spec)
+    source = source_from_args(args)
+    source.region = region
+    source.open()
+    try:
+        while not stop.is_set():
+            source.wait()
+            if mouse is not None:
+                mouse.replay(source.mouse)
+            grab_start = time.perf_counter()
+            screen = source.grab()
+            if screen is None:
+                break
+            grab_end = time.perf_counter()
+            ring.write(screen, grab_end, (grab_end - grab_start) * 1000)
+    finally:
+        source.close()
+        ring.mark_closed()
+        ring.close()
+
+
+def detector_process(args, ring_spec, board_spec, stop, ready):
+    """ Detects on the newest frame in the ring, in place, and publishes the results. Frames that arrive while the
+    detector is busy are skipped, like in the pipelined GameWrapper. """
+    ring = FrameRing(*ring_spec)
+    board = DetectionBoard(*board_spec)
+    detector = detector_from_args(args)
+    height, width = ring.shape[:2]
+    detector.warm_up(width, height, args.warmup)
+    ready.set()
+    last = 0
+    try:
+        while not stop.is_set():
+            sequence = ring.latest
+            if sequence == last:
+                if ring.closed:
+                    break
+                time.sleep(0.0005)
+                continue
+            frame = ring.read(sequence)
+            if frame is None:
+                continue
+            image, timestamp, _ = frame
+            start = time.perf_counter()
+            detections = detector.detect(image, timestamp * 1000)
+            detect_ms = (time.perf_counter() - start) * 1000
+            last = sequence
+            # The writer lapped the ring while we were reading: the detections may mix two frames
+            if ring.valid(sequence):
+                board.publish(sequence, detections, timestamp, detect_ms)
+    finally:
+        board.mark_closed()
+        board.close()
+        ring.close()
+
+
+class SharedMemoryRuntime:
+    """ Runs capture, detection and control in separate processes so they do not share one GIL.
+    The capture process writes frames into a shared memory FrameRing, the detector process reads them in place and
+    publishes its results on a DetectionBoard, and this (the control) process runs the agent, display and actuation.
+    Everything is coordinated with sequence numbers; no frame is ever pickled. """
+    def __init__(self, args, region, agent, slots=8, headless=False, metrics_interval=0, metrics_path=None, startup=None,
+                 mouse=None):
+        self.args = args
+        self.region = region
+        self.agent = agent
+        self.mouse = mouse      # ForwardedMouse of the agent's executor, for sources that take swipes themselves
+        self.slots = slots
+        self.headless = headless
+        self.metrics = StageMetrics()
+        self.__metrics_interval = metrics_interval
+        self.__metrics_path = metrics_path
+        self.__startup = startup
+
+    def play(self):
+        """ Run until Q is pressed or the source runs out of frames. """
+        metrics = self.metrics
+        ring = FrameRing((self.region["height"], self.region["width"], 4), slots=self.slots)
+        board = DetectionBoard()
+        context = mp.get_context("spawn")   # Same behaviour on every platform; nothing is inherited by accident
+        stop, ready = context.Event(), context.Event()
+        detector = context.Process(target=detector_process, args=(self.args, ring.spec, board.spec, stop, ready), daemon=True)
+        capture = context.Process(target=capture_process, args=(self.args, self.region, ring.spec, stop, self.mouse),
+                                  daemon=True)
+        detector.start()
+        try:
+            while not ready.wait(0.1):
+                if not detector.is_alive():
+                    raise RuntimeError("The detector process exited during startup")
+            if self.__startup is not None:
+                self.__startup.mark("detector ready")
+            capture.start()
+
+            play_start = time.perf_counter()
+            last_print = play_start
+            version, last_sequence, handled, skipped, torn = 0, 0, 0, 0, 0
+            # The agent, the overlay and the recorder keep using the frame after step() returned, longer than the
+            # capture process needs to lap the ring, so they get a private copy instead of the shared slot
+            image = np.empty(ring.shape, dtype=np.uint8)
+            while True:
+                if board.version == version:
+                    if board.closed or not detector.is_alive():
+                        break
+                    time.sleep(0.0005)
+                    quit_requested = not self.headless and cv2.waitKey(1) & 0xFF == ord("q")
+                    if quit_requested:
+                        break
+                    continue
+                loop_start = time.perf_counter_ns()
+                version, sequence, timestamp, detect_ms, detections = board.read()
+                if not ring.valid(sequence):    # Overwritten before we got to it
+                    skipped += 1
+                    continue
+                frame = ring.read_into(sequence, image)
+                if frame is None:   # Overwritten while it was copied
+                    torn += 1
+                    continue
+                timestamp, grab_ms = frame
+                metrics.record("grab", int(grab_ms * 1e6))
+                metrics.record("inference", int(detect_ms * 1e6))
+                metrics.record_ratio("frames_detected", True)
+                for _ in range(last_sequence + 1, sequence):
+                    metrics.record_ratio("frames_detected", False)
+                last_sequence = sequence
+
+                with metrics.stage("agent"):
+                    output = self.agent.step(image, detections, (timestamp - play_start) * 1000, timestamp, metrics)
+                handled += 1
+                quit_requested = False
+                if not self.headless and output is not None:
+                    cv2.imshow("GameFrame", output)
+                    quit_requested = cv2.waitKey(1) & 0xFF == ord("q")
+
+                now = time.perf_counter_ns()
+                metrics.record("frame", now - loop_start)
+                metrics.record("latency", now - int(timestamp * 1e9))
+                if handled == 1 and self.__startup is not None:
+                    self.__startup.mark("first frame")
+                    print(self.__startup.format(), flush=True)
+                if self.__metrics_interval and time.perf_counter() - last_print >= self.__metrics_interval:
+                    last_print = time.perf_counter()
+                    print("\n" + metrics.format(), flush=True)
+                if quit_requested:
+                    break
+        finally:
+            stop.set()
+            for process in (capture, detector):
+                if process.pid is not None:
+                    process.join(timeout=5)
+                    if process.is_alive():
+                        process.terminate()
+            ring.close(unlink=True)
+            board.close(unlink=True)
+            if not self.headless:
+                cv2.destroyAllWindows()
+
+        elapsed = time.perf_counter() - play_start
+        if handled and elapsed > 0:
+            print(f"Handled {handled} detected frames in {elapsed:.2f} s ({handled / elapsed:.2f} FPS), {skipped} overwritten before use, "
+                  f"{torn} overwritten while copied")
+        if self.__metrics_interval:
+            print("\n" + metrics.format(), flush=True)
+        if self.__metrics_path:
+            metrics.dump(self.__metrics_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track fruits with capture, detection and control in separate processes.")
+    add_source_arguments(parser)
+    add_metrics_arguments(parser)
+    add_detector_arguments(parser)
+    add_actuator_arguments(parser)
+    add_startup_arguments(parser)
+    parser.add_argument("--slots", type=int, default=8, help="Frames in the shared memory ring")
+    parser.add_argument("--swipe-speed", type=float, default=4000, help="Swipe speed in pixels per second")
+    args = parser.parse_args()
+
+    startup = StartupProfile()
+    # The source is only used to find the game region here; capture runs in its own process
+    with startup.phase("game region"):
+        source = source_from_args(args)
+        region = source.region
+        if region is None:
+            with mss.mss() as sct:
+                screen = np.array(sct.grab(source.monitor))
+            region = locate_game_region(source.monitor, screen, cache=CalibrationCache(), recalibrate=args.recalibrate)
+            if region is None:
+                raise SystemExit("Could not find the game. Select it once with track_agent.py --manual-region, "
+                                 "the selection is cached for this runtime as well.")
+            print(f"Game region {region}")
+    # Swipes for a simulator have to reach the one in the capture process
+    mouse = ForwardedMouse() if getattr(source, "mouse", None) is not None else None
+    agent = TrackAgent(get_classnames(), executor=executor_from_args(args, region_to_screen(region), mouse=mouse),
+                       swipe_speed=args.swipe_speed)
+    runtime = SharedMemoryRuntime(args, region, agent, slots=args.slots, headless=args.headless,
+                                  metrics_interval=args.metrics_every, metrics_path=args.metrics_out,
+                                  startup=startup if args.startup_profile else None, mouse=mouse)
+    runtime.play()
+    agent.close()
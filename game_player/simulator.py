@@ -0,0 +1,420 @@
+import os
+import sys
+import random
+import threading
+import time
+import cv2
+import numpy as np
+from frame_source import ReplaySource
+from actuator import swipe_path
+from detector import Detections
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data_collection')))
+from common import get_classnames, class_to_id, extract_classname_from_file
+
+
+_RESOURCE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data_collection', 'resource'))
+
+
+def harvest_sprites(data_dir, height=720, per_class=8, max_frames=500):
+    """ Cut object sprites out of the data pipeline's per-object layers, as BGRA images scaled to a game `height`.
+    Every frame folder holds the canvas after each object was rendered, named <frame>-<sequence>-<class>.png, so an
+    object is whatever changed from the previous layer (like generate_masks.subtract_images). Returns {class id: [sprites]}. """
+    ids = class_to_id()
+    sprites = {}
+    folders = sorted(entry for entry in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, entry)))[:max_frames]
+    for folder in folders:
+        path = os.path.join(data_dir, folder)
+        layers = [f for f in os.listdir(path) if f.endswith(".png") and len(f.split("-")) == 3 and f.split("-")[1].isdigit()]
+        layers.sort(key=lambda f: int(f.split("-")[1]))
+        previous = None
+        for name in layers:
+            layer = cv2.imread(os.path.join(path, name), cv2.IMREAD_UNCHANGED)
+            if layer is None or layer.ndim != 3 or layer.shape[2] != 4:
+                previous = None
+                continue
+            class_id = ids.get(extract_classname_from_file(name))
+            if class_id is not None and len(sprites.get(class_id, [])) < per_class:
+                changed = layer[..., 3] > 0
+                if previous is not None:
+                    changed &= (previous[..., 3] == 0) | (previous != layer).any(axis=-1)
+                rows, cols = np.nonzero(changed)
+                if len(rows) >= 16:
+                    y1, y2, x1, x2 = rows.min(), rows.max() + 1, cols.min(), cols.max() + 1
+                    sprite = np.where(changed[y1:y2, x1:x2, None], layer[y1:y2, x1:x2], 0).astype(np.uint8)
+                    scale = height / layer.shape[0]
+                    if scale != 1:
+                        sprite = cv2.resize(sprite, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                    sprites.setdefault(class_id, []).append(sprite)
+            previous = layer
+    return sprites
+
+
+def synthetic_sprites(height=720):
+    """ Plain discs in distinct colours per class, for running without a dataset. Halves are half discs. """
+    names = get_classnames()
+    radius = max(int(height * 0.06), 4)
+    sprites = {}
+    for class_id, name in enumerate(names):
+        hue = int(180 * class_id / len(names))
+        color = cv2.cvtColor(np.uint8([[[hue, 200, 230]]]), cv2.COLOR_HSV2BGR)[0, 0].tolist()
+        if name == "bomb":
+            color = [30, 30, 30]
+        sprite = np.zeros((2 * radius, 2 * radius, 4), dtype=np.uint8)
+        cv2.circle(sprite, (radius, radius), radius - 1, color + [255], -1, cv2.LINE_AA)
+        if "Half" in name:
+            sprite = np.ascontiguousarray(sprite[:, :radius])
+        sprites[class_id] = [sprite]
+    return sprites
+
+
+def seeded_background(width, height, seed=0, resource_dir=_RESOURCE_DIR):
+    """ A BackgroundGen background with splashes as a BGRA game frame, or a flat one if the resources are missing. """
+    if not os.path.isdir(resource_dir):
+        return np.full((height, width, 4), (40, 60, 90, 255), dtype=np.uint8)
+    from generate_background import BackgroundGen
+    # BackgroundGen draws from the global generators
+    random.seed(seed)
+    np.random.seed(seed)
+    background = BackgroundGen(resource_dir).generate_background(num_splashes=3)
+    conversion = cv2.COLOR_RGBA2BGRA if background.shape[2] == 4 else cv2.COLOR_RGB2BGRA
+    background = cv2.cvtColor(background, conversion)
+    background[..., 3] = 255
+    return cv2.resize(background, (width, height), interpolation=cv2.INTER_AREA)
+
+
+class FruitNinjaSimulator:
+    """ A deterministic stand-in for the game: fruit and bombs are thrown up from below the bottom edge in waves,
+    fly ballistically and are drawn over a background. Swipes (see SimulatorMouse) cut fruit in two halves and hit
+    bombs. Time only moves in step() calls of 1 / fps seconds, so the same seed gives the same game however fast
+    frames are taken. Positions are in game pixels, times in ms of simulated time. """
+    def __init__(self, width=1280, height=720, fps=60.0, seed=0, sprites=None, background=None,
+                 wave_interval_ms=(900, 1800), wave_size=(1, 5), bomb_chance=0.12):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.names = get_classnames()
+        self.sprites = sprites or synthetic_sprites(height)
+        self.background = background if background is not None else seeded_background(width, height, seed)
+        self.wave_interval_ms = wave_interval_ms
+        self.wave_size = wave_size
+        self.bomb_chance = bomb_chance
+        self.gravity = 1.4 * height     # Pixels per second squared
+
+        self.__rng = np.random.default_rng(seed)
+        self.__lock = threading.Lock()  # Swipes arrive from the executor thread
+        self.__whole = [i for i, name in enumerate(self.names) if "Whole" in name and i in self.sprites]
+        self.__bomb = self.names.index("bomb") if "bomb" in self.names else None
+
+        # Flying objects as parallel arrays, plus their sprite and the time they first came into view
+        self.positions = np.zeros((0, 2))
+        self.velocities = np.zeros((0, 2))
+        self.classes = np.zeros(0, dtype=np.int32)
+        self.radii = np.zeros(0)
+        self.seen_ms = np.zeros(0)
+        self.__sprites = []     # (BGRA sprite, premultiplied colour, 1 - alpha) per object
+
+        self.time_ms = 0.0
+        self.__next_wave_ms = 500.0
+        self.sliced = 0
+        self.missed = 0
+        self.bombs_hit = 0
+        self.reaction_ms = []       # Time from coming into view to being sliced, per sliced fruit
+
+    @property
+    def score(self):
+        return self.sliced
+
+    def step(self):
+        """ Advance the game by one frame and return it, rendered as a BGRA image. Every frame is a new array, like
+        ScreenSource's, so a frame still in use by the agent or the recorder is never drawn over. """
+        with self.__lock:
+            dt = 1 / self.fps
+            self.time_ms += dt * 1000
+            if self.time_ms >= self.__next_wave_ms:
+                self.__throw_wave()
+            self.velocities[:, 1] += self.gravity * dt
+            self.positions += self.velocities * dt
+
+            visible = self.positions[:, 1] - self.radii < self.height
+            self.seen_ms[np.isnan(self.seen_ms) & visible] = self.time_ms
+
+            # Objects that came into view and then fell out of the bottom are gone; unsliced whole fruit count as missed
+            gone = ~np.isnan(self.seen_ms) & (self.positions[:, 1] - self.radii > self.height) & (self.velocities[:, 1] > 0)
+            gone |= (self.positions[:, 0] < -self.width / 2) | (self.positions[:, 0] > self.width * 1.5)
+            whole = np.isin(self.classes, self.__whole)
+            self.missed += int((gone & whole).sum())
+            self.__keep(~gone)
+            return self.__render()
+
+    def __throw_wave(self):
+        rng = self.__rng
+        count = int(rng.integers(self.wave_size[0], self.wave_size[1] + 1))
+        for _ in range(count):
+            if self.__bomb is not None and self.__bomb in self.sprites and rng.random() < self.bomb_chance:
+                class_id = self.__bomb
+            else:
+                class_id = self.__whole[int(rng.integers(len(self.__whole)))]
+            choices = self.sprites[class_id]
+            sprite = choices[int(rng.integers(len(choices)))]
+            x = rng.uniform(0.15, 0.85) * self.width
+            apex = rng.uniform(0.15, 0.6) * self.height      # Height of the highest point above the bottom edge
+            radius = max(sprite.shape[:2]) / 2
+            vy = -np.sqrt(2 * self.gravity * (apex + radius))
+            vx = (self.width / 2 - x) * rng.uniform(0.1, 0.6)
+            self.__add(class_id, sprite, (x, self.height + radius), (vx, vy), np.nan)
+        low, high = self.wave_interval_ms
+        self.__next_wave_ms = self.time_ms + rng.uniform(low, high)
+
+    def __add(self, class_id, sprite, position, velocity, seen_ms):
+        self.positions = np.vstack([self.positions, position])
+        self.velocities = np.vstack([self.velocities, velocity])
+        self.classes = np.append(self.classes, np.int32(class_id))
+        self.radii = np.append(self.radii, max(sprite.shape[:2]) / 2)
+        self.seen_ms = np.append(self.seen_ms, seen_ms)
+        # Premultiplied colour and 1 - alpha, so drawing is one multiply-add per pixel
+        alpha = sprite[..., 3:4].astype(np.float32) / 255
+        self.__sprites.append((sprite, sprite[..., :3] * alpha, 1 - alpha))
+
+    def __keep(self, keep):
+        self.positions, self.velocities = self.positions[keep], self.velocities[keep]
+        self.classes, self.radii, self.seen_ms = self.classes[keep], self.radii[keep], self.seen_ms[keep]
+        self.__sprites = [sprite for sprite, k in zip(self.__sprites, keep) if k]
+
+    def slice(self, start, end):
+        """ Cut everything whose disc the segment from `start` to `end` (game pixels) passes through. """
+        with self.__lock:
+            if len(self.positions) == 0:
+                return
+            start, end = np.asarray(start, dtype=np.float64), np.asarray(end, dtype=np.float64)
+            segment = end - start
+            length = max(float(segment @ segment), 1e-9)
+            t = np.clip((self.positions - start) @ segment / length, 0, 1)
+            distance = np.linalg.norm(start + t[:, None] * segment - self.positions, axis=1)
+            hit = (distance <= self.radii) & ~np.isnan(self.seen_ms)
+            whole = np.isin(self.classes, self.__whole)
+            bomb = self.classes == self.__bomb
+
+            self.bombs_hit += int((hit & bomb).sum())
+            keep = ~(hit & (whole | bomb))
+            for i in np.flatnonzero(hit & whole):
+                self.sliced += 1
+                self.reaction_ms.append(self.time_ms - self.seen_ms[i])
+                self.__split(i, segment)
+            self.__keep(np.concatenate([keep, np.ones(len(self.classes) - len(keep), dtype=bool)]))
+
+    def __split(self, index, direction):
+        """ Throw the two halves of a cut fruit apart, perpendicular to the cut. """
+        half = self.names.index(self.names[self.classes[index]].replace("Whole", "Half"))
+        sprite = self.__sprites[index][0]
+        if half in self.sprites:
+            halves = [self.sprites[half][int(self.__rng.integers(len(self.sprites[half])))]] * 2
+            halves[1] = np.ascontiguousarray(halves[1][:, ::-1])
+        else:
+            middle = sprite.shape[1] // 2
+            halves = [np.ascontiguousarray(sprite[:, :middle]), np.ascontiguousarray(sprite[:, middle:])]
+        normal = np.array([-direction[1], direction[0]]) / max(np.linalg.norm(direction), 1e-9)
+        for sign, piece in zip((-1, 1), halves):
+            offset = sign * normal * self.radii[index] / 2
+            self.__add(half, piece, self.positions[index] + offset, self.velocities[index] + sign * normal * 120,
+                       self.seen_ms[index])
+
+    def __render(self):
+        frame = self.background.copy()
+        for (x, y), (sprite, color, inverse) in zip(self.positions, self.__sprites):
+            h, w = sprite.shape[:2]
+            x1, y1 = int(round(x - w / 2)), int(round(y - h / 2))
+            fx1, fy1, fx2, fy2 = max(x1, 0), max(y1, 0), min(x1 + w, self.width), min(y1 + h, self.height)
+            if fx1 >= fx2 or fy1 >= fy2:
+                continue
+            sx1, sy1 = fx1 - x1, fy1 - y1
+            sx2, sy2 = sx1 + fx2 - fx1, sy1 + fy2 - fy1
+            roi = frame[fy1:fy2, fx1:fx2, :3]
+            roi[:] = roi * inverse[sy1:sy2, sx1:sx2] + color[sy1:sy2, sx1:sx2]
+        return frame
+
+    def ground_truth(self):
+        """ Boxes of the objects in view as Detections, with confidence 1. Lets the rest of the agent run without a model. """
+        with self.__lock:
+            if len(self.positions) == 0:
+                return Detections(np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+            sizes = np.array([sprite.shape[1::-1] for sprite, _, _ in self.__sprites], dtype=np.float64)
+            boxes = np.concatenate([self.positions - sizes / 2, self.positions + sizes / 2], axis=1)
+            boxes = np.clip(boxes, 0, [self.width, self.height, self.width, self.height])
+            keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+            return Detections(boxes[keep].astype(np.float32), self.classes[keep].copy(), np.ones(int(keep.sum()), dtype=np.float32))
+
+    def format(self):
+        reaction = f", reaction {np.median(self.reaction_ms):.0f} ms median" if self.reaction_ms else ""
+        return (f"Simulated {self.time_ms / 1000:.1f} s: score {self.score}, {self.missed} missed, "
+                f"{self.bombs_hit} bombs hit{reaction}")
+
+
+class SimulatorMouse:
+    """ Mouse backend for SwipeExecutor that swipes in a FruitNinjaSimulator instead of on the screen.
+    Positions are game pixels, which is what game_to_screen_coords gives for a simulator source (its region is at 0, 0). """
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.__last = None
+
+    def press(self, x, y):
+        self.__last = (x, y)
+
+    def move(self, x, y):
+        if self.__last is not None:
+            self.simulator.slice(self.__last, (x, y))
+            self.__last = (x, y)
+
+    def release(self, x, y):
+        self.move(x, y)
+        self.__last = None
+
+
+class SimulatedExecutor:
+    """ SwipeExecutor on simulated time: swipes are not performed on a thread against the wall clock, but moved
+    along in advance() calls with the simulator's time (seconds, like swipe.start_time when the agent's clock is the
+    simulator's). Together with a simulator source that is not paced, a seed then always gives the same game. """
+    def __init__(self, to_screen, backend, rate=240):
+        self.to_screen = to_screen
+        self.backend = backend
+        self.rate = rate
+        self.__pending = None
+        self.__path = None      # (positions, times, next position) of the swipe in flight
+        self.completed = 0
+        self.cancelled = 0
+
+    def schedule(self, swipe, replace=True):
+        if self.__pending is not None:
+            self.cancelled += 1
+        self.__pending = swipe
+        if replace:
+            self.__stop()
+
+    def cancel(self):
+        if self.__pending is not None:
+            self.cancelled += 1
+        self.__pending = None
+        self.__stop()
+
+    def close(self):
+        self.cancel()
+
+    @property
+    def busy(self):
+        return self.__pending is not None or self.__path is not None
+
+    def __stop(self):
+        if self.__path is not None:
+            path, _, position = self.__path
+            self.backend.release(*path[max(position - 1, 0)])
+            self.cancelled += 1
+            self.__path = None
+
+    def advance(self, now):
+        """ Make every mouse movement that is due by `now`. """
+        if self.__path is None and self.__pending is not None:
+            path, times = swipe_path(self.__pending, self.to_screen, self.rate)
+            self.__pending = None
+            self.__path = (path, times, 0)
+        if self.__path is None:
+            return
+        path, times, position = self.__path
+        while position < len(path) and times[position] <= now:
+            if position == 0:
+                self.backend.press(*path[0])
+            else:
+                self.backend.move(*path[position])
+            position += 1
+        if position == len(path):
+            self.backend.release(*path[-1])
+            self.completed += 1
+            self.__path = None
+        else:
+            self.__path = (path, times, position)
+
+
+class SimulatorSource(ReplaySource):
+    """ Frames from a FruitNinjaSimulator, at its frame rate or as fast as the agent takes them, for `duration_s`
+    seconds of simulated time (0 for no limit). `mouse` makes swipes land in the simulation. """
+    def __init__(self, simulator, duration_s=60.0, realtime=True):
+        super().__init__(simulator.fps, realtime)
+        self.simulator = simulator
+        self.duration_s = duration_s
+        self.mouse = SimulatorMouse(simulator)
+        self.region = {"top": 0, "left": 0, "width": simulator.width, "height": simulator.height}
+
+    def grab(self):
+        if self.duration_s and self.simulator.time_ms >= self.duration_s * 1000:
+            return None
+        return self.simulator.step()
+
+
+def add_simulator_arguments(parser):
+    parser.add_argument("--sim-seed", type=int, default=0, help="Seed of the simulated game in --simulate mode")
+    parser.add_argument("--sim-duration", type=float, default=60, help="Seconds of simulated game in --simulate mode (0: endless)")
+    parser.add_argument("--sim-sprites", default=None, help="Dataset folder to harvest sprites from instead of drawing discs")
+
+
+def simulator_source_from_args(args):
+    sprites = harvest_sprites(args.sim_sprites) if args.sim_sprites else None
+    simulator = FruitNinjaSimulator(fps=args.fps, seed=args.sim_seed, sprites=sprites or None)
+    return SimulatorSource(simulator, duration_s=args.sim_duration, realtime=not args.fast)
+
+
+if __name__ == "__main__":
+    # Closed-loop benchmark without a screen or a model: the agent sees the simulator's ground truth boxes
+    import argparse
+    from game_wrapper import GameWrapper
+    from actuator import SwipeExecutor
+    from metrics import StageMetrics
+    from track_agent import TrackAgent
+
+    parser = argparse.ArgumentParser(description="Play the simulated game with the tracking agent on ground truth boxes.")
+    add_simulator_arguments(parser)
+    parser.add_argument("--fps", type=float, default=60.0, help="Simulated frame rate")
+    parser.add_argument("--fast", action="store_true",
+                        help="Run the simulation as fast as the agent can take frames, on simulated time so the score is reproducible")
+    parser.add_argument("--show", action="store_true", help="Show the game window")
+    args = parser.parse_args()
+
+    source = simulator_source_from_args(args)
+    simulator = source.simulator
+    if args.fast:
+        # Everything on simulated time: the agent's clock, its latency and the swipes. The planner gets no time
+        # budget, since a plan cut off by the wall clock would differ from run to run. So a seed gives one score.
+        clock = lambda: simulator.time_ms / 1000
+        agent = TrackAgent(simulator.names, clock=clock)
+        agent.planner.budget_ms = float("inf")
+        agent.executor = SimulatedExecutor(lambda x, y: (x, y), source.mouse)
+        metrics = StageMetrics()
+        start = time.perf_counter()
+        source.open()
+        while True:
+            screen = source.grab()
+            if screen is None:
+                break
+            with metrics.stage("action"):
+                output = agent.step(screen, simulator.ground_truth(), simulator.time_ms, clock(), metrics)
+            agent.executor.advance(clock())
+            if args.show:
+                cv2.imshow("GameFrame", output)
+                if cv2.waitKey(1) & 0xFF == ord("q"):
+                    break
+        source.close()
+    else:
+        # At the game's frame rate with the real executor thread, as close to live play as it gets without a screen
+        agent = TrackAgent(simulator.names)
+
+        def custom_take_action(self, screen, prev_FPS, time_ms, delta_time):
+            return agent.step(screen, simulator.ground_truth(), time_ms, self.frame.timestamp, self.metrics)
+
+        game = GameWrapper(custom_take_action, source=source, headless=not args.show)
+        agent.executor = SwipeExecutor(game.game_to_screen_coords, source.mouse)
+        metrics = game.metrics
+        start = time.perf_counter()
+        game.play()
+    elapsed = time.perf_counter() - start
+    agent.close()
+    print(f"{simulator.time_ms / 1000 / elapsed:.1f}x real time")
+    print(simulator.format())
+    print(metrics.format())
@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+# Agents import this module first, so this is close to the moment the process started running Python code
+LAUNCH_TIME = time.perf_counter()
+
+
+class StartupProfile:
+    """ Wall-clock breakdown of agent startup up to the first real frame.
+    Phases are timed from launch (the import of this module), so phases run on background threads and the gaps
+    between phases (mostly imports) are visible as well. """
+    def __init__(self, start=LAUNCH_TIME):
+        self.start = start
+        self.phases = []    # (name, start, end) in perf_counter seconds
+        self.__lock = threading.Lock()
+
+    def record(self, name, start, end):
+        with self.__lock:
+            self.phases.append((name, start, end))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def mark(self, name):
+        """ Record a milestone such as the first frame. """
+        now = time.perf_counter()
+        self.record(name, now, now)
+
+    def in_background(self, name, function, *args, **kwargs):
+        """ Run `function` on its own thread as phase `name`, e.g. loading the model while the game region is found.
+        Returns a Future; its result() re-raises any exception of the function. """
+        future = Future()
+
+        def run():
+            try:
+                with self.phase(name):
+                    future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def format(self):
+        with self.__lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        lines = [f"{'startup phase':<20} {'from':>8} {'to':>8} {'took':>8}  (ms since launch)"]
+        for name, start, end in phases:
+            begin, finish = (start - self.start) * 1000, (end - self.start) * 1000
+            lines.append(f"{name:<20} {begin:>8.0f} {finish:>8.0f} {finish - begin:>8.0f}")
+        return "\n".join(lines)
+
+
+def add_startup_arguments(parser):
+    parser.add_argument("--warmup", type=int, default=3, help="Warm-up inferences on a blank frame before capture starts")
+    parser.add_argument("--startup-profile", action="store_true", help="Print how long each startup phase took")
@@ -1,78 +1,234 @@
+from startup import StartupProfile, add_startup_arguments    # First, so the startup profile covers the other imports
 from game_wrapper import GameWrapper
+from frame_source import add_source_arguments, source_from_args
+from metrics import add_metrics_arguments
+from detector import add_detector_arguments, detector_from_args
+from preprocess import FramePreprocessor
+from tracker import Tracker
+from scheduler import DetectionScheduler
+from track_store import TrackStore
+from trajectory import predict_intercepts
+from planner import SwipePlanner
+from gating import add_gate_arguments, gate_from_args
+from roi import RoiDetector, add_roi_arguments
+from actuator import Swipe, add_actuator_arguments, executor_from_args
+from recorder import add_recorder_arguments, recorder_from_args
+from detector import Detections
+from metrics import StageMetrics
+import os
+import sys
 import cv2
-import torch
-from ultralytics import YOLO
-from collections import defaultdict
 import numpy as np
-import os
-
-
-if __name__ == "__main__":
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    weights_path = "../detection_model/FruitNinja/YOLO11s/weights/best.pt"
-    model = YOLO(weights_path).to(device)
-
-    # Store the track history for each fruit
-    track_history = defaultdict(lambda: [])
-    y_percentage_threshold = 0.1
-
-    def custom_take_action(self, screen, prev_FPS, time_ms, delta_time):
-        frame = cv2.cvtColor(screen, cv2.COLOR_BGRA2BGR)
-
-        prev_FPS = prev_FPS or 0  # In the first frame, there is no FPS
-
-        # Run YOLO tracking on the frame, persisting tracks between frames
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        tracker_path = os.path.join(script_dir, "custom_tracker.yaml")
-        results = model.track(frame, persist=True, verbose=False, tracker=tracker_path)
-
-        annotated_frame = results[0].plot()
-        orig_shape = results[0].orig_shape
-
-        # Get the boxes and track IDs
-        boxes = results[0].boxes.xywh.cpu()
-        if results[0].boxes.id is None:
-            cv2.setWindowTitle("GameFrame", f"FPS: {prev_FPS:.2f} - Counter: {time_ms:.2f} - dT: {delta_time:.2f} - Press Q to quit")
-            cv2.imshow("GameFrame", annotated_frame)
-            cv2.setWindowProperty("GameFrame", cv2.WND_PROP_TOPMOST, 1)
-            return
-
-        track_ids = results[0].boxes.id.int().cpu().tolist()
-        class_ids = results[0].boxes.cls.int().cpu().tolist()
-
-        # Plot the tracks and velocity vectors
-        for box, track_id, class_id in zip(boxes, track_ids, class_ids):
-            x, y, w, h = map(float, box)
+import time
+import argparse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from common import get_classnames
+
+
+class TrackAgent:
+    """ Everything the tracking agent keeps per game: tracks, their position history, swipe planning and the overlay.
+    Detection happens outside, so one detector can serve a single game (this script) or several (multi_game.py). """
+    def __init__(self, names, executor=None, swipe_speed=4000, y_percentage_threshold=0.1, clock=time.perf_counter):
+        self.names = names
+        self.clock = clock                  # Seconds; capture times and swipe start times are on this clock
+        self.executor = executor            # SwipeExecutor, or None to only draw the plans
+        self.swipe_speed = swipe_speed      # Pixels per second
+        self.y_percentage_threshold = y_percentage_threshold
+        self.preprocessor = FramePreprocessor()
+        self.tracker = Tracker()
+        # Store the track history for each fruit in fixed-size ring buffers
+        self.track_history = TrackStore(capacity=64, history=32)
+        self.planner = SwipePlanner(budget_ms=2.0)
+        self.swipe = None   # The swipe scheduled in the last act(), if any
+
+    def track(self, detections, time_ms):
+        """ Update the tracks with new detections, or only propagate them if there are none. Returns (tracks, detected). """
+        if detections is None:
+            return self.tracker.predict(time_ms), False
+        return self.tracker.update(detections, time_ms), True
+
+    def step(self, screen, detections, time_ms, capture_time, metrics):
+        """ Handle one captured BGRA frame given its detections (None if detection was skipped). Returns the overlay. """
+        with metrics.stage("convert"):
+            frame = self.preprocessor.to_bgr(screen)
+        with metrics.stage("tracking"):
+            tracks, detected = self.track(detections, time_ms)
+        return self.act(frame, tracks, detected, time_ms, capture_time, metrics)
+
+    def act(self, frame, tracks, detected, time_ms, capture_time, metrics):
+        """ Record, predict, plan and draw for one BGR frame captured at `capture_time` (self.clock seconds). """
+        with metrics.stage("tracking"):
+            centres = (tracks.boxes[:, :2] + tracks.boxes[:, 2:]) / 2
 
             # If fruits are not fully in the frame, bounding box is too noisy
-            y_threshold = orig_shape[0] * y_percentage_threshold
-            if y > orig_shape[0] - y_threshold:
-                continue
+            y_threshold = frame.shape[0] * self.y_percentage_threshold
+            keep = centres[:, 1] <= frame.shape[0] - y_threshold
 
             # Half-fruits are not important
-            label = results[0].names[class_id]
-            if "Half" in label:
-                continue
-
-            track = track_history[track_id]
+            keep &= np.array(["Half" not in self.names[c] for c in tracks.classes], dtype=bool)
+
+            # Propagated positions are not observations, so only detections go into the history
+            updated_tracks = tracks.ids[keep]
+            if detected:
+                slots = self.track_history.update(updated_tracks, centres[keep], time_ms, tracks.classes[keep])
+                history_slots = slots[slots >= 0]   # -1: a new track that did not fit in the store
+            else:
+                # Propagated tracks include ones that were only ever detected in the bottom band, without a history
+                history_slots = [self.track_history.slot_of(int(track_id)) for track_id in updated_tracks]
+                history_slots = [slot for slot in history_slots if slot is not None]
+
+            # Clean up tracks that haven't been on screen for the last 5 seconds
+            self.track_history.expire(time_ms, 5000)
+
+        # Predict where each fruit will be once the frame's capture-to-now latency has passed again
+        with metrics.stage("prediction"):
+            latency_ms = (self.clock() - capture_time) * 1000
+            fit, intercepts = predict_intercepts(self.track_history, time_ms, latency_ms)
+
+        # Plan a swipe on where the objects will be when it is performed, unless the previous one is still running
+        plan = None
+        self.swipe = None
+        if self.executor is not None and not self.executor.busy:
+            with metrics.stage("planning"):
+                latency_ms = (self.clock() - capture_time) * 1000
+                predicted = self.tracker.predict(time_ms + latency_ms)
+                plan = self.planner.plan(predicted.boxes, predicted.classes, bounds=(frame.shape[1], frame.shape[0]))
+                if plan is not None:
+                    length = np.linalg.norm(np.diff(plan.points, axis=0), axis=1).sum()
+                    self.swipe = Swipe(plan.points, self.clock(), length / self.swipe_speed)
+                    self.executor.schedule(self.swipe)
+
+        # Draw the boxes, the tracking lines, the predicted positions and the planned swipe
+        with metrics.stage("overlay"):
+            for box, track_id, class_id, conf in zip(tracks.boxes, tracks.ids, tracks.classes, tracks.confidences):
+                x1, y1, x2, y2 = map(int, box)
+                label = f"{self.names[class_id]} id:{track_id} {conf:.2f}"
+                color = (0, 255, 0) if "Whole" in label else (255, 0, 0) if "Half" in label else (0, 0, 255) if "bomb" in label else (0, 0, 0)
+                cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+                cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+            for slot in history_slots:
+                positions, _ = self.track_history.samples(slot)
+                points = positions.astype(np.int32).reshape((-1, 1, 2))
+                cv2.polylines(frame, [points], isClosed=False, color=(230, 230, 230), thickness=1)
+            for x, y in intercepts[fit.valid].astype(np.int32):
+                cv2.circle(frame, (int(x), int(y)), 6, (0, 255, 255), 2)
+            if plan is not None:
+                cv2.polylines(frame, [plan.points.astype(np.int32).reshape((-1, 1, 2))], isClosed=False, color=(255, 0, 255), thickness=3)
+
+        return frame
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
+            print(f"Swipes: {self.executor.completed} completed, {self.executor.cancelled} cancelled")
+
+
+def self_check():
+    """ Run the agent on synthetic tracks for the cases where the tracker reports tracks without a history. """
+    names = get_classnames()
+    whole = next(i for i, name in enumerate(names) if name.endswith("Whole"))
+    metrics = StageMetrics()
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+
+    def detections(centres):
+        centres = np.asarray(centres, dtype=np.float32)
+        return Detections(np.concatenate([centres - 15, centres + 15], axis=1).astype(np.float32),
+                          np.full(len(centres), whole, dtype=np.int32), np.full(len(centres), 0.9, dtype=np.float32))
+
+    # More fruit in one frame than the track store has slots: the ones that do not fit get no history
+    agent = TrackAgent(names)
+    count = agent.track_history.capacity + 8
+    tracks, detected = agent.track(detections(np.stack([np.linspace(20, 1260, count), np.full(count, 300)], axis=1)), 0.0)
+    assert len(tracks.ids) == count
+    agent.act(frame.copy(), tracks, detected, 0.0, agent.clock(), metrics)
+    assert len(agent.track_history) == agent.track_history.capacity
+
+    # A fruit only detected in the bottom band has no history when propagation moves it above the band
+    agent = TrackAgent(names)
+    for i, y in enumerate((715, 700, 685, 670)):
+        tracks, detected = agent.track(detections([[640, y]]), i * 16.0)
+        agent.act(frame.copy(), tracks, detected, i * 16.0, agent.clock(), metrics)
+    tracks, detected = agent.track(None, 3 * 16.0 + 200)
+    assert not detected and len(tracks.ids) == 1 and tracks.boxes[0, 1] + 15 < 720 * 0.9
+    assert agent.track_history.slot_of(int(tracks.ids[0])) is None
+    agent.act(frame.copy(), tracks, detected, 3 * 16.0 + 200, agent.clock(), metrics)
+    print("Self-check passed")
 
-            # Append the new position with velocity and timestamp
-            track.append((x, y, time_ms))
 
-            # Draw the tracking lines
-            points = np.array([(p[0], p[1]) for p in track], dtype=np.int32).reshape((-1, 1, 2))
-            cv2.polylines(annotated_frame, [points], isClosed=False, color=(230, 230, 230), thickness=1)
-
-        # Clean up tracks that haven't been on screen for the last 5 seconds
-        for track_id in list(track_history.keys()):
-            last_position_time = track_history[track_id][-1][2]
-            if time_ms - last_position_time > 5000:
-                del track_history[track_id]
-
-        # Display the annotated frame
-        cv2.setWindowTitle("GameFrame", f"FPS: {prev_FPS:.2f} - Counter: {time_ms:.2f} - dT: {delta_time:.2f} - Press Q to quit")
-        cv2.imshow("GameFrame", annotated_frame)
-        cv2.setWindowProperty("GameFrame", cv2.WND_PROP_TOPMOST, 1)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track fruits in the game with YOLO and draw their trajectories.")
+    parser.add_argument("--pipelined", action="store_true", help="Run capture, tracking and display on separate threads")
+    add_source_arguments(parser)
+    add_metrics_arguments(parser)
+    add_detector_arguments(parser)
+    parser.add_argument("--budget-ms", type=float, default=0,
+                        help="Per-frame detection budget. Frames between detections only propagate the tracks (0 detects every frame)")
+    add_actuator_arguments(parser)
+    add_gate_arguments(parser)
+    add_roi_arguments(parser)
+    parser.add_argument("--swipe-speed", type=float, default=4000, help="Swipe speed in pixels per second")
+    add_startup_arguments(parser)
+    add_recorder_arguments(parser)
+    parser.add_argument("--self-check", action="store_true", help="Run the agent on synthetic tracks and exit")
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        raise SystemExit
+
+    # The model (and torch or the inference runtime with it) loads in the background while the game region is found
+    startup = StartupProfile()
+    detector_future = startup.in_background("model load", detector_from_args, args)
+    gate = gate_from_args(args)
 
-    game = GameWrapper(custom_take_action, monitor_index=0)
-    game.play()
+    def custom_take_action(self, screen, prev_FPS, time_ms, delta_time):
+        with self.metrics.stage("convert"):
+            frame = agent.preprocessor.to_bgr(screen)   # Reused buffer instead of a new allocation per frame
+
+        # A static screen (menus, between waves) keeps the previous results and only propagates the tracks
+        changed = True
+        if gate is not None:
+            with self.metrics.stage("gate"):
+                changed = gate.changed(screen, time_ms)
+            self.metrics.record_ratio("gate_skip", not changed)
+
+        detections = None
+        if not changed:
+            tracks, detected = agent.track(None, time_ms)
+        elif scheduler is not None:
+            # Detect or propagate, depending on the budget and the state of the tracks
+            with self.metrics.stage("inference"):
+                tracks, detected = scheduler.step(screen, time_ms)
+        else:
+            with self.metrics.stage("inference"):
+                detections = detector.detect(screen, time_ms)
+            # Assign track IDs, persisting tracks between frames
+            with self.metrics.stage("tracking"):
+                tracks, detected = agent.track(detections, time_ms)
+
+        image = agent.act(frame, tracks, detected, time_ms, self.frame.timestamp, self.metrics)
+        self.annotate(detections=detections, tracks=tracks, detected=detected, swipe=agent.swipe)
+        return image
+
+    with startup.phase("game region"):
+        game = GameWrapper(custom_take_action, source=source_from_args(args), window_topmost=True, headless=args.headless,
+                           metrics_interval=args.metrics_every, metrics_path=args.metrics_out,
+                           startup=startup if args.startup_profile else None, recorder=recorder_from_args(args))
+    with startup.phase("wait for model"):
+        detector = detector_future.result()
+    executor = executor_from_args(args, game.game_to_screen_coords, mouse=getattr(game.source, "mouse", None))
+    agent = TrackAgent(detector.names, executor=executor, swipe_speed=args.swipe_speed)
+    if args.roi:
+        detector = RoiDetector(detector, agent.tracker, full_interval_ms=args.roi_full_ms)
+    scheduler = DetectionScheduler(detector, agent.tracker, latency_budget_ms=args.budget_ms) if args.budget_ms > 0 else None
+
+    # Pay for the first inferences on blank frames of the game size rather than on the first live frames
+    with startup.phase("warm-up"):
+        detector.warm_up(game.source.region["width"], game.source.region["height"], args.warmup)
+    game.play(pipelined=args.pipelined)
+    agent.close()
+    if scheduler is not None:
+        print(scheduler.format())
+    if gate is not None:
+        print(gate.format())
+    if args.roi:
+        print(detector.format())
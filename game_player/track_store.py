@@ -0,0 +1,138 @@
+import numpy as np
+
+
+class TrackStore:
+    """ Position history of all tracked objects in preallocated ring buffers.
+    Each track gets a slot holding its last `history` samples. Slots are reused once a track expires, so memory and
+    per-frame cost stay the same no matter how long a session runs. External track IDs (from the tracker) are mapped
+    to slots with a dictionary; everything else works on whole arrays. """
+    def __init__(self, capacity=64, history=32):
+        self.capacity = capacity
+        self.history = history
+
+        self.positions = np.zeros((capacity, history, 2), dtype=np.float32)   # (x, y) per sample
+        self.times = np.zeros((capacity, history), dtype=np.float64)          # Timestamp per sample
+        self.counts = np.zeros(capacity, dtype=np.int64)        # Samples ever written to the slot since it was taken
+        self.last_seen = np.full(capacity, -np.inf)             # Timestamp of the newest sample
+        self.track_ids = np.full(capacity, -1, dtype=np.int64)  # External track ID, -1 for a free slot
+        self.class_ids = np.full(capacity, -1, dtype=np.int64)
+        self.__slots = {}   # External track ID -> slot
+
+    def __len__(self):
+        return len(self.__slots)
+
+    @property
+    def active(self):
+        return self.track_ids >= 0
+
+    def __take_slot(self, track_id, timestamp, reserved):
+        free = np.flatnonzero(self.track_ids < 0)
+        if len(free):
+            slot = free[0]
+        else:   # Full: reuse the slot of the track that has not been seen for the longest time
+            if reserved.all():
+                return -1   # Every slot belongs to a track of this update, there is no room for another one
+            slot = int(np.argmin(np.where(reserved, np.inf, self.last_seen)))
+            del self.__slots[int(self.track_ids[slot])]
+        self.track_ids[slot] = track_id
+        self.counts[slot] = 0
+        self.last_seen[slot] = timestamp    # So a slot taken in this update is not evicted by the next new track
+        self.__slots[track_id] = slot
+        return slot
+
+    def update(self, track_ids, xy, timestamp, class_ids=None):
+        """ Append one (x, y) sample at `timestamp` for every given track, creating tracks that are new. Returns the
+        slot of every track, -1 for new tracks that did not fit because the update has more tracks than the store. """
+        if len(track_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        slots = np.array([self.__slots.get(int(t), -1) for t in track_ids], dtype=np.int64)
+
+        # The slots of tracks in this update must not be handed to a new track of the same update
+        reserved = np.zeros(self.capacity, dtype=bool)
+        reserved[slots[slots >= 0]] = True
+        for i in np.flatnonzero(slots < 0):
+            slots[i] = self.__take_slot(int(track_ids[i]), timestamp, reserved)
+            if slots[i] >= 0:
+                reserved[slots[i]] = True
+
+        kept = slots >= 0
+        if not kept.all():
+            xy = np.asarray(xy)[kept]
+            if class_ids is not None:
+                class_ids = np.asarray(class_ids)[kept]
+        all_slots, slots = slots, slots[kept]
+        heads = self.counts[slots] % self.history
+        self.positions[slots, heads] = xy
+        self.times[slots, heads] = timestamp
+        self.counts[slots] += 1
+        self.last_seen[slots] = timestamp
+        if class_ids is not None:
+            self.class_ids[slots] = class_ids
+        return all_slots
+
+    def expire(self, now, max_age):
+        """ Free every slot whose newest sample is older than `max_age`. """
+        stale = np.flatnonzero(self.active & (now - self.last_seen > max_age))
+        for slot in stale:
+            del self.__slots[int(self.track_ids[slot])]
+        self.track_ids[stale] = -1
+        self.class_ids[stale] = -1
+        self.last_seen[stale] = -np.inf
+        return stale
+
+    def slot_of(self, track_id):
+        return self.__slots.get(track_id)
+
+    def track(self, track_id):
+        """ Samples of one track in chronological order as ((n, 2) positions, (n,) times). """
+        return self.samples(self.__slots[track_id])
+
+    def samples(self, slot):
+        """ track() by slot, for callers that already have the slots, like those returned by update(). """
+        n = min(self.counts[slot], self.history)
+        order = (self.counts[slot] - n + np.arange(n)) % self.history
+        return self.positions[slot, order], self.times[slot, order]
+
+    def recent(self, n=None, slots=None):
+        """ Last `n` samples of the given (default: all live) slots, oldest first and aligned at the newest sample.
+        Returns slots, positions (S, n, 2), times (S, n) and a validity mask (S, n) for tracks with fewer samples. """
+        n = min(n or self.history, self.history)
+        if slots is None:
+            slots = np.flatnonzero(self.active)
+        counts = self.counts[slots]
+        steps = np.arange(n)
+        order = (counts[:, None] - n + steps[None, :]) % self.history
+        valid = steps[None, :] >= n - np.minimum(counts, n)[:, None]
+        return slots, self.positions[slots[:, None], order], self.times[slots[:, None], order], valid
+
+    def velocities(self):
+        """ Finite difference velocity of the newest two samples of every live track with at least two samples.
+        Returns (track_ids, (N, 2) velocity) in position units per time unit. """
+        slots, xy, t, valid = self.recent(2)
+        ok = valid[:, 0] & (t[:, 1] > t[:, 0])
+        slots, xy, t = slots[ok], xy[ok], t[ok]
+        return self.track_ids[slots], (xy[:, 1] - xy[:, 0]) / (t[:, 1] - t[:, 0])[:, None]
+
+    def accelerations(self):
+        """ Finite difference acceleration of the newest three samples of every live track with at least three samples.
+        Returns (track_ids, (N, 2) acceleration) in position units per time unit squared. """
+        slots, xy, t, valid = self.recent(3)
+        ok = valid[:, 0] & (t[:, 1] > t[:, 0]) & (t[:, 2] > t[:, 1])
+        slots, xy, t = slots[ok], xy[ok], t[ok]
+        v1 = (xy[:, 1] - xy[:, 0]) / (t[:, 1] - t[:, 0])[:, None]
+        v2 = (xy[:, 2] - xy[:, 1]) / (t[:, 2] - t[:, 1])[:, None]
+        return self.track_ids[slots], (v2 - v1) / ((t[:, 2] - t[:, 0]) / 2)[:, None]
+
+
+if __name__ == "__main__":
+    # A full store that gets a known and a new track in one update must evict the other track, not the known one
+    store = TrackStore(capacity=2, history=4)
+    store.update(np.array([1, 2]), np.array([[0, 0], [10, 10]]), 0.0)
+    slots = store.update(np.array([1, 3]), np.array([[1, 1], [20, 20]]), 1.0)
+    assert slots[0] != slots[1] and store.slot_of(2) is None
+    assert np.array_equal(store.track(1)[0], [[0, 0], [1, 1]]) and np.array_equal(store.track(3)[0], [[20, 20]])
+
+    # An update with more tracks than the store has slots keeps the known ones and drops the new ones that do not fit
+    slots = store.update(np.array([1, 3, 4]), np.array([[2, 2], [21, 21], [30, 30]]), 2.0)
+    assert list(slots[2:]) == [-1] and store.slot_of(4) is None and len(store.track(3)[0]) == 2
+    print("TrackStore checks passed")
@@ -0,0 +1,200 @@
+import time
+from collections import namedtuple
+import numpy as np
+from detector import Detections, empty_detections
+
+
+# Tracker output for the tracks that were matched to a detection this frame, in frame pixel coordinates:
+#   ids (N,) int64, boxes (N, 4) float32 xyxy, classes (N,) int32, confidences (N,) float32
+Tracks = namedtuple("Tracks", ["ids", "boxes", "classes", "confidences"])
+
+# Kalman state per track: centre x, centre y, vx, vy, ay. Fruit move in straight lines horizontally and
+# accelerate downwards with (unknown but constant) gravity, so ay is part of the state and converges per track.
+_STATE = 5
+_H = np.array([[1, 0, 0, 0, 0],
+               [0, 1, 0, 0, 0]], dtype=np.float64)
+
+
+def box_iou(a, b):
+    """ IoU matrix between (N, 4) and (M, 4) xyxy boxes. """
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+
+class Tracker:
+    """ Multi-object tracker for Fruit Ninja objects working on plain Detections from any backend.
+    Each track runs a constant-acceleration Kalman filter on its box centre; all tracks are predicted and updated
+    together as stacked arrays. Detections are associated greedily by IoU with the predicted boxes, falling back to
+    centroid distance for fast fruit whose boxes no longer overlap, and only within the same class.
+    Timestamps are in milliseconds, like the counter GameWrapper passes to action functions. """
+    def __init__(self, min_iou=0.1, max_distance=1.0, new_track_conf=0.25, max_missed=30,
+                 position_noise=4.0, process_noise=(1.0, 50.0, 200.0), gravity=0.0):
+        self.min_iou = min_iou                  # Minimum IoU for a match...
+        self.max_distance = max_distance        # ...or maximum centre distance in units of the predicted box diagonal
+        self.new_track_conf = new_track_conf    # Unmatched detections above this confidence start new tracks
+        self.max_missed = max_missed            # Frames a track survives without a matching detection
+        self.position_noise = position_noise    # Measurement noise of a box centre in pixels
+        self.process_noise = process_noise      # Random walk of position, velocity and acceleration per second
+        self.gravity = gravity                  # Initial guess for ay in pixels / s^2 (screen y points down)
+
+        self.__noise = np.diag(np.array([process_noise[0], process_noise[0], process_noise[1], process_noise[1], process_noise[2]]) ** 2)
+        self.__next_id = 1
+        self.__last_time = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.state = np.zeros((0, _STATE))
+        self.covariance = np.zeros((0, _STATE, _STATE))
+        self.sizes = np.zeros((0, 2))               # Smoothed box width and height
+        self.classes = np.zeros(0, dtype=np.int32)
+        self.confidences = np.zeros(0, dtype=np.float32)
+        self.missed = np.zeros(0, dtype=np.int64)   # Consecutive frames without a matched detection
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def __transition(dt):
+        f = np.eye(_STATE)
+        f[0, 2] = f[1, 3] = f[3, 4] = dt
+        f[1, 4] = 0.5 * dt * dt
+        return f
+
+    def __predict_state(self, dt):
+        f = self.__transition(dt)
+        state = self.state @ f.T
+        covariance = f @ self.covariance @ f.T + self.__noise * max(dt, 1e-3)
+        return state, covariance
+
+    def boxes(self, state=None):
+        """ xyxy boxes of all tracks for the given (default: current) state. """
+        state = self.state if state is None else state
+        half = self.sizes / 2
+        return np.concatenate([state[:, :2] - half, state[:, :2] + half], axis=1).astype(np.float32)
+
+    def predict(self, timestamp):
+        """ Predicted boxes of all live tracks at `timestamp` without changing the tracker. """
+        dt = 0.0 if self.__last_time is None else (timestamp - self.__last_time) / 1000
+        state, _ = self.__predict_state(dt)
+        return Tracks(self.ids.copy(), self.boxes(state), self.classes.copy(), self.confidences.copy())
+
+    def uncertainty(self, timestamp):
+        """ Predicted standard deviation of every track's centre position at `timestamp`, in pixels. """
+        dt = 0.0 if self.__last_time is None else (timestamp - self.__last_time) / 1000
+        _, covariance = self.__predict_state(dt)
+        return np.sqrt(covariance[:, 0, 0] + covariance[:, 1, 1])
+
+    def __associate(self, predicted_boxes, detections):
+        if len(predicted_boxes) == 0 or len(detections.boxes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        iou = box_iou(predicted_boxes, detections.boxes)
+        track_centres = (predicted_boxes[:, :2] + predicted_boxes[:, 2:]) / 2
+        det_centres = (detections.boxes[:, :2] + detections.boxes[:, 2:]) / 2
+        diagonal = np.linalg.norm(predicted_boxes[:, 2:] - predicted_boxes[:, :2], axis=1)
+        distance = np.linalg.norm(track_centres[:, None] - det_centres[None], axis=2) / np.maximum(diagonal, 1)[:, None]
+
+        cost = np.where(iou > 0, 1 - iou, 1 + distance)
+        allowed = ((iou >= self.min_iou) | (distance <= self.max_distance)) & (self.classes[:, None] == detections.classes[None, :])
+        cost[~allowed] = np.inf
+
+        # Greedy assignment in rounds: pairs that are each other's cheapest option are matched together, then the
+        # remaining rows and columns are tried again. Few objects are on screen, so this is as good as Hungarian here.
+        track_index, det_index = [], []
+        rows = np.arange(cost.shape[0])
+        while np.isfinite(cost).any():
+            best_det = np.argmin(cost, axis=1)
+            best_track = np.argmin(cost, axis=0)
+            mutual = (best_track[best_det] == rows) & np.isfinite(cost[rows, best_det])
+            i, j = rows[mutual], best_det[mutual]
+            track_index.append(i)
+            det_index.append(j)
+            cost[i, :] = np.inf
+            cost[:, j] = np.inf
+        if not track_index:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(track_index).astype(np.int64), np.concatenate(det_index).astype(np.int64)
+
+    def update(self, detections, timestamp):
+        """ Advance all tracks to `timestamp`, associate `detections` and return the tracks matched this frame. """
+        if detections is None:
+            detections = empty_detections()
+        dt = 0.0 if self.__last_time is None else (timestamp - self.__last_time) / 1000
+        self.__last_time = timestamp
+
+        self.state, self.covariance = self.__predict_state(dt)
+        track_index, det_index = self.__associate(self.boxes(), detections)
+
+        # Kalman update of all matched tracks at once
+        if len(track_index):
+            z = (detections.boxes[det_index, :2] + detections.boxes[det_index, 2:]) / 2
+            p = self.covariance[track_index]
+            s = _H @ p @ _H.T + np.eye(2) * self.position_noise ** 2
+            k = p @ _H.T @ np.linalg.inv(s)
+            innovation = z - self.state[track_index, :2]
+            self.state[track_index] += (k @ innovation[..., None])[..., 0]
+            self.covariance[track_index] = (np.eye(_STATE) - k @ _H) @ p
+
+            sizes = detections.boxes[det_index, 2:] - detections.boxes[det_index, :2]
+            self.sizes[track_index] = 0.5 * self.sizes[track_index] + 0.5 * sizes
+            self.confidences[track_index] = detections.confidences[det_index]
+
+        self.missed += 1
+        self.missed[track_index] = 0
+        matched_ids = self.ids[track_index]
+
+        # Start tracks for confident unmatched detections
+        unmatched = np.ones(len(detections.boxes), dtype=bool)
+        unmatched[det_index] = False
+        new = np.flatnonzero(unmatched & (detections.confidences >= self.new_track_conf))
+        if len(new):
+            boxes = detections.boxes[new]
+            state = np.zeros((len(new), _STATE))
+            state[:, :2] = (boxes[:, :2] + boxes[:, 2:]) / 2
+            state[:, 4] = self.gravity
+            covariance = np.tile(np.diag([self.position_noise ** 2, self.position_noise ** 2, 1e6, 1e6, 1e7]), (len(new), 1, 1))
+            new_ids = np.arange(self.__next_id, self.__next_id + len(new), dtype=np.int64)
+            self.__next_id += len(new)
+
+            self.ids = np.concatenate([self.ids, new_ids])
+            self.state = np.concatenate([self.state, state])
+            self.covariance = np.concatenate([self.covariance, covariance])
+            self.sizes = np.concatenate([self.sizes, boxes[:, 2:] - boxes[:, :2]])
+            self.classes = np.concatenate([self.classes, detections.classes[new]])
+            self.confidences = np.concatenate([self.confidences, detections.confidences[new]])
+            self.missed = np.concatenate([self.missed, np.zeros(len(new), dtype=np.int64)])
+            matched_ids = np.concatenate([matched_ids, new_ids])
+            det_index = np.concatenate([det_index, new])
+
+        # Drop tracks that have not been seen for too long
+        alive = self.missed <= self.max_missed
+        if not alive.all():
+            self.ids, self.state, self.covariance = self.ids[alive], self.state[alive], self.covariance[alive]
+            self.sizes, self.classes = self.sizes[alive], self.classes[alive]
+            self.confidences, self.missed = self.confidences[alive], self.missed[alive]
+
+        return Tracks(matched_ids, detections.boxes[det_index], detections.classes[det_index], detections.confidences[det_index])
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: objects flying on parabolas, tracked over many frames
+    rng = np.random.default_rng(0)
+    for num_objects in (10, 20, 30):
+        tracker = Tracker()
+        start = rng.uniform([100, 700, -200, -900], [1100, 720, 200, -600], size=(num_objects, 4))
+        classes = rng.integers(0, 21, num_objects).astype(np.int32)
+        timings = []
+        for frame in range(200):
+            t = frame / 60
+            cx = start[:, 0] + start[:, 2] * t
+            cy = start[:, 1] + start[:, 3] * t + 0.5 * 1200 * t * t
+            boxes = np.stack([cx - 40, cy - 40, cx + 40, cy + 40], axis=1).astype(np.float32)
+            detections = Detections(boxes, classes, np.full(num_objects, 0.9, dtype=np.float32))
+            begin = time.perf_counter_ns()
+            tracks = tracker.update(detections, t * 1000)
+            timings.append(time.perf_counter_ns() - begin)
+        timings = np.array(timings[10:]) / 1e6
+        print(f"{num_objects} objects: {np.median(timings):.3f} ms median, {np.percentile(timings, 99):.3f} ms p99, "
+              f"{len(tracker)} tracks alive")
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class BallisticFit:
+    """ Per-track parabolic motion fitted over the recent history of a TrackStore.
+    x(t) = x0 + vx * t and y(t) = y0 + vy * t + ay * t^2 / 2, with t relative to each track's newest sample.
+    x gets no acceleration term because fruit only accelerate vertically. All tracks are solved at once as one
+    batched least-squares problem. Screen y points down, so gravity gives a positive ay. """
+    def __init__(self, track_ids, class_ids, t0, x, y, valid):
+        self.track_ids = track_ids  # (N,) external track IDs
+        self.class_ids = class_ids  # (N,)
+        self.t0 = t0                # (N,) time of each track's newest sample
+        self.x = x                  # (N, 2) x0, vx
+        self.y = y                  # (N, 3) y0, vy, ay
+        self.valid = valid          # (N,) whether the track had enough samples for a fit
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def position_at(self, timestamp):
+        """ Predicted (N, 2) screen positions at an absolute timestamp. """
+        dt = timestamp - self.t0
+        px = self.x[:, 0] + self.x[:, 1] * dt
+        py = self.y[:, 0] + self.y[:, 1] * dt + 0.5 * self.y[:, 2] * dt * dt
+        return np.stack([px, py], axis=1)
+
+    def time_to_apex(self, timestamp):
+        """ Time from `timestamp` until each fruit reaches its highest point (negative if it is already falling).
+        NaN for tracks without upward curvature. """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            apex = self.t0 - self.y[:, 1] / self.y[:, 2]
+        apex[self.y[:, 2] <= 0] = np.nan
+        return apex - timestamp
+
+    def time_to_exit(self, timestamp, width, height):
+        """ Time from `timestamp` until each fruit leaves the region [0, width] x [0, height].
+        Fruit leave through the bottom after falling, or through the sides. NaN if it never leaves. """
+        dt_now = timestamp - self.t0
+        a, b, c = 0.5 * self.y[:, 2], self.y[:, 1], self.y[:, 0] - height
+        # Later root of a * t^2 + b * t + c = 0, i.e. when the fruit falls back through the bottom edge
+        with np.errstate(divide="ignore", invalid="ignore"):
+            disc = np.sqrt(b * b - 4 * a * c)
+            bottom = np.where(np.abs(a) > 1e-12, (-b + disc) / (2 * a), -c / b)
+            side = np.where(self.x[:, 1] > 1e-6, (width - self.x[:, 0]) / self.x[:, 1],
+                            np.where(self.x[:, 1] < -1e-6, -self.x[:, 0] / self.x[:, 1], np.inf))
+        exit_time = np.fmin(np.where(bottom > dt_now, bottom, np.nan), np.where(side > dt_now, side, np.nan))
+        exit_time[np.isinf(exit_time)] = np.nan
+        return exit_time - dt_now
+
+
+def fit_ballistic(store, window=8, min_samples=3, gravity=None):
+    """ Fit BallisticFit over the last `window` samples of every live track in a TrackStore.
+    Tracks with fewer than `min_samples` samples get a constant velocity (or constant position) fit and valid=False.
+    If `gravity` is given, ay is fixed to it instead of being estimated, which is more robust for short tracks. """
+    slots, xy, t, mask = store.recent(window)
+    n = len(slots)
+    counts = mask.sum(axis=1)
+    t0 = t[:, -1] if n else np.zeros(0)
+    dt = np.where(mask, t - t0[:, None], 0.0)
+    w = mask.astype(np.float64)
+
+    # Normal equations per track: (A^T W A) p = A^T W b, solved for all tracks in one batched call
+    def solve(columns, values, size):
+        a = np.stack(columns, axis=2)     # (N, window, size)
+        lhs = np.einsum("nki,nk,nkj->nij", a, w, a)
+        rhs = np.einsum("nki,nk,nk->ni", a, w, values)
+        lhs += np.eye(size) * 1e-9  # Keeps tracks with too few samples solvable
+        return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+    ones = np.ones_like(dt)
+    px = np.zeros((n, 2))
+    py = np.zeros((n, 3))
+    if n:
+        x = xy[..., 0].astype(np.float64)
+        y = xy[..., 1].astype(np.float64)
+        moving = counts >= 2
+        px[moving] = solve([ones, dt], x, 2)[moving]
+        px[~moving, 0] = x[~moving, -1]
+        if gravity is not None:
+            py[:, 2] = gravity
+            py[moving, :2] = solve([ones, dt], y - 0.5 * gravity * dt * dt, 2)[moving]
+        else:
+            full = counts >= 3
+            py[full] = solve([ones, dt, 0.5 * dt * dt], y, 3)[full]
+            partial = moving & ~full
+            py[partial, :2] = solve([ones, dt], y, 2)[partial]
+        py[~moving, 0] = y[~moving, -1]
+
+    return BallisticFit(store.track_ids[slots], store.class_ids[slots], t0, px, py, counts >= min_samples)
+
+
+def predict_intercepts(store, now, latency, window=8, gravity=None):
+    """ Where every tracked fruit will be once an action issued now takes effect.
+    `latency` is the measured pipeline delay (capture to actuation) in the store's time unit. """
+    fit = fit_ballistic(store, window=window, gravity=gravity)
+    return fit, fit.position_at(now + latency)